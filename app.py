@@ -33,8 +33,11 @@ async def main():
     # Import async coroutines
     # from src.websocket_client import fetch_market_data
     from v3 import fetch_market_data
-    from db import push_data_to_db, setup_database, push_failed_data
+    from db import push_data_to_db, setup_database, push_failed_data, close_influx_writers, close_spill_stores, spill_feed
+    from pipeline import BackpressureQueue, CoalescingBuffer
+    from pipeline.coalescing_buffer import INGEST_BUFFER
     from utils import monitor_data_transfer
+    from utils.metrics import start_metrics_server
 
     # Ensure the sqlite db directory exists
     if not os.path.exists('sqlite_db'):
@@ -43,8 +46,15 @@ async def main():
     # Setup database
     await setup_database()
 
-    # Initialize async queue for data storage
-    q = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
+    # Initialize async queue for data storage, see `QUEUE_OVERFLOW_POLICY` for what happens when it is full,
+    # or the latest-wins buffer which only keeps the newest state per instrument, see `INGEST_BUFFER`
+    if INGEST_BUFFER == "coalescing":
+        q = CoalescingBuffer()
+    else:
+        q = BackpressureQueue(maxsize=MAX_QUEUE_SIZE, spill=spill_feed)
+
+    # Serve the Prometheus metrics, see `METRICS_PORT`
+    metrics_runner = await start_metrics_server()
 
     # Initialize the shared success event
     success_event = asyncio.Event()
@@ -60,7 +70,14 @@ async def main():
     if DATA_FEED_UPDATE_URL:
         tasks.append(asyncio.create_task(monitor_data_transfer(success_event=success_event)))
 
-    await asyncio.gather(*tasks)
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # Release the pooled InfluxDB connections and commit spilled data
+        await close_influx_writers()
+        await close_spill_stores()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
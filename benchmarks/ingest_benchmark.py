@@ -0,0 +1,352 @@
+"""
+End-to-end throughput and latency benchmark of the ingest pipeline.
+
+Every scenario (instrument count x message rate x encoding path) runs in a fresh process against
+`feed_server_mock`, started in its own process with the scenario's instruments and rate. The app's
+own receive path (`fetch_market_data`: authorize, websocket receive, decode) puts the frames into
+the queue, where they are batched, filtered, encoded and written to a local mock of the InfluxDB
+write endpoint, also running in its own process.
+
+Encoding paths:
+- 'current': `push_data_to_db` as run by the app.
+- 'legacy': the frames are batched the same way, but encoded by the pre-columnar
+  `create_influx_query(transform_data(batch))` of `src/data_push.py` and written one batch at a time.
+
+Reported per scenario: frames/s, lines/s, CPU time per line, peak RSS and receive-to-ack latency
+percentiles. Results are written as JSON so builds can be compared with `--compare`.
+
+Usage:
+    python benchmarks/ingest_benchmark.py --instruments 100,1000 --rates 10,50 --duration 20
+    python benchmarks/ingest_benchmark.py --paths current,legacy --rates 10
+    python benchmarks/ingest_benchmark.py --compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(REPO_DIR, "src")
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+FEED_MOCK_APP = os.path.join(REPO_DIR, "feed_server_mock", "app.py")
+
+# Distinct live frames the feed mock builds per scenario and cycles for the rest of the run
+PREBUILT_FRAMES = 200
+# Feed mock rate of unpaced scenarios, it sends back to back
+UNPACED_RATE = 1_000_000
+ENCODING_PATHS = ("current", "legacy")
+# Instrument subscribed by the app, the feed mock adds the others as NSE_EQ|MOCK<n>
+SUBSCRIBED_KEY = "NSE_EQ|BENCH000000"
+# Pipeline settings recorded with the results, they change what is measured
+RECORDED_SETTINGS = (
+    "BATCH_MAX_ITEMS", "BATCH_MAX_BYTES", "BATCH_MAX_AGE_MS", "BATCH_MAX_PENDING_FLUSHES",
+    "INFLUX_WRITE_MAX_LINES", "INFLUX_WRITE_MAX_IN_FLIGHT", "INFLUX_WRITE_GZIP", "CANDLE_EMIT_MODE",
+    "AGGREGATE_INTERVALS", "CAPTURE_TICKS", "CAPTURE_DEPTH", "DECODE_WORKERS",
+)
+
+
+def start_mock_feed(port: int, instruments: int, rate: float) -> subprocess.Popen:
+    """Starts `feed_server_mock` in its own process, streaming `instruments` instruments at `rate` frames/s."""
+    env = dict(
+        os.environ,
+        FEED_MOCK_HOST="127.0.0.1",
+        FEED_MOCK_PORT=str(port),
+        FEED_MOCK_PUBLIC_HOST="127.0.0.1",
+        FEED_MOCK_INSTRUMENTS=str(max(0, instruments - 1)),
+        FEED_MOCK_RATE=str(rate or UNPACED_RATE),
+        FEED_MOCK_PREBUILT_FRAMES=str(PREBUILT_FRAMES),
+    )
+    return subprocess.Popen([sys.executable, FEED_MOCK_APP], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _seed_instrument_master(keys: list) -> None:
+    from utils.instrument_master import InstrumentMaster
+
+    master = InstrumentMaster()
+    master._write_index(
+        [{"instrument_key": key, "trading_symbol": key.split("|")[1]} for key in keys],
+        {"etag": None, "last_modified": None, "fetched_at": time.time()},
+    )
+
+
+def _wait_for_port(port: int, timeout: float) -> None:
+    """Waits until a server accepts connections on `port` of the loopback interface."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+class CountingQueue(asyncio.Queue):
+    """Ingest queue which counts the frames put by the receive path and notes when the first arrived."""
+
+    def __init__(self, maxsize: int):
+        super().__init__(maxsize)
+        self.produced = 0
+        self.first_at = None
+
+    async def put(self, item) -> None:
+        if self.first_at is None:
+            self.first_at = time.monotonic()
+        self.produced += 1
+        await super().put(item)
+
+
+async def _legacy_consumer(q: asyncio.Queue, tracker) -> None:
+    """Batches like the app, but encodes with the DataFrame based path the columnar encoder replaced."""
+    import data_push as legacy  # src/data_push.py
+    from db.data_push import push_data_to_influxdb, transform_data
+    from db.db_ingestion import INFLUX_BUCKET_NAME, INFLUX_DB_ORG, INFLUX_DB_TOKEN, INFLUX_DB_URL
+    from pipeline.batcher import Batcher
+
+    async def flush(batch: list) -> None:
+        query = legacy.create_influx_query(transform_data(batch))
+        await push_data_to_influxdb(influx_query=query, influxdb_url=INFLUX_DB_URL, org=INFLUX_DB_ORG,
+                                    bucket_name=INFLUX_BUCKET_NAME, token=INFLUX_DB_TOKEN)
+
+    await Batcher(queue=q, flush=flush, max_pending_flushes=1, latency_tracker=tracker).run()
+
+
+async def _run_pipeline(path: str, duration: float, connect_timeout: float, drain_timeout: float) -> dict:
+    from db import push_data_to_db, setup_database, close_influx_writers, close_spill_stores
+    from pipeline.batcher import LatencyTracker
+    from v3 import fetch_market_data
+
+    await setup_database()
+    q = CountingQueue(maxsize=10_000)
+    tracker = LatencyTracker("benchmark", max_samples=10_000_000, report_interval=float("inf"))
+    if path == "legacy":
+        consumer = asyncio.create_task(_legacy_consumer(q, tracker))
+    else:
+        consumer = asyncio.create_task(push_data_to_db(data_queue=q, success_event=asyncio.Event(), latency_tracker=tracker))
+
+    cpu_started = time.process_time()
+    producer = asyncio.create_task(fetch_market_data(q=q))
+    deadline = time.monotonic() + connect_timeout
+    while q.first_at is None and time.monotonic() < deadline and not producer.done():
+        await asyncio.sleep(0.01)
+    if q.first_at is None:
+        producer.cancel()
+        consumer.cancel()
+        raise RuntimeError("No frame received from the feed mock")
+
+    # Frames are received for `duration` seconds after the first one
+    await asyncio.sleep(max(0.0, q.first_at + duration - time.monotonic()))
+    producer.cancel()
+    await asyncio.gather(producer, return_exceptions=True)
+    produced = q.produced
+    produce_elapsed = time.monotonic() - q.first_at
+
+    # Every item is recorded by the tracker once its batch was acknowledged
+    deadline = time.monotonic() + drain_timeout
+    while len(tracker.samples) < produced and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - q.first_at
+    cpu = time.process_time() - cpu_started
+
+    consumer.cancel()
+    await asyncio.gather(consumer, return_exceptions=True)
+    await close_influx_writers()
+    await close_spill_stores()
+
+    return {
+        "frames_produced": produced,
+        "frames_acked": len(tracker.samples),
+        "produce_seconds": produce_elapsed,
+        "elapsed_seconds": elapsed,
+        "cpu_seconds": cpu,
+        "latency_ms": {
+            "p50": tracker.percentile(50),
+            "p90": tracker.percentile(90),
+            "p99": tracker.percentile(99),
+            "max": tracker.percentile(100),
+        },
+    }
+
+
+def run_scenario(instruments: int, rate: float, path: str, duration: float, influx_url: str, feed_port: int,
+                 connect_timeout: float, drain_timeout: float, result_queue) -> None:
+    """Runs one scenario in the current (fresh) process and puts its results into `result_queue`."""
+    workdir = tempfile.mkdtemp(prefix="ingest_benchmark_")
+    os.chdir(workdir)
+    os.makedirs("sqlite_db", exist_ok=True)
+    os.environ.update(
+        INFLUX_DB_URL=influx_url,
+        INFLUX_DB_ORG="benchmark",
+        INFLUX_BUCKET_NAME="benchmark",
+        INFLUX_DB_TOKEN="benchmark",
+        INSTRUMENT_CACHE_DIR=os.path.join(workdir, "instrument_cache"),
+        ACCESS_TOKEN="benchmark",
+        UPSTOX_AUTHORIZE_URL=f"http://127.0.0.1:{feed_port}/v3/feed/market-data-feed/authorize",
+        INSTRUMENTS_LIST=SUBSCRIBED_KEY,
+    )
+    sys.path.insert(0, SRC_DIR)
+    logging.basicConfig(level=logging.WARNING)
+
+    _seed_instrument_master([SUBSCRIBED_KEY] + [f"NSE_EQ|MOCK{i:06d}" for i in range(instruments - 1)])
+
+    import aiohttp
+
+    async def influx_stats(path: str, method: str = "get") -> dict:
+        async with aiohttp.ClientSession() as session:
+            async with session.request(method, f"{influx_url}{path}") as response:
+                return await response.json() if method == "get" else {}
+
+    async def main() -> dict:
+        await influx_stats("/reset", "post")
+        result = await _run_pipeline(path, duration, connect_timeout, drain_timeout)
+        result["influx"] = await influx_stats("/stats")
+        return result
+
+    result = asyncio.run(main())
+    lines = result["influx"]["lines"]
+    result.update(
+        instruments=instruments,
+        target_rate=rate,
+        path=path,
+        duration=duration,
+        frames_per_second=result["frames_acked"] / result["elapsed_seconds"],
+        lines_per_second=lines / result["elapsed_seconds"],
+        cpu_us_per_line=result["cpu_seconds"] / lines * 1e6 if lines else None,
+        peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    )
+    result_queue.put(result)
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _print_result(result: dict) -> None:
+    latency = result["latency_ms"]
+    print(
+        f"{result['instruments']:>6} instruments @ {result['target_rate'] or 'max':>5} msg/s, {result['path']:>7} :: "
+        f"{result['frames_per_second']:8.1f} frames/s :: {result['lines_per_second']:10.0f} lines/s :: "
+        f"{result['cpu_us_per_line'] or 0:6.2f} us CPU/line :: {result['peak_rss_mb']:6.0f} MB peak RSS :: "
+        f"latency p50 {latency['p50'] or 0:7.1f} ms, p99 {latency['p99'] or 0:7.1f} ms"
+        + ("" if result["frames_acked"] == result["frames_produced"]
+           else f" :: {result['frames_produced'] - result['frames_acked']} frames not acked")
+    )
+
+
+def compare(old_path: str, new_path: str) -> None:
+    """Prints the change of every metric between two result files, matching scenarios by instruments, rate and path."""
+    with open(old_path) as f:
+        old = {(r["instruments"], r["target_rate"], r.get("path", "current")): r for r in json.load(f)["scenarios"]}
+    with open(new_path) as f:
+        new = json.load(f)["scenarios"]
+
+    for result in new:
+        base = old.get((result["instruments"], result["target_rate"], result.get("path", "current")))
+        if base is None:
+            continue
+        changes = []
+        for name, value, base_value in (
+            ("lines/s", result["lines_per_second"], base["lines_per_second"]),
+            ("CPU/line", result["cpu_us_per_line"], base["cpu_us_per_line"]),
+            ("peak RSS", result["peak_rss_mb"], base["peak_rss_mb"]),
+            ("p99", result["latency_ms"]["p99"], base["latency_ms"]["p99"]),
+        ):
+            if value is not None and base_value:
+                changes.append(f"{name} {100 * (value / base_value - 1):+.1f}%")
+        print(f"{result['instruments']:>6} instruments @ {result['target_rate'] or 'max':>5} msg/s, "
+              f"{result.get('path', 'current'):>7} :: " + " :: ".join(changes))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--instruments", default="100,1000", help="Comma separated instrument counts.")
+    parser.add_argument("--rates", default="10,50,0", help="Comma separated message rates per second, 0 for unpaced.")
+    parser.add_argument("--paths", default="current", help=f"Comma separated encoding paths, of {', '.join(ENCODING_PATHS)}.")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds frames are received per scenario.")
+    parser.add_argument("--connect-timeout", type=float, default=60, help="Seconds to wait for the first frame of the feed mock.")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="Seconds to wait for the last batches.")
+    parser.add_argument("--influx-port", type=int, default=18086)
+    parser.add_argument("--feed-port", type=int, default=18765)
+    parser.add_argument("--influx-latency-ms", type=float, default=0, help="Artificial latency of the mock write endpoint.")
+    parser.add_argument("--output", help="Result file, defaults to benchmarks/results/ingest-<timestamp>.json.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files and exit.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from mock_influx import start_mock_influx
+
+    influx = start_mock_influx(args.influx_port, args.influx_latency_ms)
+    influx_url = f"http://127.0.0.1:{args.influx_port}"
+    time.sleep(1)
+
+    context = multiprocessing.get_context("spawn")
+    scenarios = []
+    try:
+        for instruments in (int(i) for i in args.instruments.split(",")):
+            for rate in (float(r) for r in args.rates.split(",")):
+                for path in args.paths.split(","):
+                    if path not in ENCODING_PATHS:
+                        parser.error(f"Unknown encoding path '{path}', expected one of {ENCODING_PATHS}")
+                    feed = start_mock_feed(args.feed_port, instruments, rate)
+                    try:
+                        _wait_for_port(args.feed_port, args.connect_timeout)
+                        result_queue = context.Queue()
+                        process = context.Process(
+                            target=run_scenario,
+                            args=(instruments, rate, path, args.duration, influx_url, args.feed_port,
+                                  args.connect_timeout, args.drain_timeout, result_queue),
+                        )
+                        process.start()
+                        try:
+                            # Generous bound for start up, connecting and drain
+                            result = result_queue.get(timeout=args.connect_timeout + args.duration + args.drain_timeout + 300)
+                        except queue.Empty:
+                            print(f"{instruments} instruments @ {rate} msg/s, {path} :: scenario failed (exit code {process.exitcode})")
+                            process.kill()
+                            continue
+                        process.join()
+                    finally:
+                        feed.terminate()
+                        feed.wait()
+                    _print_result(result)
+                    scenarios.append(result)
+    finally:
+        influx.terminate()
+
+    output = args.output or os.path.join(RESULTS_DIR, f"ingest-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "created_at": datetime.now().isoformat(),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "influx_latency_ms": args.influx_latency_ms,
+            "settings": {name: os.environ[name] for name in RECORDED_SETTINGS if name in os.environ},
+            "scenarios": scenarios,
+        }, f, indent=2)
+    print(f"Results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
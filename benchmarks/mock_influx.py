@@ -0,0 +1,56 @@
+"""
+Minimal stand-in of the InfluxDB v2 write endpoint for benchmarks.
+
+Accepts `POST /api/v2/write` (gzipped or not), counts requests, lines and bytes and answers
+204 after an optional artificial latency. `GET /stats` returns the counters, `POST /reset` clears them.
+"""
+import asyncio
+import multiprocessing
+import time
+
+from aiohttp import web
+
+
+def create_app(latency_ms: float = 0.0) -> web.Application:
+    stats = {"requests": 0, "lines": 0, "bytes": 0, "first_at": None, "last_at": None}
+
+    async def write(request: web.Request) -> web.Response:
+        # aiohttp transparently decompresses gzip request bodies
+        body = await request.read()
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000)
+        now = time.time()
+        stats["requests"] += 1
+        stats["lines"] += body.count(b"\n") + (1 if body and not body.endswith(b"\n") else 0)
+        stats["bytes"] += len(body)
+        stats["first_at"] = stats["first_at"] or now
+        stats["last_at"] = now
+        return web.Response(status=204)
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    async def reset(request: web.Request) -> web.Response:
+        stats.update(requests=0, lines=0, bytes=0, first_at=None, last_at=None)
+        return web.Response(status=204)
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({"status": "pass"})
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_post("/api/v2/write", write)
+    app.router.add_get("/stats", get_stats)
+    app.router.add_post("/reset", reset)
+    app.router.add_get("/health", health)
+    return app
+
+
+def serve(port: int, latency_ms: float = 0.0) -> None:
+    web.run_app(create_app(latency_ms), host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def start_mock_influx(port: int, latency_ms: float = 0.0) -> multiprocessing.Process:
+    """Starts the mock in its own process, so its CPU time is not counted against the pipeline."""
+    process = multiprocessing.get_context("spawn").Process(target=serve, args=(port, latency_ms), daemon=True)
+    process.start()
+    return process
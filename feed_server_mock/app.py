@@ -0,0 +1,259 @@
+"""
+Local stand-in for the Upstox v3 market data feed, used for load generation.
+
+Serves the authorize endpoint and a websocket which speaks the v3 protocol: it accepts the `sub`
+request, sends a `market_info` frame and an `initial_feed` snapshot, then `live_feed` frames built
+from `MarketDataFeedV3_pb2` at the configured rate, with optional periodic bursts. Every instrument
+is streamed in the mode it was subscribed in (or changed to with `change_mode`).
+
+Point the app to it with:
+    UPSTOX_AUTHORIZE_URL=http://localhost:8765/v3/feed/market-data-feed/authorize
+    ACCESS_TOKEN=anything
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from aiohttp import WSMsgType, web
+
+# The generated protobuf module is copied next to this file in the image, and lives in src/v3 in the repo
+sys.path[:0] = [os.path.dirname(__file__), os.path.join(os.path.dirname(__file__), "..", "src", "v3")]
+import MarketDataFeedV3_pb2 as pb  # noqa: E402
+
+logger = logging.getLogger("feed_server_mock")
+
+FEED_MOCK_HOST = os.getenv("FEED_MOCK_HOST", "0.0.0.0")
+FEED_MOCK_PORT = int(os.getenv("FEED_MOCK_PORT", 8765))
+# Host name put into the authorized websocket URI handed to clients
+FEED_MOCK_PUBLIC_HOST = os.getenv("FEED_MOCK_PUBLIC_HOST", "localhost")
+# Synthetic instruments added to the subscribed ones, so a handful of subscribed keys can drive a full load
+FEED_MOCK_INSTRUMENTS = int(os.getenv("FEED_MOCK_INSTRUMENTS", 0))
+# Live frames per second and connection
+FEED_MOCK_RATE = float(os.getenv("FEED_MOCK_RATE", 10))
+# Share of the instruments updated in every live frame
+FEED_MOCK_UPDATE_RATIO = float(os.getenv("FEED_MOCK_UPDATE_RATIO", 1.0))
+# Every FEED_MOCK_BURST_EVERY seconds the rate is multiplied by FEED_MOCK_BURST_FACTOR for FEED_MOCK_BURST_SECONDS
+FEED_MOCK_BURST_EVERY = float(os.getenv("FEED_MOCK_BURST_EVERY", 0))
+FEED_MOCK_BURST_SECONDS = float(os.getenv("FEED_MOCK_BURST_SECONDS", 5))
+FEED_MOCK_BURST_FACTOR = float(os.getenv("FEED_MOCK_BURST_FACTOR", 5))
+FEED_MOCK_DEPTH_LEVELS = int(os.getenv("FEED_MOCK_DEPTH_LEVELS", 5))
+# Cycle through this many pre-serialized live frames instead of building every frame, 0 builds every frame
+FEED_MOCK_PREBUILT_FRAMES = int(os.getenv("FEED_MOCK_PREBUILT_FRAMES", 0))
+
+WS_PATH = "/v3/feed/market-data-feed"
+AUTHORIZE_PATH = "/v3/feed/market-data-feed/authorize"
+INTERVALS = (("I1", 60_000), ("I30", 1_800_000), ("1d", 86_400_000))
+# Subscription mode -> request mode of its feeds
+MODES = {"ltpc": pb.ltpc, "full": pb.full_d5, "option_greeks": pb.option_greeks, "full_d30": pb.full_d30}
+DEFAULT_MODE = "full"
+
+
+class Instrument:
+    """Random walk of one instrument with its current candle per interval, streamed in `mode`."""
+
+    def __init__(self, key: str, mode: str = DEFAULT_MODE):
+        self.key = key
+        self.mode = mode
+        self.cp = round(random.uniform(100, 5000), 2)
+        self.ltp = self.cp
+        self.vtt = 0
+        self.candles = {}
+
+    def step(self, now_ms: int) -> None:
+        self.ltp = round(max(0.05, self.ltp * (1 + random.gauss(0, 0.0005))), 2)
+        ltq = random.randint(1, 500)
+        self.vtt += ltq
+        for interval, size in INTERVALS:
+            ts = now_ms - now_ms % size
+            candle = self.candles.get(interval)
+            if candle is None or candle[5] != ts:
+                self.candles[interval] = [self.ltp, self.ltp, self.ltp, self.ltp, ltq, ts]
+            else:
+                candle[1] = max(candle[1], self.ltp)
+                candle[2] = min(candle[2], self.ltp)
+                candle[3] = self.ltp
+                candle[4] += ltq
+        self.ltq = ltq
+        self.ltt = now_ms
+
+    def _fill_ltpc(self, ltpc) -> None:
+        ltpc.ltp = self.ltp
+        ltpc.ltt = self.ltt
+        ltpc.ltq = self.ltq
+        ltpc.cp = self.cp
+
+    def fill(self, feed) -> None:
+        feed.requestMode = MODES[self.mode]
+        if self.mode == "ltpc":
+            self._fill_ltpc(feed.ltpc)
+            return
+        if self.mode == "option_greeks":
+            first_level = feed.firstLevelWithGreeks
+            self._fill_ltpc(first_level.ltpc)
+            quote = first_level.firstDepth
+            quote.bidQ, quote.bidP = random.randint(1, 1000), round(self.ltp - 0.05, 2)
+            quote.askQ, quote.askP = random.randint(1, 1000), round(self.ltp + 0.05, 2)
+            greeks = first_level.optionGreeks
+            greeks.delta = round(random.uniform(-1, 1), 4)
+            greeks.theta = round(random.uniform(-5, 0), 4)
+            greeks.gamma = round(random.uniform(0, 0.01), 6)
+            greeks.vega = round(random.uniform(0, 10), 4)
+            greeks.rho = round(random.uniform(-1, 1), 4)
+            first_level.vtt = self.vtt
+            first_level.oi = random.randint(1, 1_000_000)
+            first_level.iv = round(random.uniform(0.1, 0.5), 4)
+            return
+
+        market_ff = feed.fullFeed.marketFF
+        self._fill_ltpc(market_ff.ltpc)
+        for level in range(30 if self.mode == "full_d30" else FEED_MOCK_DEPTH_LEVELS):
+            quote = market_ff.marketLevel.bidAskQuote.add()
+            quote.bidQ = random.randint(1, 1000)
+            quote.bidP = round(self.ltp - 0.05 * (level + 1), 2)
+            quote.askQ = random.randint(1, 1000)
+            quote.askP = round(self.ltp + 0.05 * (level + 1), 2)
+        for interval, _ in INTERVALS:
+            o, h, low, c, vol, ts = self.candles[interval]
+            ohlc = market_ff.marketOHLC.ohlc.add()
+            ohlc.interval, ohlc.open, ohlc.high, ohlc.low, ohlc.close, ohlc.vol, ohlc.ts = interval, o, h, low, c, vol, ts
+        market_ff.atp = self.cp
+        market_ff.vtt = self.vtt
+        market_ff.tbq = random.randint(1, 100_000)
+        market_ff.tsq = random.randint(1, 100_000)
+
+
+def market_info_frame() -> bytes:
+    response = pb.FeedResponse(type=pb.market_info, currentTs=int(time.time() * 1000))
+    for segment in ("NSE_COM", "NCD_FO", "NSE_FO", "BSE_EQ", "BCD_FO", "BSE_FO", "NSE_EQ",
+                    "MCX_FO", "MCX_INDEX", "NSE_INDEX", "BSE_INDEX"):
+        response.marketInfo.segmentStatus[segment] = pb.NORMAL_OPEN
+    return response.SerializeToString()
+
+
+def feed_frame(instruments, feed_type) -> bytes:
+    now_ms = int(time.time() * 1000)
+    response = pb.FeedResponse(type=feed_type, currentTs=now_ms)
+    for instrument in instruments:
+        instrument.step(now_ms)
+        instrument.fill(response.feeds[instrument.key])
+    return response.SerializeToString()
+
+
+def current_rate(started: float) -> float:
+    if FEED_MOCK_BURST_EVERY and (time.monotonic() - started) % FEED_MOCK_BURST_EVERY < FEED_MOCK_BURST_SECONDS:
+        return FEED_MOCK_RATE * FEED_MOCK_BURST_FACTOR
+    return FEED_MOCK_RATE
+
+
+def updated(instruments: dict) -> list:
+    """Picks the instruments updated in the next live frame."""
+    if FEED_MOCK_UPDATE_RATIO >= 1 or not instruments:
+        return list(instruments.values())
+    return random.sample(list(instruments.values()), max(1, int(len(instruments) * FEED_MOCK_UPDATE_RATIO)))
+
+
+def apply_request(instruments: dict, request: dict, peer) -> None:
+    """Applies a `sub`, `unsub` or `change_mode` request to the streamed instruments."""
+    method = request.get("method")
+    data = request.get("data", {})
+    keys = data.get("instrumentKeys", [])
+    mode = data.get("mode", DEFAULT_MODE)
+    if method in ("sub", "change_mode") and mode not in MODES:
+        logger.warning(f"{peer} :: {method} with unknown mode '{mode}' ignored")
+        return
+    if method == "sub":
+        for key in keys:
+            if key in instruments:
+                instruments[key].mode = mode
+            else:
+                instruments[key] = Instrument(key, mode)
+    elif method == "change_mode":
+        for key in keys:
+            if key in instruments:
+                instruments[key].mode = mode
+    elif method == "unsub":
+        for key in keys:
+            instruments.pop(key, None)
+    logger.info(f"{peer} :: {method} {len(keys)} instruments ({data.get('mode')}) :: streaming {len(instruments)}")
+
+
+async def read_requests(ws: web.WebSocketResponse, instruments: dict, peer) -> None:
+    async for msg in ws:
+        if msg.type in (WSMsgType.BINARY, WSMsgType.TEXT):
+            apply_request(instruments, json.loads(msg.data), peer)
+
+
+async def authorize(request: web.Request) -> web.Response:
+    if not request.headers.get("Authorization", "").startswith("Bearer "):
+        return web.json_response(
+            {"status": "error", "errors": [{"error_code": "UDAPI100050", "message": "Invalid token used to access API"}]},
+            status=401,
+        )
+    uri = f"ws://{FEED_MOCK_PUBLIC_HOST}:{FEED_MOCK_PORT}{WS_PATH}"
+    return web.json_response({"status": "success", "data": {"authorized_redirect_uri": uri}})
+
+
+async def feed(request: web.Request) -> web.WebSocketResponse:
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    peer = request.remote
+
+    msg = await ws.receive()
+    if msg.type not in (WSMsgType.BINARY, WSMsgType.TEXT):
+        await ws.close()
+        return ws
+    instruments = {}
+    apply_request(instruments, json.loads(msg.data), peer)
+    for i in range(FEED_MOCK_INSTRUMENTS):
+        key = f"NSE_EQ|MOCK{i:06d}"
+        instruments[key] = Instrument(key)
+
+    await ws.send_bytes(market_info_frame())
+    await ws.send_bytes(feed_frame(instruments.values(), pb.initial_feed))
+
+    prebuilt = [feed_frame(updated(instruments), pb.live_feed) for _ in range(FEED_MOCK_PREBUILT_FRAMES)]
+    reader = asyncio.create_task(read_requests(ws, instruments, peer))
+
+    started = time.monotonic()
+    next_send = started
+    sent = 0
+    try:
+        while not ws.closed:
+            if prebuilt:
+                frame = prebuilt[sent % len(prebuilt)]
+            else:
+                frame = feed_frame(updated(instruments), pb.live_feed)
+            await ws.send_bytes(frame)
+            sent += 1
+
+            next_send += 1 / current_rate(started)
+            delay = next_send - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                # Behind schedule, send back to back but let other connections run
+                next_send = time.monotonic()
+                await asyncio.sleep(0)
+    except ConnectionResetError:
+        pass
+    finally:
+        reader.cancel()
+        elapsed = time.monotonic() - started
+        logger.info(f"{peer} disconnected after {sent} frames ({sent / max(elapsed, 1e-9):.0f} frames/s)")
+    return ws
+
+
+def create_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get(AUTHORIZE_PATH, authorize)
+    app.router.add_get(WS_PATH, feed)
+    return app
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    web.run_app(create_app(), host=FEED_MOCK_HOST, port=FEED_MOCK_PORT)
@@ -1,2 +1,5 @@
 from .backed_up_data import push_failed_data
-from .db_ingestion import push_data_to_db, push_data_to_db, setup_database
+from .db_ingestion import push_data_to_db, push_data_to_db, setup_database, spill_feed
+from .influx_writer import InfluxWriter, InfluxWriteError, close_influx_writers
+from .sinks import Sink, SinkBatch, SinkFanout, SinkRunner, StreamSink
+from .spill_store import SpillStore, close_spill_stores
@@ -1,72 +1,235 @@
-import aiosqlite
 import asyncio
 from datetime import datetime
 import logging
+import os
+import time
+from typing import Iterator, List, Tuple
+
 from .data_push import push_data_to_influxdb
+from .influx_writer import INFLUX_WRITE_MAX_BYTES, INFLUX_WRITE_MAX_LINES, point_key
 from utils import is_influxdb_online
-from .db_ingestion import INFLUX_BUCKET_NAME, INFLUX_DB_ORG, INFLUX_DB_TOKEN, INFLUX_DB_URL, DB_LOCATION
+from utils.metrics import REGISTRY
+from .db_ingestion import INFLUX_BUCKET_NAME, INFLUX_DB_ORG, INFLUX_DB_TOKEN, INFLUX_DB_URL, DB_LOCATION, MAX_DOCS_LIMIT
+from .spill_store import SpillStore, get_spill_store
 
 WAITING_TIME_THRESHOLD = 10
+REPLAY_PAGE_SIZE = int(os.getenv("REPLAY_PAGE_SIZE", 500))
+REPLAY_TARGET_LINES = int(os.getenv("REPLAY_TARGET_LINES", INFLUX_WRITE_MAX_LINES))
+REPLAY_TARGET_BYTES = int(os.getenv("REPLAY_TARGET_BYTES", INFLUX_WRITE_MAX_BYTES))
+REPLAY_CONCURRENCY = int(os.getenv("REPLAY_CONCURRENCY", 2))
+REPLAY_VACUUM_PAGES = int(os.getenv("REPLAY_VACUUM_PAGES", 1_000))
+
+REPLAYED_ROWS = REGISTRY.counter("replay_rows_total", "Spilled rows written to InfluxDB and deleted.")
+REPLAYED_LINES = REGISTRY.counter("replay_lines_total", "Line protocol lines replayed from the spill store.")
+REPLAY_FAILED_GROUPS = REGISTRY.counter("replay_failed_groups_total", "Merged groups of spilled rows which could not be replayed.")
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-async def vacuum_database(database_path=DB_LOCATION):
-    async with aiosqlite.connect(database_path) as conn:
-        try:
-            await conn.execute("VACUUM")
-            await conn.commit()  # Ensure changes are committed
-            logger.info("Database vacuumed successfully.")
-        except aiosqlite.Error as e:
-            logger.error(f"An error occurred: {e}")
+
+def merge_rows(rows: List[Tuple[int, str]], target_lines: int, target_bytes: int) -> List[Tuple[int, int, str, int]]:
+    """
+    Merges consecutive spilled rows into right-sized write payloads.
+
+    Parameters:
+    - rows (List[Tuple[int, str]]): (id, query) rows ordered by id.
+    - target_lines (int): A payload is closed once it holds at least this many lines.
+    - target_bytes (int): A payload is closed once it holds at least this many bytes.
+
+    Returns:
+    - List[Tuple[int, int, str, int]]: (first_id, last_id, payload, line_count) per payload. Every
+      id between first_id and last_id belongs to the payload.
+    """
+    groups = []
+    queries = []
+    first_id = None
+    lines = 0
+    nbytes = 0
+
+    for doc_id, query in rows:
+        if not query:
+            query_lines = 0
+        else:
+            query_lines = query.count("\n") + 1
+
+        if queries and (lines + query_lines > target_lines or nbytes + len(query) > target_bytes):
+            groups.append((first_id, last_id, "\n".join(queries), lines))
+            queries = []
+            first_id = None
+            lines = 0
+            nbytes = 0
+
+        if first_id is None:
+            first_id = doc_id
+        last_id = doc_id
+        if query:
+            queries.append(query)
+        lines += query_lines
+        nbytes += len(query) + 1
+
+    if first_id is not None:
+        groups.append((first_id, last_id, "\n".join(queries), lines))
+    return groups
+
+
+class BacklogReplayer:
+    """
+    Streams spilled data from the SQLite spill store back into InfluxDB.
+
+    The backlog is read in pages of `page_size` rows using the row id as cursor, so memory use
+    does not depend on the size of the backlog. Small spilled batches of a page are merged into
+    payloads of about `target_lines` / `target_bytes` and pushed in id order, and acknowledged ids
+    are deleted as ranges in one transaction per page. Freed pages are returned to the file system
+    with an incremental vacuum after every pass.
+
+    A point spilled more than once has to end up with its last values, so consecutive payloads are
+    only pushed concurrently (at most `concurrency` at a time) when they write disjoint points, and
+    a pass stops at the first failed payload: the rows after it are retried after it on the next pass.
+
+    Parameters:
+    - store (SpillStore): The spill store holding the backlog.
+    - url, org, bucket, token (str): InfluxDB target.
+    - page_size (int): Number of rows read per page.
+    - target_lines (int): Target number of lines per write.
+    - target_bytes (int): Target payload size in bytes per write.
+    - concurrency (int): Maximum number of concurrent writes of payloads without common points.
+    - vacuum_pages (int): Maximum number of pages freed after every pass, 0 frees all.
+    """
+
+    def __init__(self,
+                 store: SpillStore,
+                 url: str,
+                 org: str,
+                 bucket: str,
+                 token: str,
+                 page_size: int = REPLAY_PAGE_SIZE,
+                 target_lines: int = REPLAY_TARGET_LINES,
+                 target_bytes: int = REPLAY_TARGET_BYTES,
+                 concurrency: int = REPLAY_CONCURRENCY,
+                 vacuum_pages: int = REPLAY_VACUUM_PAGES):
+        self.store = store
+        self.url = url
+        self.org = org
+        self.bucket = bucket
+        self.token = token
+        self.page_size = page_size
+        self.target_lines = target_lines
+        self.target_bytes = target_bytes
+        self.concurrency = concurrency
+        self.vacuum_pages = vacuum_pages
+
+    async def _push_group(self, payload: str) -> None:
+        await push_data_to_influxdb(
+            influx_query=payload,
+            influxdb_url=self.url,
+            org=self.org,
+            bucket_name=self.bucket,
+            token=self.token
+        )
+
+    def _waves(self, groups: list) -> Iterator[list]:
+        """Splits the merged groups of a page into runs of consecutive groups which can be pushed concurrently."""
+        if self.concurrency <= 1:
+            for group in groups:
+                yield [group]
+            return
+
+        wave = []
+        wave_keys = set()
+        for group in groups:
+            keys = {point_key(line) for line in group[2].split("\n")}
+            keys.discard(None)
+            if wave and (len(wave) >= self.concurrency or not wave_keys.isdisjoint(keys)):
+                yield wave
+                wave = []
+                wave_keys = set()
+            wave.append(group)
+            wave_keys |= keys
+        if wave:
+            yield wave
+
+    async def replay(self) -> Tuple[int, int]:
+        """
+        Runs one pass over the backlog.
+
+        Returns:
+        - Tuple[int, int]: Number of rows and lines which were written and deleted.
+        """
+        cursor_id = 0
+        rows_done = 0
+        lines_done = 0
+        started_at = time.monotonic()
+
+        while True:
+            page = await self.store.fetch_page(cursor_id, self.page_size)
+            if not page:
+                break
+            cursor_id = page[-1][0]
+
+            groups = merge_rows(page, self.target_lines, self.target_bytes)
+            acknowledged = []
+            failed = False
+            for wave in self._waves(groups):
+                results = await asyncio.gather(
+                    *(self._push_group(payload) for _, _, payload, _ in wave),
+                    return_exceptions=True
+                )
+                for (first_id, last_id, _, lines), result in zip(wave, results):
+                    if isinstance(result, BaseException):
+                        logger.error(f"Unsuccessful processing for doc_ids {first_id}-{last_id}: {result}")
+                        REPLAY_FAILED_GROUPS.inc()
+                        failed = True
+                        continue
+                    # Groups of one wave share no points, the others can be deleted
+                    acknowledged.append((first_id, last_id))
+                    lines_done += lines
+                    REPLAYED_LINES.inc(lines)
+                if failed:
+                    break
+
+            deleted = await self.store.delete_ranges(acknowledged)
+            REPLAYED_ROWS.inc(deleted)
+            rows_done += deleted
+            if failed:
+                # Later rows may hold newer values of the failed points, leave them for the next pass
+                break
+
+        elapsed = time.monotonic() - started_at
+        if rows_done:
+            logger.info(
+                f"Replayed {rows_done} rows / {lines_done} lines in {elapsed:.2f}s :: "
+                f"{lines_done / max(elapsed, 1e-9):.0f} lines/s :: {self.store.row_count} rows left"
+            )
+            await self.store.reclaim_space(self.vacuum_pages)
+        return rows_done, lines_done
+
 
 async def push_failed_data(success_event: asyncio.Event, url: str = INFLUX_DB_URL, org: str = INFLUX_DB_ORG,
                            bucket: str = INFLUX_BUCKET_NAME, token: str = INFLUX_DB_TOKEN):
     """
     Continuously processes documents from the SQLite database.
-    For each document, applies a function and deletes the document upon successful completion.
+    Spilled documents are streamed page by page, merged into right-sized writes, pushed to InfluxDB
+    and deleted upon successful completion (see `BacklogReplayer`).
     """
     ref_time = datetime.now()
     logger.info(f"Starting document processing at {ref_time}")
 
+    store = await get_spill_store(DB_LOCATION, MAX_DOCS_LIMIT).open()
+    replayer = BacklogReplayer(store=store, url=url, org=org, bucket=bucket, token=token)
+
     while True:
+        if store.row_count == 0:
+            logger.debug("No backed up data to push.")
+
         # Check if InfluxDB is online
-        if await is_influxdb_online(url):
-            logger.info("InfluxDB is online. Proceeding with data fetching and pushing.")
-            
-            async with aiosqlite.connect(DB_LOCATION) as db:
-                logger.info("Attempting asynchronously accessing SQLite DB")
-                async with db.execute('SELECT id, query FROM data') as cursor:
-                    docs = await cursor.fetchall()
-
-                logger.info(f"Starting for loop for queries")
-                for doc_id, query in docs:
-                    try:
-                        logger.info(f"Waiting for data push")
-                        await push_data_to_influxdb(
-                            influx_query=query,
-                            influxdb_url=url,
-                            org=org,
-                            bucket_name=bucket,
-                            token=token
-                        )
-
-                        # Delete
-                        logger.info(f"Deleting data from SQLite for document ID {doc_id}")
-                        await db.execute('DELETE FROM data WHERE id = ?', (doc_id,))
-                        await db.commit()
-
-                        success_event.set() # Set the event flag
-                        logger.info(f"Document {doc_id} successfully processed and deleted.")
-                    except Exception as e:
-                        logger.error(f"Unsuccessful processing for doc_id {doc_id}: {e}")
-                        continue  # Continue with the next document
-                
-                # Release space
-                await vacuum_database()
+        elif await is_influxdb_online(url):
+            logger.info(f"InfluxDB is online. Replaying {store.row_count} backed up documents.")
+            rows_done, _ = await replayer.replay()
+            if rows_done:
+                success_event.set() # Set the event flag
         else:
             logger.warning(f"InfluxDB is offline. Retrying after interval. url : {url}")
-        
+
         # Wait before the next iteration
-        await asyncio.sleep(WAITING_TIME_THRESHOLD)
\ No newline at end of file
+        await asyncio.sleep(WAITING_TIME_THRESHOLD)
@@ -1,14 +1,19 @@
 import pandas as pd
-from typing import List, Dict, Any
-import aiohttp
+from typing import List, Dict, Any, Union
 import os
 
 from v3.data_models.live_feed import LiveFeed
-from src.utils.utils import get_instruments_data
+from v3.decoder import DecodedFeed
+from .line_protocol import LineProtocolEncoder
+from .influx_writer import get_influx_writer
+from utils.instrument_master import InstrumentMaster
 
 REPLACE_INSTRUMENT_KEY_WITH_TRADE_SYMBOL = os.getenv("REPLACE_INSTRUMENT_KEY_WITH_TRADE_SYMBOL", "False").lower() == "true"
-UPSTOX_INSTRUMENTS_DF = get_instruments_data()
-INSTRUMENT_KEY_TO_TRADE_SYMBOL = dict(zip(UPSTOX_INSTRUMENTS_DF['instrument_key'], UPSTOX_INSTRUMENTS_DF['trading_symbol']))
+# Lazily loaded from the on-disk cache on first lookup, see `InstrumentMaster`
+INSTRUMENT_MASTER = InstrumentMaster()
+LINE_PROTOCOL_ENCODER = LineProtocolEncoder(INSTRUMENT_MASTER)
+# Trade symbols may change with a refreshed master, rebuild the cached line prefixes
+INSTRUMENT_MASTER.add_listener(LINE_PROTOCOL_ENCODER.clear_cache)
 
 
 def create_influx_query(df: pd.DataFrame) -> str:
@@ -20,8 +25,9 @@ def create_influx_query(df: pd.DataFrame) -> str:
     ----------------
     Measurement: Derived from the 'interval' column in the DataFrame, representing the 
                  granularity of the stock data (e.g., '1m', '5m', '1h').
-    Tags:        Consists of a single tag:
+    Tags:        Consists of two tags:
                  - 'feed_name': Identifier for the data source or feed.
+                 - 'trade_symbol': Trade symbol of the instrument, falls back to the feed name.
     Fields:      Includes the following numerical stock data points:
                  - 'Open': Opening price of the stock for the interval.
                  - 'High': Highest price of the stock during the interval.
@@ -49,42 +55,70 @@ def create_influx_query(df: pd.DataFrame) -> str:
         queries = create_influx_query(df)
         print(queries)  # Prints the line protocol queries to be ingested into InfluxDB.
     """
-    df["ts"] = (df['ts'].astype('int64')).astype(str)
-
-    queries = []
+    return LINE_PROTOCOL_ENCODER.encode_columns(
+        df["feed_name"].astype(str).tolist(),
+        df["interval"].astype(str).tolist(),
+        pd.to_numeric(df["Open"], errors="coerce").to_numpy(),
+        pd.to_numeric(df["High"], errors="coerce").to_numpy(),
+        pd.to_numeric(df["Low"], errors="coerce").to_numpy(),
+        pd.to_numeric(df["Close"], errors="coerce").to_numpy(),
+        pd.to_numeric(df["Volume"], errors="coerce").to_numpy(),
+        df["ts"].astype("int64").to_numpy(),
+    )
+
+
+def encode_feeds(data_list: List[Union[DecodedFeed, LiveFeed]]) -> str:
+    """
+    Encodes a batch of decoded feeds straight into InfluxDB line protocol.
 
-    # Format feed name
-    df["feed_name"] = df["feed_name"].str.replace(" ", "_")
+    This is the columnar replacement of `create_influx_query(transform_data(data_list))`, the
+    intermediate DataFrame is only built when pydantic `LiveFeed` models are present in the batch.
 
-    for _, row in df.iterrows():
-        measurement = row['interval']
-        tags = f"feed_name={row['feed_name']},trade_symbol={row['trade_symbol']}"
-        
-        fields = ",".join(
-            f"{key}={value}"
-            for key, value in row[['Open', 'High', 'Low', 'Close', 'Volume']].items()
-            if pd.notna(value)
-        )
-        timestamp = row["ts"]
+    Parameters:
+    - data_list (List[DecodedFeed]): Decoded websocket frames.
 
-        query = f"{measurement},{tags} {fields} {timestamp}"
-        queries.append(query)
+    Returns:
+    - str: Newline separated line protocol, same schema as `create_influx_query`.
+    """
+    if all(isinstance(data, DecodedFeed) for data in data_list):
+        return LINE_PROTOCOL_ENCODER.encode_feeds(data_list)
 
-    return "\n".join(queries)
+    df = transform_data(data_list)
+    if df.empty:
+        return ""
+    return create_influx_query(df)
 
 
-def transform_data(data_list: List[LiveFeed]) -> pd.DataFrame:
+def transform_data(data_list: List[Union[DecodedFeed, LiveFeed]]) -> pd.DataFrame:
     """
     Transforms the given data into a pandas DataFrame.
+
+    Accepts the flat `DecodedFeed` records produced by the live path as well as
+    pydantic `LiveFeed` models (validation/debug mode).
     """
     rows = []
 
     for data in data_list:
+        if isinstance(data, DecodedFeed):
+            for candle in data.candles:
+                rows.append({
+                    'feed_name': candle.instrument_key,
+                    'trade_symbol': INSTRUMENT_MASTER.get(candle.instrument_key, candle.instrument_key),
+                    'interval': candle.interval,
+                    'Open': candle.open,
+                    'High': candle.high,
+                    'Low': candle.low,
+                    'Close': candle.close,
+                    'Volume': candle.volume,
+                    'ts': candle.ts
+                })
+            continue
+
         for feed_name, feed_data in data.feeds.items():
             for interval_feed in feed_data.fullFeed.marketFF.marketOHLC.ohlc:
                 row = {
                     'feed_name': feed_name,
-                    'trade_symbol': INSTRUMENT_KEY_TO_TRADE_SYMBOL.get(feed_name, feed_name),
+                    'trade_symbol': INSTRUMENT_MASTER.get(feed_name, feed_name),
                     'interval': interval_feed.interval,
                     'Open': interval_feed.open,
                     'High': interval_feed.high,
@@ -104,40 +138,27 @@ async def push_data_to_influxdb(influx_query: str,
                                 bucket_name: str,
                                 token: str) -> None:
     """
-    Asynchronously pushes data to InfluxDB using aiohttp, based on a pre-defined query.
+    Asynchronously pushes data to InfluxDB, based on a pre-defined query.
+
+    The write goes through the shared `InfluxWriter` of the target, which keeps its connections
+    alive between calls, gzips the payload and splits large queries into concurrent chunks.
 
     Parameters:
-    - data (List[Dict[str, Any]]): Data to be pushed to InfluxDB, structured according to the schema expected by the query function.
+    - influx_query (str): Line protocol to be pushed to InfluxDB.
     - influxdb_url (str): URL of the InfluxDB server.
     - org (str): Organization name for InfluxDB.
     - bucket_name (str): The name of the InfluxDB bucket where the data will be written.
     - token (str): Authentication token for InfluxDB.
 
     Raises:
-    - aiohttp.ClientError: If the HTTP request fails.
+    - InfluxWriteError: If the write failed after all retries. `failed_payloads` holds the part
+      of the query which was not written.
     """
-
-    # Prepare the headers for the request
-    headers = {
-        "Authorization": f"Token {token}",
-        "Content-Type": "text/plain",
-    }
-
-    # Construct the URL for the write API
-    write_url = f"{influxdb_url}/api/v2/write?org={org}&bucket={bucket_name}&precision=ms"
-
-    # Perform the asynchronous POST request to InfluxDB
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(write_url, headers=headers, data=influx_query) as response:
-                response.raise_for_status()
-                print("Data pushed to influxDB successfully.")
-    except Exception as e:
-        # txt = await response.text()
-        print(f"Failed to push data :: Error occured : {e}")
-        raise e
+    writer = get_influx_writer(url=influxdb_url, org=org, bucket=bucket_name, token=token)
+    # Success and failure are counted by the writer (see `utils.metrics`), callers log failures
+    await writer.write(influx_query)
 
     return None
 
 if __name__=="__main__":
-    pass
\ No newline at end of file
+    pass
@@ -1,16 +1,27 @@
 import asyncio
-import pandas as pd
-from datetime import datetime, timedelta
-import aiosqlite
 import os
+import time
+from typing import Dict, Tuple
 
 # Importing from v3
 # from . import data_push  # InfluxDB utility
 from .data_push import (
-    create_influx_query, 
-    push_data_to_influxdb, 
-    transform_data
+    INSTRUMENT_MASTER,
+    LINE_PROTOCOL_ENCODER,
+    push_data_to_influxdb
 )
+from .influx_writer import InfluxWriteError
+from .sinks import SinkBatch, SinkFanout
+from .spill_store import get_spill_store
+from pipeline.batcher import BATCH_MAX_AGE_MS, BATCH_MAX_BYTES, BATCH_MAX_ITEMS, Batcher, LatencyTracker
+from pipeline.aggregator import BarAggregator
+from pipeline.candle_filter import CandleChangeFilter
+from pipeline.coalescing_buffer import CoalescingBuffer
+from pipeline.quote_snapshot import get_quote_snapshot
+from pipeline.tick_filter import CAPTURE_DEPTH, CAPTURE_TICKS, TickThrottle
+from v3.backfill import BACKFILL_SOURCE, BackfillFeed, get_persisted_bars
+from v3.subscriptions import get_watchlist
+from utils.metrics import BYTES_BUCKETS, COUNT_BUCKETS, REGISTRY
 
 import logging
 
@@ -23,7 +34,13 @@ INFLUX_DB_URL = os.getenv("INFLUX_DB_URL", None)
 INFLUX_DB_TOKEN = os.getenv("INFLUX_DB_TOKEN", None)
 DB_LOCATION = os.path.join("sqlite_db", "failed_to_push_data.sqlite")
 MAX_DOCS_LIMIT = 100_000_000
-LAST_PUSH_TIME_THRESHOLD = timedelta(seconds=30)
+
+QUEUE_DEPTH = REGISTRY.gauge("ingest_queue_depth", "Decoded frames waiting in the ingest queue.")
+BATCH_ITEMS = REGISTRY.histogram("ingest_batch_items", "Frames per flushed batch.", buckets=COUNT_BUCKETS)
+BATCH_LINES = REGISTRY.histogram("ingest_batch_lines", "Line protocol lines per flushed batch.", buckets=COUNT_BUCKETS)
+BATCH_BYTES = REGISTRY.histogram("ingest_batch_bytes", "Line protocol bytes per flushed batch.", buckets=BYTES_BUCKETS)
+FLUSH_ERRORS = REGISTRY.counter("ingest_flush_errors_total", "Batches which could not be written completely and were spilled.")
+FRESHNESS_SECONDS = REGISTRY.histogram("ingest_receive_to_write_seconds", "Time from receiving a frame to InfluxDB acknowledging its batch.")
 
 if (INFLUX_BUCKET_NAME is None) or (INFLUX_DB_ORG is None) or (INFLUX_DB_URL is None) or (INFLUX_DB_TOKEN is None):
     print(f"bucket : {INFLUX_BUCKET_NAME} :: org : {INFLUX_DB_ORG} :: URL : {INFLUX_DB_URL} :: token : {INFLUX_DB_TOKEN}")
@@ -31,7 +48,8 @@ if (INFLUX_BUCKET_NAME is None) or (INFLUX_DB_ORG is None) or (INFLUX_DB_URL is
 
 async def setup_database(db_path: str = DB_LOCATION):
     """
-    Sets up the SQLite database by ensuring the required table exists.
+    Sets up the SQLite database by opening the shared spill store, which ensures the required
+    table exists and switches the database to WAL journaling.
     
     Parameters:
     - db_path: str: The path to the SQLite database file.
@@ -39,21 +57,17 @@ async def setup_database(db_path: str = DB_LOCATION):
     Returns:
     - None
     """
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                query TEXT
-            )
-        ''')
-        await db.commit()
-        logger.info(f"Database setup complete. Table 'data' is ready for use.")
+    await get_spill_store(db_path, MAX_DOCS_LIMIT).open()
+    logger.info(f"Database setup complete. Table 'data' is ready for use.")
 
 
 async def save_to_db(data: str, db_path: str = DB_LOCATION, max_docs_limit: int = MAX_DOCS_LIMIT) -> None:
     """
     Asynchronously saves data to a SQLite database, respecting a maximum documents limit.
     If the database already contains the maximum number of documents, it logs an error and discards the new data.
+
+    The data is appended to the shared spill store of `db_path`, which keeps its connection open and
+    group commits appended rows, so saving costs about as much as appending to a list.
     
     Parameters:
     - data: str: A string containing the query data.
@@ -63,29 +77,61 @@ async def save_to_db(data: str, db_path: str = DB_LOCATION, max_docs_limit: int
     Returns:
     - None
     """
-    async with aiosqlite.connect(db_path) as db:
+    store = get_spill_store(db_path, max_docs_limit)
+    if await store.append(data):
+        logger.debug(f"Successfully saved data to {db_path}. Current row count: {store.row_count + store.pending_rows}.")
+    return None
 
-        async with db.execute('SELECT COUNT(*) FROM data') as cursor:
-            (existing_docs_count,) = await cursor.fetchone()
 
-        if existing_docs_count >= max_docs_limit:
-            logger.error(f"Error: Maximum row limit of {max_docs_limit} reached. Discarding data.")
-            return None
+async def spill_feed(feed, db_path: str = DB_LOCATION) -> None:
+    """
+    Saves the candles of a decoded frame to the spill store instead of queueing them, used by the
+    'spill' overflow policy of the ingest queue (see `BackpressureQueue`). They are written to InfluxDB
+    by `push_failed_data` later on.
 
-        await db.execute('INSERT INTO data (query) VALUES (?)', (data,))
-        await db.commit()
+    Only completed candles are spilled, i.e. those older than the newest candle of the same instrument
+    and interval in the frame (frames carry the final values of the previous minute next to the current
+    one). The open candles are dropped: the replay runs after newer values were written live and would
+    overwrite them, and the following frames repeat them anyway. What is lost are the intermediate
+    values of open candles and the bars which never appear completed in a later frame, e.g. the open
+    daily bar if nothing after the overflow is written.
 
-        logger.debug(f"Successfully saved data to {db_path}. Current row count: {existing_docs_count + 1}.")
-        return None
+    Spilled frames skip the candle filter and the aggregation, and their ticks are not captured. The
+    quote snapshot was updated when they were decoded.
+
+    Parameters:
+    - feed (DecodedFeed): The frame which did not fit into the queue.
+    - db_path (str): The path to the SQLite database file.
+
+    Returns:
+    - None
+    """
+    if isinstance(feed, BackfillFeed):
+        # Backfilled bars are completed
+        completed = feed.candles
+    else:
+        newest: Dict[Tuple[str, str], int] = {}
+        for candle in feed.candles:
+            key = (candle.instrument_key, candle.interval)
+            if candle.ts > newest.get(key, -1):
+                newest[key] = candle.ts
+        completed = [candle for candle in feed.candles if candle.ts < newest[(candle.instrument_key, candle.interval)]]
+    query = LINE_PROTOCOL_ENCODER.encode_candles(completed)
+    if query:
+        await save_to_db(query, db_path)
 
 async def push_data_to_db(
         data_queue: asyncio.Queue, 
         success_event: asyncio.Event, 
-        threshold: int=10, 
+        threshold: int=BATCH_MAX_ITEMS, 
         url: str=INFLUX_DB_URL, 
         org: str=INFLUX_DB_ORG, 
         bucket: str=INFLUX_BUCKET_NAME, 
-        token: str=INFLUX_DB_TOKEN
+        token: str=INFLUX_DB_TOKEN,
+        max_bytes: int=BATCH_MAX_BYTES,
+        max_age_ms: int=BATCH_MAX_AGE_MS,
+        latency_tracker: LatencyTracker=None,
+        fanout: SinkFanout=None
 ) -> None:
     """
     Processes data from the queue and attempts to push it to InfluxDB. If pushing to InfluxDB fails, 
@@ -101,8 +147,8 @@ async def push_data_to_db(
         This can be used to signal other coroutines that the operation was successful.
 
     threshold : int, optional
-        The minimum number of items in the queue required to trigger a push to InfluxDB. 
-        Default is 10.
+        The maximum number of queued items flushed together in one batch. 
+        Default is set to the global `BATCH_MAX_ITEMS`.
 
     url : str, optional
         The URL of the InfluxDB instance. Default is set to the global `INFLUX_DB_URL`.
@@ -116,6 +162,21 @@ async def push_data_to_db(
     token : str, optional
         The token for authenticating with InfluxDB. Default is set to the global `INFLUX_DB_TOKEN`.
 
+    max_bytes : int, optional
+        The maximum estimated line protocol size of a batch. Default is set to the global `BATCH_MAX_BYTES`.
+
+    max_age_ms : int, optional
+        The maximum time in milliseconds an item may wait for its batch to be flushed, counted from the
+        moment it was received from the websocket. Default is set to the global `BATCH_MAX_AGE_MS`.
+
+    latency_tracker : LatencyTracker, optional
+        Records the receive-to-write latency of every item. Default is a tracker which periodically 
+        logs the percentiles.
+
+    fanout : SinkFanout, optional
+        Further sinks every flushed batch is handed to, each behind its own queue. Default is built 
+        from the global `SINKS`.
+
     Returns:
     --------
     None
@@ -124,59 +185,187 @@ async def push_data_to_db(
     
     Behavior:
     ---------
-    The function continuously monitors the `data_queue` in an infinite loop. 
-    It checks whether the queue size exceeds the specified `threshold` or if a certain amount of time has 
-    passed since the last data push. If either condition is met, it processes the data and attempts to 
-    push it to InfluxDB. If the push operation fails, the data is saved locally for future processing. 
+    The function wakes up as soon as data arrives in the `data_queue` and collects a batch until
+    either `threshold` items, `max_bytes` or `max_age_ms` is reached, whichever comes first (see
+    `Batcher`). Finished batches are written in background tasks, so the queue keeps being drained
+    while a write is in flight. Before encoding, every batch passes these stages:
+    - Unchanged candles are dropped (see `CandleChangeFilter`).
+    - Bars of the `AGGREGATE_INTERVALS` are built from every frame as it leaves the queue and are
+      published in the quote snapshot (see `BarAggregator` and `QuoteSnapshotWriter`).
+    - Bars backfilled after a reconnect skip the change filter (see `BackfillFeed`), and the last
+      acknowledged `I1` bars mark where the next gap starts (see `PersistedBars`).
+    - With `CAPTURE_TICKS` and `CAPTURE_DEPTH`, throttled ticks and depth snapshots are written in the
+      same request (see `TickThrottle`).
+    - The candles and ticks are queued for the `SINKS` without waiting for them (see `SinkRunner`).
+    The state of instruments removed from the watchlist is dropped from all of these. If the push
+    operation fails, the data is saved locally for future processing. When cancelled, everything
+    still in flight, queued or held back by the stages is written before returning.
     The function also sets the `success_event` to signal successful data push operations.
 
     Logging:
     --------
-    The function logs various debug and error messages, including the conditions for pushing data, 
-    success or failure of the push operation, and other operational details.
+    The function logs various debug and error messages, including success or failure of the push 
+    operation, and periodically reports the receive-to-write latency percentiles (see `FRESHNESS_P99_TARGET_MS`).
     """
-    logger.debug(f"Performing data push to DB.")
-    time_ref = datetime.now()
+    # Drops candles which were already written, see `CANDLE_EMIT_MODE`
+    candle_filter = CandleChangeFilter()
+    # Builds the custom bar intervals, see `AGGREGATE_INTERVALS`
+    aggregator = BarAggregator()
+    # Latest quotes for local readers, updated by the decode stage, see `QUOTE_SNAPSHOT_NAME`
+    snapshot = get_quote_snapshot()
+    if snapshot is not None:
+        snapshot.open()
+    # Further sinks next to InfluxDB, see `SINKS`
+    fanout = await (fanout if fanout is not None else SinkFanout.from_names()).start()
+    # Throttles the captured ticks and depth snapshots, see `CAPTURE_TICKS`
+    tick_throttle = TickThrottle() if CAPTURE_TICKS or CAPTURE_DEPTH or fanout else None
+    # Last written I1 bars, where the gaps detected after a reconnect start, see `BACKFILL_SOURCE`
+    persisted_bars = get_persisted_bars() if BACKFILL_SOURCE else None
+
+    # Candles and ticks of unsubscribed instruments which the change filter and the tick throttle held
+    # back, written with the next batch
+    held = []
+    held_ticks = []
+
+    def discard(instrument_keys) -> None:
+        # Unsubscribed instruments leave every cache, see `Watchlist`
+        held.extend(candle_filter.discard(instrument_keys))
+        aggregator.discard(instrument_keys)
+        if snapshot is not None:
+            snapshot.discard(instrument_keys)
+        if tick_throttle is not None:
+            held_ticks.extend(tick_throttle.discard(instrument_keys))
+        if persisted_bars is not None:
+            persisted_bars.discard(instrument_keys)
+
+    get_watchlist().add_listener(discard)
+
+    def on_item(feed) -> None:
+        # Runs in arrival order as soon as the frame leaves the queue, the aggregated bars are
+        # appended to the frame's own candles
+        if isinstance(feed, BackfillFeed):
+            if aggregator:
+                feed.candles.extend(aggregator.backfill(feed.instrument_key, feed.candles, feed.start_ts, feed.end_ts))
+            return
+        if aggregator:
+            bars = aggregator.update(feed.candles, feed.ticks)
+            feed.candles.extend(bars)
+            if snapshot is not None:
+                snapshot.update_bars(bars, feed.received_at)
+
+    async def flush(data_to_process: list, final: bool = False) -> bool:
+        live = [feed for feed in data_to_process if not isinstance(feed, BackfillFeed)]
+        if len(live) == len(data_to_process):
+            candles = candle_filter.filter(candle for feed in live for candle in feed.candles)
+        else:
+            # Backfilled bars are final and skip the change filter, which only tracks the live values,
+            # the arrival order is kept so the newest values of an aggregated bar are written last
+            candles, run = [], []
+            for feed in data_to_process:
+                if isinstance(feed, BackfillFeed):
+                    candles.extend(candle_filter.filter(run))
+                    candles.extend(feed.candles)
+                    run = []
+                else:
+                    run.extend(feed.candles)
+            candles.extend(candle_filter.filter(run))
+        if held:
+            candles[:0] = held
+            held.clear()
+        if final:
+            # Nothing follows, the candles still held back are written with their latest values
+            candles.extend(candle_filter.pending())
+        query = LINE_PROTOCOL_ENCODER.encode_candles(candles)
+        ticks = tick_throttle.filter(live) if tick_throttle is not None else []
+        if held_ticks:
+            ticks[:0] = held_ticks
+            held_ticks.clear()
+        if final and tick_throttle is not None:
+            ticks.extend(tick_throttle.pending())
+        if fanout:
+            received_at = min((feed.received_at for feed in data_to_process), default=time.time())
+            await fanout.submit(SinkBatch(candles, ticks, received_at))
+        if CAPTURE_TICKS or CAPTURE_DEPTH:
+            parts = [query]
+            if CAPTURE_TICKS:
+                parts.append(LINE_PROTOCOL_ENCODER.encode_ticks(ticks))
+            if CAPTURE_DEPTH:
+                parts.append(LINE_PROTOCOL_ENCODER.encode_depth(ticks))
+            query = "\n".join(part for part in parts if part)
+        if data_to_process:
+            BATCH_ITEMS.observe(len(data_to_process))
+        if not query:
+            return True
+        BATCH_LINES.observe(query.count("\n") + 1)
+        BATCH_BYTES.observe(len(query))
+
+        try:
+            await push_data_to_influxdb(
+                influx_query=query,
+                influxdb_url=url,
+                org=org,
+                bucket_name=bucket,
+                token=token
+            )
+            logger.debug("Data successfully pushed to DB.")
+            if persisted_bars is not None:
+                persisted_bars.update(candles)
+
+            success_event.set() # Set the event flag
+            return True
+        except InfluxWriteError as e:
+            FLUSH_ERRORS.inc()
+            logger.error(f"Failed to push data to InfluxDB: {e}. Saving {len(e.failed_payloads)} chunk(s) to DB.")
+            for payload in e.failed_payloads:
+                await save_to_db(payload)
+            return False
+        except Exception as e:
+            FLUSH_ERRORS.inc()
+            logger.error(f"Failed to push data to InfluxDB: {e}. Saving to DB.")
+            await save_to_db(query)
+            return False
+
+    batcher = Batcher(
+        queue=data_queue,
+        flush=flush,
+        max_items=threshold,
+        max_bytes=max_bytes,
+        max_age_ms=max_age_ms,
+        latency_tracker=latency_tracker or LatencyTracker("Websocket receive to InfluxDB write", histogram=FRESHNESS_SECONDS),
+        on_item=on_item if aggregator else None,
+    )
+
+    QUEUE_DEPTH.set_function(data_queue.qsize)
+
+    # Map the instrument master before the first flush, it is only downloaded when there is no cache yet
+    await asyncio.get_running_loop().run_in_executor(None, INSTRUMENT_MASTER.load)
 
     logger.info("Starting loop to push data")
-    while True:  # Infinite loop to keep the coroutine alive
-        mask1 = data_queue.qsize() > threshold  # data queue size is big enough
-        mask2 = not data_queue.empty()  # data queue is not empty
-        mask3 = datetime.now() - time_ref > LAST_PUSH_TIME_THRESHOLD  # Enough time passed since last push
-        
-        logger.debug(f"Calculated masks for data push :: mask1 : {mask1} :: mask2 : {mask2} :: mask3 : {mask3}")
-
-        # Process if either enough time is passed or queue size is big enough
-        if mask1 | ((mask2) & (mask3)):
-            time_ref = datetime.now()
-            logger.debug(f"Time reference changed : {time_ref}")
-            
-            # Gather data to process list from queue
-            data_to_process = []
-            
-            while not data_queue.empty():
-                data_to_process.append(await data_queue.get())
-            logger.debug("Data to process list gathered")
-
-            df = transform_data(data_to_process)  # Assuming data_to_process format
-
-            query = create_influx_query(df)
-
-            # Mock send data logic
-            try:
-                await push_data_to_influxdb(
-                    influx_query=query,
-                    influxdb_url=url,
-                    org=org,
-                    bucket_name=bucket,
-                    token=token
-                )
-                logger.debug("Data successfully pushed to DB.")
-
-                success_event.set() # Set the event flag
-            except Exception as e:
-                logger.error(f"Failed to push data to InfluxDB: {e}. Saving to DB.")
-                await save_to_db(query)
+    try:
+        await batcher.run()
+    finally:
+        # Writes the batches in flight, what is still queued and the candles and ticks held back by the
+        # change filter and the tick throttle, best effort
+        await batcher.wait_flushes()
+        # The open batch went through `on_item` already, the queued frames did not
+        open_batch = batcher.take_open_batch()
+        remaining = []
+        if isinstance(data_queue, CoalescingBuffer):
+            # Its snapshot is only handed out by `get_nowait` once due
+            remaining = data_queue.drain()
         else:
-            logger.debug("Sleeping for 1 second")
-            await asyncio.sleep(1)  # Sleep for a bit if below threshold
\ No newline at end of file
+            while True:
+                try:
+                    remaining.append(data_queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+        if batcher.on_item is not None:
+            for feed in remaining:
+                batcher.on_item(feed)
+        remaining[:0] = open_batch
+        await flush(remaining, final=True)
+        if persisted_bars is not None:
+            persisted_bars.save()
+        await fanout.close()
+        if snapshot is not None:
+            snapshot.close()
@@ -0,0 +1,302 @@
+import asyncio
+import gzip
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+INFLUX_WRITE_MAX_LINES = int(os.getenv("INFLUX_WRITE_MAX_LINES", 5_000))
+INFLUX_WRITE_MAX_BYTES = int(os.getenv("INFLUX_WRITE_MAX_BYTES", 1_000_000))
+INFLUX_WRITE_MAX_IN_FLIGHT = int(os.getenv("INFLUX_WRITE_MAX_IN_FLIGHT", 4))
+INFLUX_WRITE_TIMEOUT = float(os.getenv("INFLUX_WRITE_TIMEOUT", 10))
+INFLUX_WRITE_RETRIES = int(os.getenv("INFLUX_WRITE_RETRIES", 2))
+INFLUX_WRITE_RETRY_BACKOFF = float(os.getenv("INFLUX_WRITE_RETRY_BACKOFF", 0.5))
+INFLUX_WRITE_GZIP = os.getenv("INFLUX_WRITE_GZIP", "True").lower() == "true"
+
+# Status codes worth retrying, everything else in the 4xx range means the payload itself is rejected
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# Payloads above this size are compressed in the default executor to keep the event loop free
+GZIP_IN_EXECUTOR_THRESHOLD = 64 * 1024
+GZIP_LEVEL = 1
+
+WRITE_SECONDS = REGISTRY.histogram("influx_write_seconds", "Duration of successful InfluxDB write requests, retries excluded.")
+WRITTEN_LINES = REGISTRY.counter("influx_written_lines_total", "Line protocol lines acknowledged by InfluxDB.")
+WRITTEN_BYTES = REGISTRY.counter("influx_written_bytes_total", "Uncompressed line protocol bytes acknowledged by InfluxDB.")
+WRITE_ERRORS = REGISTRY.counter("influx_write_errors_total", "Failed InfluxDB write attempts by HTTP status or exception.", ("reason",))
+WRITE_RETRIES = REGISTRY.counter("influx_write_retries_total", "Retried InfluxDB write attempts.")
+
+
+class InfluxWriteError(Exception):
+    """
+    Raised when one or more chunks of a write could not be pushed to InfluxDB.
+
+    Attributes:
+    - failed_payloads (List[str]): The line protocol chunks which were not written, so that
+      callers can spill only those instead of the whole batch.
+    - status (int, optional): HTTP status of the last failed attempt, if a response was received.
+    """
+
+    def __init__(self, message: str, failed_payloads: Optional[List[str]] = None, status: Optional[int] = None):
+        super().__init__(message)
+        self.failed_payloads = failed_payloads or []
+        self.status = status
+
+
+def split_lines(lines: str, max_lines: int, max_bytes: int) -> List[str]:
+    """
+    Splits newline separated line protocol into chunks bounded by line count and byte size.
+
+    A single line larger than `max_bytes` is emitted as its own chunk.
+    """
+    if not lines:
+        return []
+
+    if len(lines) <= max_bytes and lines.count("\n") < max_lines:
+        return [lines]
+
+    chunks = []
+    current = []
+    current_bytes = 0
+    for line in lines.split("\n"):
+        # +1 for the newline separator
+        line_bytes = len(line) + 1
+        if current and (len(current) >= max_lines or current_bytes + line_bytes > max_bytes):
+            chunks.append("\n".join(current))
+            current = []
+            current_bytes = 0
+        current.append(line)
+        current_bytes += line_bytes
+
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def point_key(line: str) -> Optional[Tuple[str, str]]:
+    """
+    Returns the (measurement and tag set, timestamp) of a line protocol line, which identify the
+    point it writes, or None for lines without a timestamp (written at the server time).
+    """
+    end = line.find(" ")
+    # Spaces escaped in the measurement or a tag do not end the series
+    while end > 0 and line[end - 1] == "\\":
+        end = line.find(" ", end + 1)
+    if end < 0:
+        return None
+    ts = line[line.rfind(" ") + 1:]
+    if not ts.isdigit() or line.rfind(" ") == end:
+        return None
+    return line[:end], ts
+
+
+def dedupe_points(lines: str) -> str:
+    """
+    Keeps only the last line of every point (see `point_key`) of newline separated line protocol,
+    so its chunks can be written in any order. Lines without a timestamp are all kept.
+    """
+    latest = {}
+    for i, line in enumerate(lines.split("\n")):
+        if line:
+            key = point_key(line)
+            latest[i if key is None else key] = line
+    return "\n".join(latest.values())
+
+
+class InfluxWriter:
+    """
+    Long-lived InfluxDB v2 write client.
+
+    A single `aiohttp.ClientSession` with keep-alive connections is reused for every write.
+    Payloads are gzip compressed, large writes are chunked by line count and byte size, and the
+    number of concurrent in-flight requests is bounded across all callers sharing the writer.
+
+    Parameters:
+    - url (str): URL of the InfluxDB server.
+    - org (str): Organization name for InfluxDB.
+    - bucket (str): The name of the InfluxDB bucket where the data will be written.
+    - token (str): Authentication token for InfluxDB.
+    - precision (str): Timestamp precision of the written lines. Default is 'ms'.
+    - max_lines (int): Maximum number of lines per request.
+    - max_bytes (int): Maximum uncompressed size of a request body in bytes.
+    - max_in_flight (int): Maximum number of concurrent write requests.
+    - timeout (float): Total timeout of a single request in seconds.
+    - retries (int): Number of retries of a chunk after the first failed attempt.
+    - retry_backoff (float): Base delay in seconds between retries, doubled on every retry.
+    - compress (bool): Whether to gzip request bodies.
+    """
+
+    def __init__(self,
+                 url: str,
+                 org: str,
+                 bucket: str,
+                 token: str,
+                 precision: str = "ms",
+                 max_lines: int = INFLUX_WRITE_MAX_LINES,
+                 max_bytes: int = INFLUX_WRITE_MAX_BYTES,
+                 max_in_flight: int = INFLUX_WRITE_MAX_IN_FLIGHT,
+                 timeout: float = INFLUX_WRITE_TIMEOUT,
+                 retries: int = INFLUX_WRITE_RETRIES,
+                 retry_backoff: float = INFLUX_WRITE_RETRY_BACKOFF,
+                 compress: bool = INFLUX_WRITE_GZIP):
+        self.write_url = f"{url}/api/v2/write"
+        self.params = {"org": org, "bucket": bucket, "precision": precision}
+        self.headers = {
+            "Authorization": f"Token {token}",
+            "Content-Type": "text/plain; charset=utf-8",
+        }
+        if compress:
+            self.headers["Content-Encoding"] = "gzip"
+
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.max_in_flight = max_in_flight
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.compress = compress
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Created lazily so that the writer can be instantiated outside of a running loop
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self) -> "InfluxWriter":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_in_flight, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._session
+
+    async def close(self) -> None:
+        """Closes the underlying session and its pooled connections."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _encode_body(self, chunk: str) -> bytes:
+        body = chunk.encode("utf-8")
+        if not self.compress:
+            return body
+        if len(body) >= GZIP_IN_EXECUTOR_THRESHOLD:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, gzip.compress, body, GZIP_LEVEL)
+        return gzip.compress(body, GZIP_LEVEL)
+
+    async def _post(self, chunk: str) -> None:
+        """Posts a single chunk, retrying transient failures with exponential backoff."""
+        session = self._get_session()
+        body = await self._encode_body(chunk)
+
+        attempt = 0
+        while True:
+            status = None
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    started = time.perf_counter()
+                    async with session.post(self.write_url, params=self.params, headers=self.headers, data=body) as response:
+                        status = response.status
+                        if status < 300:
+                            WRITE_SECONDS.observe(time.perf_counter() - started)
+                            WRITTEN_LINES.inc(chunk.count("\n") + 1)
+                            WRITTEN_BYTES.inc(len(chunk))
+                            return None
+                        message = await response.text()
+                        retry_after = response.headers.get("Retry-After")
+                WRITE_ERRORS.labels(status).inc()
+                error = f"InfluxDB responded with status {status} : {message}"
+                if status not in RETRYABLE_STATUS_CODES:
+                    raise InfluxWriteError(error, failed_payloads=[chunk], status=status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                WRITE_ERRORS.labels(type(e).__name__).inc()
+                error = f"{type(e).__name__} : {e}"
+
+            if attempt >= self.retries:
+                raise InfluxWriteError(f"Write failed after {attempt + 1} attempts :: {error}", failed_payloads=[chunk], status=status)
+
+            delay = self.retry_backoff * (2 ** attempt)
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            attempt += 1
+            WRITE_RETRIES.inc()
+            logger.warning(f"InfluxDB write failed :: {error} :: retry {attempt}/{self.retries} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    async def write(self, lines: str) -> int:
+        """
+        Writes newline separated line protocol to InfluxDB.
+
+        The payload is split into chunks which are sent concurrently, bounded by `max_in_flight`.
+        Chunks may land in any order, so a payload spanning several chunks only keeps the last line
+        of every point (see `dedupe_points`) and the newest values of a point are written whichever
+        chunk lands last.
+
+        Parameters:
+        - lines (str): Line protocol to write.
+
+        Returns:
+        - int: Number of chunks written.
+
+        Raises:
+        - InfluxWriteError: If any chunk could not be written after all retries. The exception
+          carries the chunks that failed; all other chunks were written successfully.
+        """
+        chunks = split_lines(lines, self.max_lines, self.max_bytes)
+        if not chunks:
+            return 0
+        if len(chunks) == 1:
+            # Lines of one request are applied in order
+            await self._post(chunks[0])
+            return 1
+
+        chunks = split_lines(dedupe_points(lines), self.max_lines, self.max_bytes)
+        results = await asyncio.gather(*(self._post(chunk) for chunk in chunks), return_exceptions=True)
+
+        failed_payloads = []
+        errors = []
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, InfluxWriteError):
+                failed_payloads.extend(result.failed_payloads)
+                errors.append(result)
+            elif isinstance(result, BaseException):
+                failed_payloads.append(chunk)
+                errors.append(result)
+
+        if errors:
+            raise InfluxWriteError(
+                f"{len(errors)}/{len(chunks)} chunks failed :: {errors[0]}",
+                failed_payloads=failed_payloads,
+                status=getattr(errors[0], "status", None),
+            )
+        return len(chunks)
+
+
+_WRITERS: Dict[Tuple[str, str, str, str], InfluxWriter] = {}
+
+
+def get_influx_writer(url: str, org: str, bucket: str, token: str) -> InfluxWriter:
+    """Returns the shared writer of the given InfluxDB target, creating it on first use."""
+    key = (url, org, bucket, token)
+    writer = _WRITERS.get(key)
+    if writer is None:
+        writer = InfluxWriter(url=url, org=org, bucket=bucket, token=token)
+        _WRITERS[key] = writer
+    return writer
+
+
+async def close_influx_writers() -> None:
+    """Closes all shared writers, to be called on shutdown."""
+    for writer in list(_WRITERS.values()):
+        await writer.close()
+    _WRITERS.clear()
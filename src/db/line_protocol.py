@@ -0,0 +1,224 @@
+from operator import itemgetter
+from typing import Callable, Dict, Iterable, Mapping, Optional, Sequence, Tuple, Union
+
+from v3.decoder import CandleRow, DecodedFeed, TickRow
+
+# Fields written for every candle, in order. `Volume` is written without the integer suffix
+# to stay compatible with the float field type of the existing series.
+CANDLE_LINE_TEMPLATE = "{}Open={},High={},Low={},Close={},Volume={} {}"
+
+# Tick fields written for every tick, followed by the optional fields the tick carries
+TICK_LINE_TEMPLATE = "{}LTP={},LTT={}i,LTQ={}i,CP={}{} {}"
+# (field, TickRow attribute, suffix) of the market level and greek fields, omitted when None
+OPTIONAL_TICK_FIELDS = (
+    ("ATP", "atp", ""), ("VTT", "vtt", "i"), ("OI", "oi", ""), ("IV", "iv", ""), ("TBQ", "tbq", ""),
+    ("TSQ", "tsq", ""), ("Delta", "delta", ""), ("Theta", "theta", ""), ("Gamma", "gamma", ""),
+    ("Vega", "vega", ""), ("Rho", "rho", ""),
+)
+# Best bid/ask as numbers plus every level packed into one string field per side ("price:quantity;...")
+DEPTH_LINE_TEMPLATE = '{}BidP={},BidQ={}i,AskP={},AskQ={}i,Bids="{}",Asks="{}" {}'
+
+TICK_MEASUREMENT = "tick"
+DEPTH_MEASUREMENT = "depth"
+
+_CANDLE_GETTERS = tuple(itemgetter(i) for i in range(len(CandleRow._fields)))
+_OPTIONAL_TICK_GETTERS = tuple(
+    (f",{field}=", itemgetter(TickRow._fields.index(attribute)), suffix)
+    for field, attribute, suffix in OPTIONAL_TICK_FIELDS
+)
+
+_MEASUREMENT_ESCAPES = str.maketrans({",": r"\,", " ": r"\ "})
+_TAG_ESCAPES = str.maketrans({",": r"\,", "=": r"\=", " ": r"\ "})
+
+
+def escape_measurement(value: str) -> str:
+    """Escapes commas and spaces in a line protocol measurement name."""
+    return value.translate(_MEASUREMENT_ESCAPES)
+
+
+def escape_tag(value: str) -> str:
+    """Escapes commas, equal signs and spaces in a line protocol tag key or value."""
+    return value.translate(_TAG_ESCAPES)
+
+
+def _format_column(values: Sequence, formatter: Callable = str) -> list:
+    """Formats a whole column to strings, mapping in C instead of a Python level loop."""
+    if hasattr(values, "tolist"):
+        values = values.tolist()
+    return list(map(formatter, values))
+
+
+class LineProtocolEncoder:
+    """
+    Columnar InfluxDB line protocol encoder for OHLC candles, ticks and market depth.
+
+    The measurement and tag part of a line only depends on the (instrument, interval) pair,
+    so it is built and escaped once and cached. Every column is formatted in one mapped pass
+    and stitched together with the cached prefixes, without building per row objects.
+
+    Parameters:
+    - symbol_lookup (Mapping[str, str] or callable, optional): Maps an instrument key to its
+      trade symbol. Instrument keys without a symbol are used as the trade symbol.
+    """
+
+    def __init__(self, symbol_lookup: Optional[Union[Mapping[str, str], Callable[[str], Optional[str]]]] = None):
+        if symbol_lookup is None:
+            self._symbol_lookup = lambda key: None
+        elif callable(symbol_lookup):
+            self._symbol_lookup = symbol_lookup
+        else:
+            self._symbol_lookup = symbol_lookup.get
+        self._prefixes: Dict[Tuple[str, str], str] = {}
+
+    def clear_cache(self) -> None:
+        """Drops the cached prefixes, e.g. after the instrument master was refreshed."""
+        self._prefixes.clear()
+
+    def prefix(self, instrument_key: str, interval: str) -> str:
+        """Returns the `<measurement>,<tags> ` prefix of the given instrument and interval."""
+        key = (instrument_key, interval)
+        prefix = self._prefixes.get(key)
+        if prefix is None:
+            trade_symbol = self._symbol_lookup(instrument_key) or instrument_key
+            # Spaces in the feed name have always been stored as underscores
+            feed_name = instrument_key.replace(" ", "_")
+            prefix = (
+                f"{escape_measurement(interval)},"
+                f"feed_name={escape_tag(feed_name)},trade_symbol={escape_tag(str(trade_symbol))} "
+            )
+            self._prefixes[key] = prefix
+        return prefix
+
+    def encode_columns(self,
+                       instrument_keys: Sequence[str],
+                       intervals: Sequence[str],
+                       opens: Sequence[float],
+                       highs: Sequence[float],
+                       lows: Sequence[float],
+                       closes: Sequence[float],
+                       volumes: Sequence[int],
+                       timestamps: Sequence[int]) -> str:
+        """
+        Encodes equally sized candle columns into line protocol.
+
+        Parameters:
+        - instrument_keys, intervals: Tag columns, one entry per line.
+        - opens, highs, lows, closes: Price columns.
+        - volumes: Traded volume column.
+        - timestamps: Epoch millisecond timestamps.
+
+        Returns:
+        - str: Newline separated line protocol, one line per candle. Missing (NaN) prices and volumes
+          are omitted from their line.
+        """
+        if len(instrument_keys) == 0:
+            return ""
+
+        pairs = list(zip(instrument_keys, intervals))
+        prefixes = list(map(self._prefixes.get, pairs))
+        if None in prefixes:
+            prefixes = [prefix or self.prefix(*pair) for prefix, pair in zip(prefixes, pairs)]
+
+        price_columns = [_format_column(column, repr) for column in (opens, highs, lows, closes)]
+        volume_s = _format_column(volumes)
+        ts_s = _format_column(timestamps)
+
+        lines = list(map(CANDLE_LINE_TEMPLATE.format, prefixes, *price_columns, volume_s, ts_s))
+
+        # Rare slow path, drop the missing fields of lines which carry NaN prices or volumes
+        value_columns = price_columns + [volume_s]
+        if any("nan" in column for column in value_columns):
+            for i, values in enumerate(zip(*value_columns)):
+                if "nan" not in values:
+                    continue
+                fields = [
+                    f"{name}={value}"
+                    for name, value in zip(("Open", "High", "Low", "Close", "Volume"), values)
+                    if value != "nan"
+                ]
+                lines[i] = f"{prefixes[i]}{','.join(fields)} {ts_s[i]}"
+
+        return "\n".join(lines)
+
+    def encode_feeds(self, feeds: Iterable[DecodedFeed]) -> str:
+        """
+        Encodes the candles of a batch of decoded frames into line protocol in one pass.
+
+        Parameters:
+        - feeds (Iterable[DecodedFeed]): Decoded websocket frames.
+
+        Returns:
+        - str: Newline separated line protocol for every candle in the batch.
+        """
+        return self.encode_candles([candle for feed in feeds for candle in feed.candles])
+
+    def encode_candles(self, candles: Sequence[CandleRow]) -> str:
+        """
+        Encodes a sequence of candles into line protocol in one pass.
+
+        Parameters:
+        - candles (Sequence[CandleRow]): Candles to encode.
+
+        Returns:
+        - str: Newline separated line protocol, one line per candle.
+        """
+        if not candles:
+            return ""
+        # Column extraction through itemgetter is much cheaper than transposing with zip(*candles)
+        return self.encode_columns(*(list(map(getter, candles)) for getter in _CANDLE_GETTERS))
+
+    def encode_ticks(self, ticks: Sequence[Tuple[int, TickRow]], measurement: str = TICK_MEASUREMENT) -> str:
+        """
+        Encodes last traded price, market level and greeks of ticks into line protocol.
+
+        Market level and greek fields which are None are omitted from the line.
+
+        Parameters:
+        - ticks (Sequence[Tuple[int, TickRow]]): (epoch millisecond timestamp, tick) pairs, the
+          timestamp is usually the `current_ts` of the frame the tick came from.
+        - measurement (str): Measurement the ticks are written to.
+
+        Returns:
+        - str: Newline separated line protocol, one line per tick.
+        """
+        lines = []
+        for ts, tick in ticks:
+            optional = []
+            for field, getter, suffix in _OPTIONAL_TICK_GETTERS:
+                value = getter(tick)
+                if value is not None:
+                    optional.append(f"{field}{value!r}{suffix}")
+            lines.append(TICK_LINE_TEMPLATE.format(
+                self.prefix(tick.instrument_key, measurement),
+                repr(tick.ltp), tick.ltt, tick.ltq, repr(tick.cp), "".join(optional), ts,
+            ))
+        return "\n".join(lines)
+
+    def encode_depth(self, ticks: Sequence[Tuple[int, TickRow]], measurement: str = DEPTH_MEASUREMENT) -> str:
+        """
+        Encodes the market depth of ticks into line protocol, one point per snapshot.
+
+        Instead of four fields per level, the levels of each side are packed into a single string
+        field, which keeps a 5 (or 30) level snapshot at a handful of fields. Ticks without depth
+        are skipped.
+
+        Parameters:
+        - ticks (Sequence[Tuple[int, TickRow]]): (epoch millisecond timestamp, tick) pairs.
+        - measurement (str): Measurement the snapshots are written to.
+
+        Returns:
+        - str: Newline separated line protocol, one line per tick with depth.
+        """
+        lines = []
+        for ts, tick in ticks:
+            if not tick.depth:
+                continue
+            best_bid_q, best_bid_p, best_ask_q, best_ask_p = tick.depth[0]
+            lines.append(DEPTH_LINE_TEMPLATE.format(
+                self.prefix(tick.instrument_key, measurement),
+                repr(best_bid_p), best_bid_q, repr(best_ask_p), best_ask_q,
+                ";".join(f"{bid_p!r}:{bid_q}" for bid_q, bid_p, _, _ in tick.depth),
+                ";".join(f"{ask_p!r}:{ask_q}" for _, _, ask_q, ask_p in tick.depth),
+                ts,
+            ))
+        return "\n".join(lines)
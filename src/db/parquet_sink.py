@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from pipeline.tick_filter import CAPTURE_TICKS
+from utils.metrics import REGISTRY
+from v3.decoder import CandleRow, TickRow
+from .sinks import Sink, SinkBatch
+
+logger = logging.getLogger(__name__)
+
+# Root directory of the archive, see `ParquetSink` for the layout
+PARQUET_DIR = os.getenv("PARQUET_DIR", os.path.join("archive", "parquet"))
+# Rows per partition buffered into one row group
+PARQUET_ROW_GROUP_SIZE = int(os.getenv("PARQUET_ROW_GROUP_SIZE", 100_000))
+# A file is closed and a new one started after this many rows, all files every this many seconds, which
+# bounds what a crash loses (see `ParquetSink`)
+PARQUET_FILE_MAX_ROWS = int(os.getenv("PARQUET_FILE_MAX_ROWS", 5_000_000))
+PARQUET_FILE_MAX_AGE = float(os.getenv("PARQUET_FILE_MAX_AGE", 300))
+# 'zstd', 'snappy', 'gzip', 'lz4', 'brotli' or 'none'
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd").lower()
+
+# Offset of IST to UTC, partitions are split at the exchange's midnight
+_IST_OFFSET_MS = (5 * 60 + 30) * 60 * 1000
+_DAY_MS = 24 * 3600 * 1000
+_EPOCH = date(1970, 1, 1)
+# Scalar fields of `TickRow` archived as columns, the market depth is left out
+_TICK_FIELDS = [field for field in TickRow._fields[1:] if field != "depth"]
+
+PARQUET_ROWS = REGISTRY.counter("parquet_rows_total", "Rows written to Parquet row groups.", ("kind",))
+PARQUET_FILES = REGISTRY.counter("parquet_files_total", "Parquet files completed.")
+PARQUET_BUFFERED = REGISTRY.gauge("parquet_buffered_rows", "Rows buffered for the next Parquet row groups.")
+
+
+def _segment(instrument_key: str) -> str:
+    """Exchange segment of an instrument key, e.g. 'NSE_EQ' of 'NSE_EQ|INE002A01018'."""
+    return instrument_key.partition("|")[0]
+
+
+class _PartitionFile:
+    """Open file of one partition, written under a temporary name until it is rolled."""
+
+    def __init__(self, writer, path: str):
+        self.writer = writer
+        self.path = path
+        self.rows = 0
+
+    def close(self) -> None:
+        self.writer.close()
+        os.replace(self.path + ".tmp", self.path)
+        PARQUET_FILES.inc()
+
+
+class ParquetSink(Sink):
+    """
+    Archives the ingested candles (and ticks with `capture_ticks`) in Parquet files for research
+    workloads, which only scan history and do not need InfluxDB.
+
+    Files are partitioned Hive style by date (IST), interval and exchange segment:
+    `<directory>/candles/date=2024-01-31/interval=I1/segment=NSE_EQ/part-<id>.parquet` and
+    `<directory>/ticks/date=2024-01-31/segment=NSE_EQ/part-<id>.parquet`. Rows are buffered per
+    partition and written as one row group once `row_group_size` rows are collected. A file is
+    closed after `file_max_rows` rows and every `file_max_age` seconds all buffered rows are written
+    and all files closed, also when no rows arrive. Files are renamed from `.parquet.tmp` when closed,
+    so readers only ever see complete files.
+
+    A crash loses the rows received since the last roll, at most `file_max_age` seconds: they are
+    either still buffered or in a `.parquet.tmp` file without footer, which is left behind unreadable.
+    A shorter `file_max_age` loses less but writes more, smaller files.
+
+    Candles are written whenever they change, a buffered candle is replaced by its newer values, but
+    a bar can still appear in several row groups; readers keep the last row per instrument, interval
+    and ts.
+
+    Encoding and compression run on a dedicated thread, so they never block the event loop.
+    Requires `pyarrow`.
+
+    Parameters:
+    - directory (str): Root directory of the archive.
+    - row_group_size (int): Rows per row group.
+    - file_max_rows (int): Rows after which a file is rolled.
+    - file_max_age (float): Seconds between writing all buffered rows and rolling all files.
+    - compression (str): Parquet compression codec.
+    - capture_ticks (bool): Also archive the throttled ticks.
+    """
+    name = "parquet"
+
+    def __init__(self, directory: str = PARQUET_DIR, row_group_size: int = PARQUET_ROW_GROUP_SIZE,
+                 file_max_rows: int = PARQUET_FILE_MAX_ROWS, file_max_age: float = PARQUET_FILE_MAX_AGE,
+                 compression: str = PARQUET_COMPRESSION, capture_ticks: bool = CAPTURE_TICKS):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("The 'parquet' sink requires pyarrow, install it with `pip install pyarrow`.")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.directory = directory
+        self.row_group_size = max(1, row_group_size)
+        self.file_max_rows = file_max_rows
+        self.file_max_age = file_max_age
+        self.compression = None if compression == "none" else compression
+        self.capture_ticks = capture_ticks
+        self.candle_schema = pyarrow.schema([
+            ("instrument_key", pyarrow.string()), ("interval", pyarrow.string()), ("ts", pyarrow.timestamp("ms", tz="UTC")),
+            ("open", pyarrow.float64()), ("high", pyarrow.float64()), ("low", pyarrow.float64()),
+            ("close", pyarrow.float64()), ("volume", pyarrow.int64()),
+        ])
+        self.tick_schema = pyarrow.schema(
+            [("instrument_key", pyarrow.string()), ("ts", pyarrow.timestamp("ms", tz="UTC"))]
+            + [(field, pyarrow.int64() if field in ("ltt", "ltq", "vtt") else pyarrow.float64()) for field in _TICK_FIELDS]
+        )
+        # partition -> buffered rows, candles keyed by (instrument, interval, ts)
+        self._candles: Dict[Tuple[str, str, str], Dict[Tuple[str, str, int], CandleRow]] = {}
+        self._ticks: Dict[Tuple[str, str], List[Tuple[int, TickRow]]] = {}
+        self._files: Dict[tuple, _PartitionFile] = {}
+        self._dates: Dict[int, str] = {}
+        self._rolled_at = time.monotonic()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._roller: Optional[asyncio.Task] = None
+        # Only updated by the writer thread, the metrics endpoint reads the plain int
+        self._buffered_rows = 0
+        PARQUET_BUFFERED.set_function(lambda: self._buffered_rows)
+
+    def _count_buffered(self) -> None:
+        self._buffered_rows = sum(map(len, self._candles.values())) + sum(map(len, self._ticks.values()))
+
+    def _date(self, ts: int) -> str:
+        day = (ts + _IST_OFFSET_MS) // _DAY_MS
+        value = self._dates.get(day)
+        if value is None:
+            value = self._dates[day] = (_EPOCH + timedelta(days=day)).isoformat()
+        return value
+
+    async def open(self) -> None:
+        # One thread keeps the writes of a partition in order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="parquet-sink")
+        self._roller = asyncio.create_task(self._roll_periodically())
+        logger.info(f"Archiving {'candles and ticks' if self.capture_ticks else 'candles'} as Parquet in {self.directory}")
+
+    async def write(self, batch: SinkBatch) -> None:
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write, batch)
+
+    async def close(self) -> None:
+        if self._executor is None:
+            return
+        self._roller.cancel()
+        try:
+            await self._roller
+        except asyncio.CancelledError:
+            pass
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._flush_all)
+        self._executor.shutdown()
+        self._executor = None
+
+    async def _roll_periodically(self) -> None:
+        # Rolls the files of partitions which stopped receiving rows, e.g. after the market closed
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(max(1.0, self._rolled_at + self.file_max_age - time.monotonic()))
+            await loop.run_in_executor(self._executor, self._roll)
+
+    def _write(self, batch: SinkBatch) -> None:
+        for candle in batch.candles:
+            partition = (self._date(candle.ts), candle.interval, _segment(candle.instrument_key))
+            self._candles.setdefault(partition, {})[(candle.instrument_key, candle.interval, candle.ts)] = candle
+        if self.capture_ticks:
+            for ts, tick in batch.ticks:
+                self._ticks.setdefault((self._date(ts), _segment(tick.instrument_key)), []).append((ts, tick))
+
+        for partition, rows in list(self._candles.items()):
+            if len(rows) >= self.row_group_size:
+                self._write_candles(partition, self._candles[partition])
+                del self._candles[partition]
+        for partition, rows in list(self._ticks.items()):
+            if len(rows) >= self.row_group_size:
+                self._write_ticks(partition, self._ticks[partition])
+                del self._ticks[partition]
+        self._roll()
+        self._count_buffered()
+
+    def _file(self, key: tuple, path: str, schema) -> _PartitionFile:
+        file = self._files.get(key)
+        if file is None:
+            os.makedirs(path, exist_ok=True)
+            path = os.path.join(path, f"part-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet")
+            writer = self._pq.ParquetWriter(path + ".tmp", schema, compression=self.compression)
+            file = self._files[key] = _PartitionFile(writer, path)
+        return file
+
+    def _write_table(self, key: tuple, path: str, table) -> None:
+        file = self._file(key, path, table.schema)
+        file.writer.write_table(table, row_group_size=len(table))
+        file.rows += len(table)
+        PARQUET_ROWS.labels(key[0]).inc(len(table))
+
+    def _write_candles(self, partition: Tuple[str, str, str], rows: Dict[Tuple[str, str, int], CandleRow]) -> None:
+        candles = list(rows.values())
+        table = self._pa.table([
+            [c.instrument_key for c in candles], [c.interval for c in candles], [c.ts for c in candles],
+            [c.open for c in candles], [c.high for c in candles], [c.low for c in candles],
+            [c.close for c in candles], [c.volume for c in candles],
+        ], schema=self.candle_schema)
+        day, interval, segment = partition
+        path = os.path.join(self.directory, "candles", f"date={day}", f"interval={interval}", f"segment={segment}")
+        self._write_table(("candles",) + partition, path, table)
+
+    def _write_ticks(self, partition: Tuple[str, str], rows: List[Tuple[int, TickRow]]) -> None:
+        columns = [[tick.instrument_key for _, tick in rows], [ts for ts, _ in rows]]
+        columns.extend([getattr(tick, field) for _, tick in rows] for field in _TICK_FIELDS)
+        table = self._pa.table(columns, schema=self.tick_schema)
+        day, segment = partition
+        path = os.path.join(self.directory, "ticks", f"date={day}", f"segment={segment}")
+        self._write_table(("ticks",) + partition, path, table)
+
+    def _roll(self) -> None:
+        if time.monotonic() - self._rolled_at >= self.file_max_age:
+            # Also writes the rows of partitions which never fill a row group, e.g. daily bars
+            self._flush_all()
+            return
+        for key, file in list(self._files.items()):
+            if file.rows >= self.file_max_rows:
+                del self._files[key]
+                file.close()
+
+    def _flush_all(self) -> None:
+        for partition in list(self._candles):
+            self._write_candles(partition, self._candles[partition])
+            del self._candles[partition]
+        for partition in list(self._ticks):
+            self._write_ticks(partition, self._ticks[partition])
+            del self._ticks[partition]
+        for key in list(self._files):
+            self._files.pop(key).close()
+        self._rolled_at = time.monotonic()
+        self._count_buffered()
@@ -0,0 +1,305 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from pipeline.backpressure import BackpressureQueue
+from pipeline.batcher import Batcher
+from utils.metrics import COUNT_BUCKETS, REGISTRY
+from v3.decoder import CandleRow, TickRow
+
+logger = logging.getLogger(__name__)
+
+# Comma separated sinks fed next to InfluxDB: 'stream' and 'parquet'
+SINKS = [name.strip() for name in os.getenv("SINKS", "").split(",") if name.strip()]
+# Batches waiting per sink, what happens beyond is decided by `SINK_OVERFLOW_POLICY`
+SINK_QUEUE_SIZE = int(os.getenv("SINK_QUEUE_SIZE", 100))
+# 'drop-oldest' or 'spill' (sinks without a spill drop), 'block' would stall the ingest stage
+SINK_OVERFLOW_POLICY = os.getenv("SINK_OVERFLOW_POLICY", "drop-oldest").lower()
+# Ingest batches merged into one sink write, and how long a sink waits to fill a write
+SINK_BATCH_MAX_ITEMS = int(os.getenv("SINK_BATCH_MAX_ITEMS", 20))
+SINK_BATCH_MAX_AGE_MS = int(os.getenv("SINK_BATCH_MAX_AGE_MS", 1_000))
+# Attempts per sink write before the batch is spilled, with exponential backoff from SINK_RETRY_DELAY seconds
+SINK_RETRIES = int(os.getenv("SINK_RETRIES", 3))
+SINK_RETRY_DELAY = float(os.getenv("SINK_RETRY_DELAY", 0.5))
+# Local stream of candles and ticks as JSON lines, for bots
+STREAM_SINK_HOST = os.getenv("STREAM_SINK_HOST", "127.0.0.1")
+STREAM_SINK_PORT = int(os.getenv("STREAM_SINK_PORT", 8767))
+# Clients with more unsent bytes than this miss data until they caught up
+STREAM_SINK_MAX_BUFFER = int(os.getenv("STREAM_SINK_MAX_BUFFER", 4 * 1024 * 1024))
+
+SINK_ROWS = REGISTRY.counter("sink_written_rows_total", "Candles and ticks written per sink.", ("sink",))
+SINK_WRITES = REGISTRY.histogram("sink_write_seconds", "Duration of successful sink writes.", ("sink",))
+SINK_RETRIES_TOTAL = REGISTRY.counter("sink_retries_total", "Sink writes retried after an error.", ("sink",))
+SINK_FAILED = REGISTRY.counter("sink_failed_batches_total", "Sink writes which failed after all retries.", ("sink",))
+SINK_SPILLED = REGISTRY.counter("sink_spilled_batches_total", "Sink batches handed to the sink's spill.", ("sink",))
+SINK_DROPPED_ROWS = REGISTRY.counter("sink_dropped_rows_total", "Rows a sink could not write nor spill.", ("sink",))
+SINK_QUEUE_DEPTH = REGISTRY.gauge("sink_queue_depth", "Batches waiting per sink.", ("sink",))
+SINK_BATCH_ROWS = REGISTRY.histogram("sink_batch_rows", "Rows per sink write.", ("sink",), buckets=COUNT_BUCKETS)
+SINK_FRESHNESS = REGISTRY.histogram("sink_receive_to_write_seconds", "Time from receiving a frame to the sink writing it.", ("sink",))
+
+
+class SinkBatch(NamedTuple):
+    """Rows of one flushed ingest batch, shared by all sinks without copying."""
+    candles: List[CandleRow]
+    # (feed timestamp, tick) pairs which passed the tick throttle
+    ticks: List[Tuple[int, TickRow]]
+    # Receive time of the oldest frame of the batch
+    received_at: float
+
+    @property
+    def rows(self) -> int:
+        return len(self.candles) + len(self.ticks)
+
+
+def merge_batches(batches: List[SinkBatch]) -> SinkBatch:
+    if len(batches) == 1:
+        return batches[0]
+    return SinkBatch(
+        [candle for batch in batches for candle in batch.candles],
+        [tick for batch in batches for tick in batch.ticks],
+        min(batch.received_at for batch in batches),
+    )
+
+
+class Sink:
+    """
+    Destination of the ingested rows next to InfluxDB.
+
+    Subclasses implement `write`, which raises on failure, and optionally `open`, `close` and `spill`
+    (called with a batch which could not be written after all retries, the default drops it).
+    """
+    name = "sink"
+
+    async def open(self) -> None:
+        pass
+
+    async def write(self, batch: SinkBatch) -> None:
+        raise NotImplementedError
+
+    async def spill(self, batch: SinkBatch) -> None:
+        SINK_DROPPED_ROWS.labels(self.name).inc(batch.rows)
+
+    async def close(self) -> None:
+        pass
+
+
+class SinkRunner:
+    """
+    Feeds one sink from its own queue, so a slow or failing sink never stalls the others, the
+    ingest stage or the websocket.
+
+    `submit` puts a batch into a `BackpressureQueue` of `queue_size` batches, which by default drops
+    the oldest batch when the sink falls behind. A `Batcher` merges up to `max_items` queued batches
+    into one write, which is attempted `retries` times with exponential backoff and then handed to
+    the sink's `spill`.
+
+    Parameters:
+    - sink (Sink): The sink to feed.
+    - queue_size (int): Maximum number of queued batches.
+    - policy (str): Overflow policy of the queue, see `BackpressureQueue`.
+    - max_items (int): Maximum number of batches merged into one write.
+    - max_age_ms (int): Maximum time a batch waits for a write, counted from its receive time.
+    - retries (int): Attempts per write.
+    - retry_delay (float): Delay before the first retry in seconds, doubled for every further one.
+    """
+
+    def __init__(self, sink: Sink, queue_size: int = SINK_QUEUE_SIZE, policy: str = SINK_OVERFLOW_POLICY,
+                 max_items: int = SINK_BATCH_MAX_ITEMS, max_age_ms: int = SINK_BATCH_MAX_AGE_MS,
+                 retries: int = SINK_RETRIES, retry_delay: float = SINK_RETRY_DELAY):
+        self.sink = sink
+        self.retries = max(1, retries)
+        self.retry_delay = retry_delay
+        self.queue = BackpressureQueue(maxsize=queue_size, policy=policy, spill=sink.spill, name=f"sink-{sink.name}")
+        self.batcher = Batcher(queue=self.queue, flush=self._flush, max_items=max_items, max_age_ms=max_age_ms,
+                               max_pending_flushes=1)
+        self._task: Optional[asyncio.Task] = None
+        self._rows = SINK_ROWS.labels(sink.name)
+        self._writes = SINK_WRITES.labels(sink.name)
+        self._retried = SINK_RETRIES_TOTAL.labels(sink.name)
+        self._failed = SINK_FAILED.labels(sink.name)
+        self._spilled = SINK_SPILLED.labels(sink.name)
+        self._batch_rows = SINK_BATCH_ROWS.labels(sink.name)
+        self._freshness = SINK_FRESHNESS.labels(sink.name)
+        SINK_QUEUE_DEPTH.labels(sink.name).set_function(self.queue.qsize)
+
+    async def start(self) -> "SinkRunner":
+        await self.sink.open()
+        self._task = asyncio.create_task(self.batcher.run())
+        return self
+
+    async def submit(self, batch: SinkBatch) -> None:
+        await self.queue.put(batch)
+
+    async def _flush(self, batches: List[SinkBatch]) -> None:
+        batch = merge_batches(batches)
+        if not batch.rows:
+            return
+        for attempt in range(self.retries):
+            try:
+                started = time.perf_counter()
+                await self.sink.write(batch)
+                self._writes.observe(time.perf_counter() - started)
+                self._rows.inc(batch.rows)
+                self._batch_rows.observe(batch.rows)
+                self._freshness.observe(time.time() - batch.received_at)
+                return
+            except Exception as e:
+                if attempt + 1 < self.retries:
+                    self._retried.inc()
+                    delay = self.retry_delay * 2 ** attempt
+                    logger.warning(f"Sink '{self.sink.name}' write failed :: {e} :: Retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+                else:
+                    self._failed.inc()
+                    logger.error(f"Sink '{self.sink.name}' write failed after {self.retries} attempts :: {e} :: Spilling {batch.rows} rows")
+        self._spilled.inc()
+        await self.sink.spill(batch)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.batcher.wait_flushes()
+        # Writes the open batch and what is still queued, best effort
+        pending = self.batcher.take_open_batch()
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        if pending:
+            await self._flush(pending)
+        await self.sink.close()
+
+
+class StreamSink(Sink):
+    """
+    Local stream of the ingested candles and ticks for bots, as JSON lines over TCP.
+
+    Every connected client receives one line per row, e.g.
+    `{"type": "candle", "instrument_key": "NSE_EQ|INE002A01018", "interval": "I1", "ts": 1700000000000,
+    "open": 1.0, "high": 1.0, "low": 1.0, "close": 1.0, "volume": 10}` or
+    `{"type": "tick", "instrument_key": ..., "ts": ..., "ltp": ..., ...}`. Each batch is serialized
+    once for all clients. Clients which do not keep up (more than `max_buffer` unsent bytes) miss
+    batches until their buffer drained, so they never slow down the sink.
+
+    Parameters:
+    - host (str): Interface to listen on.
+    - port (int): Port to listen on.
+    - max_buffer (int): Unsent bytes per client beyond which batches are skipped for it.
+    """
+    name = "stream"
+
+    def __init__(self, host: str = STREAM_SINK_HOST, port: int = STREAM_SINK_PORT, max_buffer: int = STREAM_SINK_MAX_BUFFER):
+        self.host = host
+        self.port = port
+        self.max_buffer = max_buffer
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._clients: Set[asyncio.StreamWriter] = set()
+
+    async def open(self) -> None:
+        self._server = await asyncio.start_server(self._accept, self.host, self.port)
+        logger.info(f"Streaming candles and ticks at tcp://{self.host}:{self.port}")
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._clients.add(writer)
+        try:
+            # Nothing is read from clients, this only notices the disconnect
+            await reader.read()
+        except (asyncio.CancelledError, ConnectionError):
+            # Cancelled when the sink is closed
+            pass
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+    @staticmethod
+    def serialize(batch: SinkBatch) -> bytes:
+        lines = [
+            json.dumps({"type": "candle", "instrument_key": c.instrument_key, "interval": c.interval, "ts": c.ts,
+                        "open": c.open, "high": c.high, "low": c.low, "close": c.close, "volume": c.volume})
+            for c in batch.candles
+        ]
+        lines.extend(
+            json.dumps({"type": "tick", "instrument_key": t.instrument_key, "ts": ts, "ltp": t.ltp, "ltt": t.ltt,
+                        "ltq": t.ltq, "cp": t.cp, "atp": t.atp, "vtt": t.vtt, "oi": t.oi, "iv": t.iv,
+                        "tbq": t.tbq, "tsq": t.tsq})
+            for ts, t in batch.ticks
+        )
+        return ("\n".join(lines) + "\n").encode() if lines else b""
+
+    async def write(self, batch: SinkBatch) -> None:
+        if not self._clients:
+            return
+        payload = self.serialize(batch)
+        for writer in list(self._clients):
+            if writer.is_closing():
+                self._clients.discard(writer)
+            elif writer.transport.get_write_buffer_size() > self.max_buffer:
+                SINK_DROPPED_ROWS.labels(self.name).inc(batch.rows)
+            else:
+                writer.write(payload)
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._clients):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+def _parquet_sink() -> Sink:
+    # Imported on demand, pyarrow is only needed by this sink
+    from .parquet_sink import ParquetSink
+    return ParquetSink()
+
+
+# name -> factory of the sinks selectable with `SINKS`
+SINK_FACTORIES: Dict[str, Callable[[], Sink]] = {
+    "stream": StreamSink,
+    "parquet": _parquet_sink,
+}
+
+
+class SinkFanout:
+    """
+    Hands every flushed ingest batch to the runners of all configured sinks.
+
+    Parameters:
+    - sinks (List[Sink]): The sinks to feed, each gets its own `SinkRunner`.
+    """
+
+    def __init__(self, sinks: List[Sink]):
+        self.runners = [SinkRunner(sink) for sink in sinks]
+
+    def __bool__(self) -> bool:
+        return bool(self.runners)
+
+    @classmethod
+    def from_names(cls, names: List[str] = SINKS) -> "SinkFanout":
+        unknown = [name for name in names if name not in SINK_FACTORIES]
+        if unknown:
+            raise ValueError(f"Unknown sinks {unknown}, expected any of {sorted(SINK_FACTORIES)}")
+        return cls([SINK_FACTORIES[name]() for name in names])
+
+    async def start(self) -> "SinkFanout":
+        for runner in self.runners:
+            await runner.start()
+        return self
+
+    async def submit(self, batch: SinkBatch) -> None:
+        """Queues the batch for every sink, waits only for sinks with the 'block' overflow policy."""
+        for runner in self.runners:
+            await runner.submit(batch)
+
+    async def close(self) -> None:
+        for runner in self.runners:
+            try:
+                await runner.close()
+            except Exception as e:
+                logger.error(f"Closing sink '{runner.sink.name}' failed :: {e}")
@@ -0,0 +1,265 @@
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import aiosqlite
+
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SPILL_COMMIT_INTERVAL_MS = int(os.getenv("SPILL_COMMIT_INTERVAL_MS", 200))
+SPILL_MAX_PENDING_ROWS = int(os.getenv("SPILL_MAX_PENDING_ROWS", 500))
+SPILL_SYNCHRONOUS = os.getenv("SPILL_SYNCHRONOUS", "NORMAL").upper()
+
+SPILLED_ROWS = REGISTRY.counter("spill_appended_rows_total", "Line protocol payloads spilled to SQLite.")
+SPILL_DISCARDED_ROWS = REGISTRY.counter("spill_discarded_rows_total", "Payloads discarded because the spill store was full.")
+SPILL_BACKLOG_ROWS = REGISTRY.gauge("spill_backlog_rows", "Rows waiting in the spill store, committed or buffered.", ("db_path",))
+
+
+class SpillStore:
+    """
+    SQLite backed store for line protocol which could not be written to InfluxDB.
+
+    A single connection is kept open for the lifetime of the store, in WAL journal mode with
+    relaxed `synchronous` settings. Appended queries are buffered in memory and group committed,
+    either every `commit_interval_ms` or as soon as `max_pending_rows` are buffered, with one
+    `executemany` per commit. The row count is read once when the store is opened and tracked
+    incrementally afterwards, so appending never scans the table.
+
+    Parameters:
+    - db_path (str): The path to the SQLite database file.
+    - max_rows (int): The maximum number of rows allowed in the database, further rows are discarded.
+    - commit_interval_ms (int): Maximum time appended rows stay buffered before being committed.
+    - max_pending_rows (int): Number of buffered rows which triggers an immediate commit.
+    - synchronous (str): SQLite `synchronous` pragma, e.g. 'NORMAL' or 'FULL'.
+    """
+
+    def __init__(self,
+                 db_path: str,
+                 max_rows: int,
+                 commit_interval_ms: int = SPILL_COMMIT_INTERVAL_MS,
+                 max_pending_rows: int = SPILL_MAX_PENDING_ROWS,
+                 synchronous: str = SPILL_SYNCHRONOUS):
+        self.db_path = db_path
+        self.max_rows = max_rows
+        self.commit_interval = commit_interval_ms / 1000
+        self.max_pending_rows = max_pending_rows
+        self.synchronous = synchronous
+
+        self.row_count = 0
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._pending: List[str] = []
+        self._lock: Optional[asyncio.Lock] = None
+        self._open_lock: Optional[asyncio.Lock] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._committer: Optional[asyncio.Task] = None
+        self._closing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self._conn is not None
+
+    @property
+    def pending_rows(self) -> int:
+        """Number of appended rows not committed yet."""
+        return len(self._pending)
+
+    @property
+    def connection(self) -> aiosqlite.Connection:
+        if self._conn is None:
+            raise RuntimeError(f"Spill store {self.db_path} is not open.")
+        return self._conn
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        """Lock serializing transactions on the shared connection."""
+        return self._lock
+
+    async def open(self) -> "SpillStore":
+        """Opens the connection, applies the pragmas and ensures the `data` table exists."""
+        if self._open_lock is None:
+            self._open_lock = asyncio.Lock()
+
+        async with self._open_lock:
+            if self._conn is not None:
+                return self
+
+            conn = await aiosqlite.connect(self.db_path)
+            # Only effective on a fresh database, existing ones are converted below
+            await conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await conn.execute("PRAGMA journal_mode=WAL")
+            await conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            await conn.execute("PRAGMA busy_timeout=5000")
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS data (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    query TEXT
+                )
+            ''')
+            await conn.commit()
+
+            async with conn.execute("PRAGMA auto_vacuum") as cursor:
+                (auto_vacuum,) = await cursor.fetchone()
+            if auto_vacuum != 2:
+                # One-off full VACUUM so that space can be reclaimed incrementally from now on
+                logger.info(f"Converting {self.db_path} to incremental auto vacuum.")
+                await conn.execute("VACUUM")
+
+            async with conn.execute('SELECT COUNT(*) FROM data') as cursor:
+                (self.row_count,) = await cursor.fetchone()
+
+            self._conn = conn
+            self._lock = asyncio.Lock()
+            self._wakeup = asyncio.Event()
+            self._closing = False
+            self._committer = asyncio.create_task(self._commit_loop())
+            logger.info(f"Spill store {self.db_path} opened in WAL mode with {self.row_count} rows.")
+        return self
+
+    async def close(self) -> None:
+        """Commits the buffered rows and closes the connection."""
+        if self._conn is None:
+            return
+        if self._committer is not None:
+            # Lets the loop finish a commit in progress instead of cancelling it halfway
+            self._closing = True
+            self._wakeup.set()
+            await self._committer
+            self._committer = None
+        await self.commit()
+        await self._conn.close()
+        self._conn = None
+
+    async def append(self, query: str) -> bool:
+        """
+        Buffers a query for the next group commit.
+
+        Returns:
+        - bool: False if the row was discarded because the store is full, True otherwise.
+        """
+        if self._conn is None:
+            await self.open()
+
+        if self.row_count + len(self._pending) >= self.max_rows:
+            logger.error(f"Error: Maximum row limit of {self.max_rows} reached. Discarding data.")
+            SPILL_DISCARDED_ROWS.inc()
+            return False
+
+        self._pending.append(query)
+        SPILLED_ROWS.inc()
+        if len(self._pending) >= self.max_pending_rows:
+            self._wakeup.set()
+        return True
+
+    async def commit(self) -> int:
+        """Writes all buffered rows in a single transaction. Returns the number of rows written."""
+        if not self._pending or self._conn is None:
+            return 0
+
+        async with self._lock:
+            rows, self._pending = self._pending, []
+            try:
+                await self._conn.executemany('INSERT INTO data (query) VALUES (?)', ((row,) for row in rows))
+                await self._conn.commit()
+            except BaseException:
+                # Keep the rows for the next attempt, also when cancelled, and undo what the interrupted
+                # transaction inserted already so they are not written twice
+                self._pending = rows + self._pending
+                await asyncio.shield(self._rollback())
+                raise
+            self.row_count += len(rows)
+
+        logger.debug(f"Committed {len(rows)} rows to {self.db_path}. Current row count: {self.row_count}.")
+        return len(rows)
+
+    async def _rollback(self) -> None:
+        try:
+            await self._conn.rollback()
+        except aiosqlite.Error as e:
+            logger.error(f"Rolling back the commit to {self.db_path} failed: {e}")
+
+    async def _commit_loop(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.commit_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.commit()
+            except aiosqlite.Error as e:
+                logger.error(f"Group commit to {self.db_path} failed: {e}")
+
+    async def delete(self, doc_ids: Sequence[int]) -> int:
+        """Deletes the given rows and commits. Returns the number of deleted rows."""
+        if not doc_ids:
+            return 0
+        async with self._lock:
+            placeholders = ",".join("?" * len(doc_ids))
+            cursor = await self.connection.execute(f'DELETE FROM data WHERE id IN ({placeholders})', tuple(doc_ids))
+            await self.connection.commit()
+            deleted = cursor.rowcount
+            await cursor.close()
+        self.row_count = max(0, self.row_count - deleted)
+        return deleted
+
+    async def fetch_page(self, after_id: int, limit: int) -> List[Tuple[int, str]]:
+        """Returns up to `limit` committed rows with an id greater than `after_id`, ordered by id."""
+        async with self.connection.execute(
+            'SELECT id, query FROM data WHERE id > ? ORDER BY id LIMIT ?', (after_id, limit)
+        ) as cursor:
+            return await cursor.fetchall()
+
+    async def delete_ranges(self, id_ranges: Sequence[Tuple[int, int]]) -> int:
+        """
+        Deletes the rows of the given inclusive (first_id, last_id) ranges in a single transaction.
+
+        Returns:
+        - int: The number of deleted rows.
+        """
+        if not id_ranges:
+            return 0
+        async with self._lock:
+            deleted = 0
+            for first_id, last_id in id_ranges:
+                cursor = await self.connection.execute('DELETE FROM data WHERE id BETWEEN ? AND ?', (first_id, last_id))
+                deleted += cursor.rowcount
+                await cursor.close()
+            await self.connection.commit()
+        self.row_count = max(0, self.row_count - deleted)
+        return deleted
+
+    async def reclaim_space(self, max_pages: int = 0) -> None:
+        """
+        Returns free pages to the file system without blocking like a full VACUUM.
+
+        Parameters:
+        - max_pages (int): Maximum number of pages to free, 0 frees all of them.
+        """
+        async with self._lock:
+            # The pragma frees one page per step, fetching the (empty) result runs it to completion
+            async with self.connection.execute(f"PRAGMA incremental_vacuum({int(max_pages)})") as cursor:
+                await cursor.fetchall()
+            await self.connection.commit()
+
+
+_STORES: Dict[str, SpillStore] = {}
+
+
+def get_spill_store(db_path: str, max_rows: int) -> SpillStore:
+    """Returns the shared spill store of the given database file, creating it on first use."""
+    store = _STORES.get(db_path)
+    if store is None:
+        store = SpillStore(db_path=db_path, max_rows=max_rows)
+        _STORES[db_path] = store
+        SPILL_BACKLOG_ROWS.labels(db_path).set_function(lambda: store.row_count + store.pending_rows)
+    return store
+
+
+async def close_spill_stores() -> None:
+    """Commits and closes all shared spill stores, to be called on shutdown."""
+    for store in list(_STORES.values()):
+        await store.close()
+    _STORES.clear()
@@ -0,0 +1,7 @@
+from .batcher import Batcher, LatencyTracker
+from .backpressure import BackpressureQueue
+from .aggregator import BarAggregator
+from .coalescing_buffer import CoalescingBuffer
+from .candle_filter import CandleChangeFilter
+from .quote_snapshot import QuoteSnapshot, QuoteSnapshotReader, QuoteSnapshotWriter
+from .tick_filter import TickThrottle
@@ -0,0 +1,352 @@
+import os
+from typing import Dict, Iterable, List, Sequence
+
+import numpy as np
+
+from v3.decoder import CandleRow, TickRow
+
+# Comma separated bar intervals built from `I1` candles, e.g. "I5,I15,I60". Empty disables aggregation
+AGGREGATE_INTERVALS = [i.strip() for i in os.getenv("AGGREGATE_INTERVALS", "").split(",") if i.strip()]
+# Bars are aligned to this many minutes after midnight UTC (225 = 09:15 IST, the NSE open)
+AGGREGATE_ALIGN_MINUTES = int(os.getenv("AGGREGATE_ALIGN_MINUTES", 225))
+
+SOURCE_INTERVAL = "I1"
+MINUTE_MS = 60_000
+
+
+def interval_minutes(interval: str) -> int:
+    """Parses an Upstox style interval name ('I5') into minutes."""
+    if not interval.startswith("I") or not interval[1:].isdigit() or int(interval[1:]) <= 0:
+        raise ValueError(f"Invalid aggregation interval '{interval}', expected e.g. 'I5' or 'I15'")
+    return int(interval[1:])
+
+
+class BarAggregator:
+    """
+    Builds custom bar intervals incrementally from `I1` candles and ticks.
+
+    A bar is the combination of the minutes of its bucket which are already complete (kept per
+    instrument and interval) and the current minute (kept per instrument). An `I1` update of the
+    current minute replaces it, a new minute folds the previous one into the complete part of every
+    interval, so every update is O(1) and repeated updates of the same minute are never double counted.
+    Ticks move high, low and close of the current minute between `I1` updates. State lives in NumPy
+    arrays indexed by an instrument slot, grown by doubling.
+
+    Upstox frames often carry the final values of the previous minute next to the new one, after the
+    new minute was opened. The last folded minute and the complete part of every interval as it was
+    before folding it are kept, so such a late update replaces the minute's provisional contribution
+    (of the current bucket, or of the bar closed by the fold). Updates of older minutes are ignored.
+
+    Bars missed while the websocket was down are merged in with `backfill`.
+
+    Every update returns the affected bars (with the bucket start as ts) so they can go through the
+    same change filter, encoder and writer as the candles pushed by Upstox.
+
+    Parameters:
+    - intervals (Sequence[str]): Bar intervals to build, e.g. ['I5', 'I15', 'I60'].
+    - align_minutes (int): Offset of the bucket boundaries in minutes after midnight UTC.
+    - capacity (int): Initial number of instrument slots.
+    """
+
+    def __init__(self, intervals: Sequence[str] = AGGREGATE_INTERVALS, align_minutes: int = AGGREGATE_ALIGN_MINUTES,
+                 capacity: int = 256):
+        self.intervals = list(intervals)
+        self.interval_ms = np.array([interval_minutes(i) * MINUTE_MS for i in self.intervals], dtype=np.int64)
+        self.align_ms = align_minutes * MINUTE_MS
+        self._slots: Dict[str, int] = {}
+        # Slots of discarded instruments, reused before new ones are taken
+        self._free: List[int] = []
+        self._used = 0
+
+        n = len(self.intervals)
+        # Current minute, per instrument
+        self.cur_ts = np.full(capacity, -1, dtype=np.int64)
+        self.cur = np.zeros((capacity, 4), dtype=np.float64)  # open, high, low, close
+        self.cur_vol = np.zeros(capacity, dtype=np.int64)
+        # Completed minutes of the current bucket, per instrument and interval
+        self.bucket = np.full((capacity, n), -1, dtype=np.int64)
+        self.done = np.zeros((capacity, n, 3), dtype=np.float64)  # open, high, low
+        self.done_vol = np.zeros((capacity, n), dtype=np.int64)
+        self.has_done = np.zeros((capacity, n), dtype=bool)
+        # Last folded minute per instrument, and the completed part of its bucket before it was folded
+        self.prev_ts = np.full(capacity, -1, dtype=np.int64)
+        self.prev = np.zeros((capacity, 4), dtype=np.float64)
+        self.prev_vol = np.zeros(capacity, dtype=np.int64)
+        self.prev_bucket = np.full((capacity, n), -1, dtype=np.int64)
+        self.base = np.zeros((capacity, n, 3), dtype=np.float64)
+        self.base_vol = np.zeros((capacity, n), dtype=np.int64)
+        self.has_base = np.zeros((capacity, n), dtype=bool)
+        # Last bar closed by a fold, per instrument and interval
+        self.closed_bucket = np.full((capacity, n), -1, dtype=np.int64)
+        self.closed = np.zeros((capacity, n, 4), dtype=np.float64)  # open, high, low, close
+        self.closed_vol = np.zeros((capacity, n), dtype=np.int64)
+
+    def __bool__(self) -> bool:
+        return bool(self.intervals)
+
+    def _slot(self, instrument_key: str) -> int:
+        slot = self._slots.get(instrument_key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+            else:
+                slot = self._used
+                self._used += 1
+                if slot >= len(self.cur_ts):
+                    self._grow()
+            self._slots[instrument_key] = slot
+        return slot
+
+    def discard(self, instrument_keys: Iterable[str]) -> None:
+        """Drops the state of instruments which are no longer subscribed, their slots are reused."""
+        for instrument_key in instrument_keys:
+            slot = self._slots.pop(instrument_key, None)
+            if slot is None:
+                continue
+            self.cur_ts[slot] = -1
+            self.cur[slot] = 0
+            self.cur_vol[slot] = 0
+            self.bucket[slot] = -1
+            self.done[slot] = 0
+            self.done_vol[slot] = 0
+            self.has_done[slot] = False
+            self.prev_ts[slot] = -1
+            self.prev_bucket[slot] = -1
+            self.has_base[slot] = False
+            self.closed_bucket[slot] = -1
+            self._free.append(slot)
+
+    def _grow(self) -> None:
+        def grow(array, fill):
+            extra = np.full((len(array),) + array.shape[1:], fill, dtype=array.dtype)
+            return np.concatenate([array, extra])
+
+        self.cur_ts = grow(self.cur_ts, -1)
+        self.cur = grow(self.cur, 0)
+        self.cur_vol = grow(self.cur_vol, 0)
+        self.bucket = grow(self.bucket, -1)
+        self.done = grow(self.done, 0)
+        self.done_vol = grow(self.done_vol, 0)
+        self.has_done = grow(self.has_done, False)
+        self.prev_ts = grow(self.prev_ts, -1)
+        self.prev = grow(self.prev, 0)
+        self.prev_vol = grow(self.prev_vol, 0)
+        self.prev_bucket = grow(self.prev_bucket, -1)
+        self.base = grow(self.base, 0)
+        self.base_vol = grow(self.base_vol, 0)
+        self.has_base = grow(self.has_base, False)
+        self.closed_bucket = grow(self.closed_bucket, -1)
+        self.closed = grow(self.closed, 0)
+        self.closed_vol = grow(self.closed_vol, 0)
+
+    def _bucket_start(self, ts: int, k: int) -> int:
+        size = int(self.interval_ms[k])
+        return (ts - self.align_ms) // size * size + self.align_ms
+
+    def _bar(self, instrument_key: str, k: int, bucket: int, has_done: bool, done, done_vol: int,
+             minute, minute_vol: int) -> CandleRow:
+        """Combines the completed part of a bucket with its latest minute."""
+        o, h, l, c = minute
+        if has_done:
+            d_open, d_high, d_low = done
+            return CandleRow(instrument_key, self.intervals[k], d_open, max(d_high, h), min(d_low, l), c,
+                             done_vol + minute_vol, bucket)
+        return CandleRow(instrument_key, self.intervals[k], o, h, l, c, minute_vol, bucket)
+
+    def _bars(self, instrument_key: str, slot: int) -> List[CandleRow]:
+        """Returns the current bar of every interval of the instrument."""
+        minute = self.cur[slot].tolist()
+        vol = int(self.cur_vol[slot])
+        return [
+            self._bar(instrument_key, k, int(self.bucket[slot, k]), bool(self.has_done[slot, k]),
+                      self.done[slot, k].tolist(), int(self.done_vol[slot, k]), minute, vol)
+            for k in range(len(self.intervals))
+        ]
+
+    def _close(self, slot: int, k: int, bucket: int, has_done: bool, done, done_vol: int, minute, minute_vol: int) -> None:
+        """Keeps the final bar of a bucket which was closed by a new minute."""
+        if has_done:
+            self.closed[slot, k] = (done[0], max(done[1], minute[1]), min(done[2], minute[2]), minute[3])
+            self.closed_vol[slot, k] = done_vol + minute_vol
+        else:
+            self.closed[slot, k] = minute
+            self.closed_vol[slot, k] = minute_vol
+        self.closed_bucket[slot, k] = bucket
+
+    def _fold_current(self, slot: int, new_ts: int) -> None:
+        """Folds the current minute into the completed part of every interval and opens the buckets of `new_ts`."""
+        o, h, l, c = self.cur[slot].tolist()
+        vol = int(self.cur_vol[slot])
+        # Kept to replace the folded minute with a late update of its final values
+        self.prev_ts[slot] = self.cur_ts[slot]
+        self.prev[slot] = self.cur[slot]
+        self.prev_vol[slot] = vol
+        self.prev_bucket[slot] = self.bucket[slot]
+        self.base[slot] = self.done[slot]
+        self.base_vol[slot] = self.done_vol[slot]
+        self.has_base[slot] = self.has_done[slot]
+        for k in range(len(self.intervals)):
+            new_bucket = self._bucket_start(new_ts, k)
+            if new_bucket != self.bucket[slot, k]:
+                self._close(slot, k, int(self.bucket[slot, k]), bool(self.has_done[slot, k]),
+                            self.done[slot, k].tolist(), int(self.done_vol[slot, k]), (o, h, l, c), vol)
+                self.bucket[slot, k] = new_bucket
+                self.has_done[slot, k] = False
+            elif self.has_done[slot, k]:
+                done = self.done[slot, k]
+                done[1] = max(done[1], h)
+                done[2] = min(done[2], l)
+                self.done_vol[slot, k] += vol
+            else:
+                self.done[slot, k] = (o, h, l)
+                self.done_vol[slot, k] = vol
+                self.has_done[slot, k] = True
+
+    def update_candle(self, candle: CandleRow) -> List[CandleRow]:
+        """Applies an `I1` candle and returns the updated bars, other intervals are ignored."""
+        if candle.interval != SOURCE_INTERVAL:
+            return []
+
+        slot = self._slot(candle.instrument_key)
+        cur_ts = self.cur_ts[slot]
+        if candle.ts < cur_ts:
+            if candle.ts == self.prev_ts[slot]:
+                return self._update_previous(candle, slot)
+            # Late update of an older minute, its bars were closed already
+            return []
+        if candle.ts > cur_ts:
+            if cur_ts >= 0:
+                self._fold_current(slot, candle.ts)
+            else:
+                for k in range(len(self.intervals)):
+                    self.bucket[slot, k] = self._bucket_start(candle.ts, k)
+            self.cur_ts[slot] = candle.ts
+
+        self.cur[slot] = (candle.open, candle.high, candle.low, candle.close)
+        self.cur_vol[slot] = candle.volume
+        return self._bars(candle.instrument_key, slot)
+
+    def _update_previous(self, candle: CandleRow, slot: int) -> List[CandleRow]:
+        """Replaces the last folded minute with its final values, returns the bars it belongs to."""
+        minute = (candle.open, candle.high, candle.low, candle.close)
+        self.prev[slot] = minute
+        self.prev_vol[slot] = candle.volume
+        cur = self.cur[slot].tolist()
+        cur_vol = int(self.cur_vol[slot])
+        bars = []
+        for k in range(len(self.intervals)):
+            bucket = int(self.prev_bucket[slot, k])
+            has_base = bool(self.has_base[slot, k])
+            base = self.base[slot, k].tolist()
+            base_vol = int(self.base_vol[slot, k])
+            if bucket == self.bucket[slot, k]:
+                # Folded into the current bucket, fold the final values again on top of the state before
+                if has_base:
+                    self.done[slot, k] = (base[0], max(base[1], candle.high), min(base[2], candle.low))
+                    self.done_vol[slot, k] = base_vol + candle.volume
+                else:
+                    self.done[slot, k] = (candle.open, candle.high, candle.low)
+                    self.done_vol[slot, k] = candle.volume
+                self.has_done[slot, k] = True
+                bars.append(self._bar(candle.instrument_key, k, bucket, True, self.done[slot, k].tolist(),
+                                      int(self.done_vol[slot, k]), cur, cur_vol))
+            else:
+                # It was the last minute of the bar closed by the fold
+                self._close(slot, k, bucket, has_base, base, base_vol, minute, candle.volume)
+                bars.append(self._bar(candle.instrument_key, k, bucket, has_base, base, base_vol, minute, candle.volume))
+        return bars
+
+    def backfill(self, instrument_key: str, candles: Iterable[CandleRow], start_ts: int, end_ts: int) -> List[CandleRow]:
+        """
+        Merges the `I1` bars of a gap (see `v3.backfill.find_gaps`) and returns the affected bars.
+
+        The gap starts with the last minute seen before the disconnect, whose final values replace its
+        provisional ones if it is still the last folded minute. The minutes after it are merged into the
+        current bar and the bar closed last, buckets within the gap are built from the gap alone. Other
+        buckets which overlap the gap were closed before and keep their values.
+
+        Parameters:
+        - instrument_key (str): Instrument of the bars.
+        - candles (Iterable[CandleRow]): Backfilled bars, other intervals are ignored.
+        - start_ts (int): Last minute seen before the disconnect.
+        - end_ts (int): First minute seen after the reconnect.
+        """
+        minutes = sorted((c for c in candles if c.interval == SOURCE_INTERVAL and start_ts <= c.ts < end_ts),
+                         key=lambda c: c.ts)
+        if not minutes:
+            return []
+        slot = self._slots.get(instrument_key)
+        bars = []
+        if slot is not None and minutes[0].ts == start_ts and self.prev_ts[slot] == start_ts:
+            bars.extend(self._update_previous(minutes[0], slot))
+
+        for k, interval in enumerate(self.intervals):
+            size = int(self.interval_ms[k])
+            buckets: Dict[int, List[CandleRow]] = {}
+            for candle in minutes:
+                buckets.setdefault(self._bucket_start(candle.ts, k), []).append(candle)
+
+            for bucket, group in buckets.items():
+                # The first minute of the gap is part of the live state already
+                gap = [c for c in group if c.ts > start_ts]
+                current = slot is not None and bucket == self.bucket[slot, k]
+                closed = slot is not None and bucket == self.closed_bucket[slot, k]
+                if gap and (current or closed):
+                    o, h, l = gap[0].open, max(c.high for c in gap), min(c.low for c in gap)
+                    vol = sum(c.volume for c in gap)
+                    # Minutes before the gap open the bucket when it starts at or before the gap
+                    keep_open = bucket <= start_ts
+                    if current:
+                        self._merge_done(self.done, self.done_vol, self.has_done, slot, k, keep_open, o, h, l, vol)
+                        bars.append(self._bar(instrument_key, k, bucket, True, self.done[slot, k].tolist(),
+                                              int(self.done_vol[slot, k]), self.cur[slot].tolist(), int(self.cur_vol[slot])))
+                    else:
+                        c_open, c_high, c_low, c_close = self.closed[slot, k].tolist()
+                        # Minutes after the reconnect close the bucket when it extends beyond the gap
+                        close = c_close if bucket + size > end_ts else gap[-1].close
+                        self.closed[slot, k] = (c_open if keep_open else o, max(c_high, h), min(c_low, l), close)
+                        self.closed_vol[slot, k] += vol
+                        bars.append(CandleRow(instrument_key, interval, *self.closed[slot, k].tolist(),
+                                              int(self.closed_vol[slot, k]), bucket))
+                    if self.prev_bucket[slot, k] == bucket and self.prev_ts[slot] >= end_ts:
+                        # A late update of the last folded minute starts from this state
+                        self._merge_done(self.base, self.base_vol, self.has_base, slot, k, keep_open, o, h, l, vol)
+                elif bucket >= start_ts and bucket + size <= end_ts:
+                    bars.append(CandleRow(instrument_key, interval, group[0].open, max(c.high for c in group),
+                                          min(c.low for c in group), group[-1].close, sum(c.volume for c in group), bucket))
+        return bars
+
+    @staticmethod
+    def _merge_done(done, done_vol, has_done, slot: int, k: int, keep_open: bool, o: float, h: float, l: float, vol: int) -> None:
+        if has_done[slot, k]:
+            d_open, d_high, d_low = done[slot, k].tolist()
+            done[slot, k] = (d_open if keep_open else o, max(d_high, h), min(d_low, l))
+            done_vol[slot, k] += vol
+        else:
+            done[slot, k] = (o, h, l)
+            done_vol[slot, k] = vol
+            has_done[slot, k] = True
+
+    def update_tick(self, tick: TickRow) -> List[CandleRow]:
+        """Moves high, low and close of the current minute with a last traded price."""
+        slot = self._slots.get(tick.instrument_key)
+        if slot is None or not tick.ltp or tick.ltt < self.cur_ts[slot] or tick.ltt >= self.cur_ts[slot] + MINUTE_MS:
+            # Only ticks inside the current minute are applied, the next I1 candle opens a new minute
+            return []
+        cur = self.cur[slot]
+        if tick.ltp > cur[1]:
+            cur[1] = tick.ltp
+        if tick.ltp < cur[2]:
+            cur[2] = tick.ltp
+        cur[3] = tick.ltp
+        return self._bars(tick.instrument_key, slot)
+
+    def update(self, candles: Iterable[CandleRow], ticks: Iterable[TickRow] = ()) -> List[CandleRow]:
+        """Applies a batch of candles and ticks, returns the updated bars in order."""
+        bars = []
+        for candle in candles:
+            if candle.interval == SOURCE_INTERVAL:
+                bars.extend(self.update_candle(candle))
+        for tick in ticks:
+            bars.extend(self.update_tick(tick))
+        return bars
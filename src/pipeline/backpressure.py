@@ -0,0 +1,118 @@
+import asyncio
+import collections
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from v3.decoder import DecodedFeed
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# What `put` does when the ingest queue is full: 'block', 'drop-oldest', 'coalesce' or 'spill'
+QUEUE_OVERFLOW_POLICY = os.getenv("QUEUE_OVERFLOW_POLICY", "block").lower()
+OVERFLOW_REPORT_INTERVAL = float(os.getenv("QUEUE_OVERFLOW_REPORT_INTERVAL", 10))
+
+OVERFLOW_POLICIES = ("block", "drop-oldest", "coalesce", "spill")
+
+OVERFLOWS = REGISTRY.counter("queue_overflow_total", "Items put into a full queue, by queue and resulting action.", ("queue", "action"))
+
+
+def coalesce_feeds(older: DecodedFeed, newer: DecodedFeed) -> DecodedFeed:
+    """
+    Merges two decoded frames into one, newer values win.
+
+    Candles are kept per (instrument, interval, ts), so a completed candle is never replaced by the
+    next one, and ticks per instrument. The merged frame keeps the receive time of `older`, so
+    freshness is measured from the oldest data it carries.
+    """
+    candles = {(c.instrument_key, c.interval, c.ts): c for c in older.candles}
+    candles.update(((c.instrument_key, c.interval, c.ts), c) for c in newer.candles)
+    ticks = {t.instrument_key: t for t in older.ticks}
+    ticks.update((t.instrument_key, t) for t in newer.ticks)
+    return DecodedFeed(newer.type, newer.current_ts, older.received_at, list(candles.values()), list(ticks.values()))
+
+
+class BackpressureQueue(asyncio.Queue):
+    """
+    Ingest queue with a selectable policy for when it is full.
+
+    With 'block' (the default) `put` waits for free space like `asyncio.Queue`, which stalls the
+    websocket receive loop while the writer is behind. The other policies never wait, so a slow
+    InfluxDB degrades data granularity instead of the connection:
+    - 'drop-oldest': The oldest queued frame is dropped to make room.
+    - 'coalesce': The frame is merged into the newest queued frame (see `coalesce_feeds`), keeping
+      the latest values per instrument; frames which cannot be merged are handled like 'drop-oldest'.
+    - 'spill': The frame is handed to `spill`, which persists it for a later replay (only its completed
+      candles, see `spill_feed`).
+
+    Every overflow is counted in `queue_overflow_total` (labelled with the queue `name`, the sink
+    queues share it) and summarized in the log every `QUEUE_OVERFLOW_REPORT_INTERVAL` seconds.
+
+    'coalesce' replaces the newest queued item, which `asyncio.Queue` has no public method for. Like
+    the `LifoQueue` and `PriorityQueue` subclasses of asyncio, the storage hooks `_init`, `_put` and
+    `_get` are overridden, so `_queue` is a deque this class creates itself. It must stay named
+    `_queue`, because `qsize` and `empty` of `asyncio.Queue` read it.
+
+    Parameters:
+    - maxsize (int): Maximum number of queued frames.
+    - policy (str): One of 'block', 'drop-oldest', 'coalesce', 'spill'.
+    - spill (callable, optional): Coroutine function persisting a frame, required by 'spill'.
+    - name (str): Name of the queue in metrics and log messages.
+    """
+
+    def __init__(self, maxsize: int = 0, policy: str = QUEUE_OVERFLOW_POLICY,
+                 spill: Optional[Callable[[Any], Awaitable[None]]] = None, name: str = "ingest"):
+        super().__init__(maxsize=maxsize)
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown queue overflow policy '{policy}', expected one of {OVERFLOW_POLICIES}")
+        if policy == "spill" and spill is None:
+            raise ValueError("The 'spill' overflow policy needs a spill coroutine")
+        self.policy = policy
+        self.spill = spill
+        self.name = name
+        self._overflows = {action: OVERFLOWS.labels(name, action) for action in ("dropped", "coalesced", "spilled")}
+        self._unreported = {action: 0 for action in self._overflows}
+        self._last_report = time.monotonic()
+
+    def _init(self, maxsize: int) -> None:
+        self._queue = collections.deque()
+
+    def _put(self, item: Any) -> None:
+        self._queue.append(item)
+
+    def _get(self) -> Any:
+        return self._queue.popleft()
+
+    def _count(self, action: str) -> None:
+        self._overflows[action].inc()
+        self._unreported[action] += 1
+        now = time.monotonic()
+        if now - self._last_report >= OVERFLOW_REPORT_INTERVAL:
+            summary = " :: ".join(f"{action} : {count}" for action, count in self._unreported.items() if count)
+            logger.warning(f"Queue '{self.name}' full ({self.maxsize} items, policy '{self.policy}') :: {summary}")
+            self._unreported = {action: 0 for action in self._unreported}
+            self._last_report = now
+
+    def _drop_oldest(self, item: Any) -> None:
+        self.get_nowait()
+        self.put_nowait(item)
+        self._count("dropped")
+
+    async def put(self, item: Any) -> None:
+        if self.policy == "block" or not self.full():
+            return await super().put(item)
+
+        if self.policy == "drop-oldest":
+            self._drop_oldest(item)
+        elif self.policy == "coalesce":
+            newest = self._queue[-1]
+            if isinstance(newest, DecodedFeed) and isinstance(item, DecodedFeed):
+                self._queue[-1] = coalesce_feeds(newest, item)
+                self._count("coalesced")
+            else:
+                self._drop_oldest(item)
+        else:
+            await self.spill(item)
+            self._count("spilled")
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 500))
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", 2_000_000))
+BATCH_MAX_AGE_MS = int(os.getenv("BATCH_MAX_AGE_MS", 1_000))
+BATCH_MAX_PENDING_FLUSHES = int(os.getenv("BATCH_MAX_PENDING_FLUSHES", 4))
+FRESHNESS_P99_TARGET_MS = float(os.getenv("FRESHNESS_P99_TARGET_MS", 5_000))
+FRESHNESS_REPORT_INTERVAL = float(os.getenv("FRESHNESS_REPORT_INTERVAL", 60))
+
+
+def _item_size(item: Any) -> int:
+    return getattr(item, "nbytes", 0)
+
+
+def _item_received_at(item: Any) -> Optional[float]:
+    return getattr(item, "received_at", None)
+
+
+class LatencyTracker:
+    """
+    Keeps the most recent latency samples (in milliseconds) and reports their percentiles.
+
+    Parameters:
+    - name (str): Name used in the periodic log line.
+    - max_samples (int): Number of most recent samples kept.
+    - p99_target_ms (float): A warning is logged when the reported p99 exceeds this value.
+    - report_interval (float): Minimum number of seconds between two reports.
+    - histogram (Histogram, optional): Additionally observes every sample, in seconds.
+    """
+
+    def __init__(self, name: str, max_samples: int = 10_000,
+                 p99_target_ms: float = FRESHNESS_P99_TARGET_MS,
+                 report_interval: float = FRESHNESS_REPORT_INTERVAL,
+                 histogram=None):
+        self.name = name
+        self.histogram = histogram
+        self.samples = deque(maxlen=max_samples)
+        self.p99_target_ms = p99_target_ms
+        self.report_interval = report_interval
+        self._last_report = time.monotonic()
+
+    def record(self, *latencies_ms: float) -> None:
+        self.samples.extend(latencies_ms)
+        if self.histogram is not None:
+            for latency_ms in latencies_ms:
+                self.histogram.observe(latency_ms / 1000)
+        if time.monotonic() - self._last_report >= self.report_interval:
+            self.report()
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Returns the q-th percentile (0-100) of the kept samples, None if there are none."""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def report(self) -> None:
+        self._last_report = time.monotonic()
+        if not self.samples:
+            return
+        p50, p99 = self.percentile(50), self.percentile(99)
+        message = f"{self.name} latency over last {len(self.samples)} samples :: p50 : {p50:.1f} ms :: p99 : {p99:.1f} ms"
+        if p99 > self.p99_target_ms:
+            logger.warning(f"{message} :: above target of {self.p99_target_ms:.0f} ms")
+        else:
+            logger.info(message)
+
+
+class Batcher:
+    """
+    Event-driven batching stage between an `asyncio.Queue` and a flush coroutine.
+
+    The batcher sleeps on the queue and wakes up as soon as an item arrives. A batch is closed
+    on whichever limit is hit first: `max_items`, `max_bytes` (as reported by the items' `nbytes`)
+    or `max_age_ms`, counted from the receive time of the oldest item in the batch. Closed batches
+    are flushed in background tasks so that draining the queue never waits on the writer; at most
+    `max_pending_flushes` closed batches wait for their flush. Flushes run one after another in batch
+    order: every frame repeats the open candles, so a slow earlier batch finishing after a later one
+    would overwrite newer values of the same point.
+
+    Parameters:
+    - queue (asyncio.Queue): Queue to consume from.
+    - flush (callable): Coroutine function called with the list of items of a batch. It returns False
+      when the batch was not written (e.g. it was spilled), which keeps it out of the latency samples.
+    - max_items (int): Maximum number of items per batch.
+    - max_bytes (int): Maximum estimated payload size of a batch.
+    - max_age_ms (int): Maximum age of the oldest item before the batch is flushed.
+    - max_pending_flushes (int): Maximum number of closed batches waiting for or in their flush.
+    - latency_tracker (LatencyTracker, optional): Records receive-to-flush latency of every item
+      after its batch was written.
+    - on_item (callable, optional): Called with every item, in order, as soon as it is taken from the
+      queue, i.e. before its batch is closed. Must not block.
+    """
+
+    def __init__(self,
+                 queue: asyncio.Queue,
+                 flush: Callable[[List[Any]], Awaitable[Optional[bool]]],
+                 max_items: int = BATCH_MAX_ITEMS,
+                 max_bytes: int = BATCH_MAX_BYTES,
+                 max_age_ms: int = BATCH_MAX_AGE_MS,
+                 max_pending_flushes: int = BATCH_MAX_PENDING_FLUSHES,
+                 latency_tracker: Optional[LatencyTracker] = None,
+                 on_item: Optional[Callable[[Any], None]] = None):
+        self.queue = queue
+        self.flush = flush
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_age = max_age_ms / 1000
+        self.latency_tracker = latency_tracker
+        self.on_item = on_item
+        self._flush_slots = asyncio.Semaphore(max_pending_flushes)
+        self._pending = set()
+        self._open: List[Any] = []
+        self._last_flush: Optional[asyncio.Task] = None
+
+    def _add(self, item: Any) -> None:
+        if self.on_item is not None:
+            self.on_item(item)
+        self._open.append(item)
+
+    async def next_batch(self) -> List[Any]:
+        """
+        Waits for the next item and collects a batch around it.
+
+        The items are kept on the batcher until `run` hands the batch to its flush, so the batch
+        being collected when `run` is cancelled can still be flushed (see `take_open_batch`).
+        """
+        batch = self._open
+        if not batch:
+            self._add(await self.queue.get())
+        nbytes = sum(map(_item_size, batch))
+        deadline = (_item_received_at(batch[0]) or time.time()) + self.max_age
+
+        while len(batch) < self.max_items and nbytes < self.max_bytes:
+            try:
+                item = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            self._add(item)
+            nbytes += _item_size(item)
+
+        return batch
+
+    def take_open_batch(self) -> List[Any]:
+        """
+        Returns and forgets the items of the batch which was being collected (or waiting for a flush
+        slot) when `run` was cancelled. They went through `on_item` already but were not flushed.
+        """
+        batch, self._open = self._open, []
+        return batch
+
+    async def wait_flushes(self) -> None:
+        """Waits until the closed batches were flushed, e.g. after `run` was cancelled."""
+        if self._pending:
+            await asyncio.wait(self._pending)
+
+    async def _run_flush(self, batch: List[Any], previous: Optional[asyncio.Task]) -> None:
+        try:
+            if previous is not None:
+                # Waits without propagating a cancellation to the previous flush
+                await asyncio.wait({previous})
+            written = await self.flush(batch)
+            # A flush returns False when the batch was not written, e.g. spilled after a failed write
+            if written is not False and self.latency_tracker is not None:
+                now = time.time()
+                self.latency_tracker.record(*(
+                    (now - received_at) * 1000
+                    for received_at in map(_item_received_at, batch)
+                    if received_at is not None
+                ))
+        except Exception as e:
+            logger.error(f"Flushing batch of {len(batch)} items failed: {e}")
+        finally:
+            self._flush_slots.release()
+
+    async def run(self) -> None:
+        """Runs forever, batching items from the queue and handing them to `flush`."""
+        while True:
+            batch = await self.next_batch()
+            logger.debug(f"Batch of {len(batch)} items closed.")
+
+            # Waits only when `max_pending_flushes` batches are already waiting or being written
+            await self._flush_slots.acquire()
+            self._open = []
+            task = asyncio.create_task(self._run_flush(batch, self._last_flush))
+            self._last_flush = task
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
@@ -0,0 +1,123 @@
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from v3.decoder import CandleRow
+
+# 'all' writes every candle of every frame, 'changed' only candles whose values changed,
+# 'finalized' only completed candles (plus throttled provisional updates)
+CANDLE_EMIT_MODE = os.getenv("CANDLE_EMIT_MODE", "changed").lower()
+CANDLE_PROVISIONAL_INTERVAL_MS = int(os.getenv("CANDLE_PROVISIONAL_INTERVAL_MS", 60_000))
+
+EMIT_MODES = ("all", "changed", "finalized")
+
+
+class CandleChangeFilter:
+    """
+    Last-value cache which suppresses candles that were already written.
+
+    Every frame repeats the current candle of each interval, so most candles are identical to the
+    previous one. The cache keeps the latest candle per (instrument, interval), which identifies the
+    (instrument, interval, ts) point being updated while keeping memory bounded by the number of
+    instruments. Candles older than the cached one are dropped.
+
+    Modes:
+    - 'all': Every candle is passed through.
+    - 'changed': A candle is passed through when its ts moved forward or any of its values changed.
+    - 'finalized': A candle is passed through once, with its last values, when the next ts of the same
+      instrument and interval arrives. In between, the current candle is passed through as a provisional
+      update at most every `provisional_interval_ms` (0 disables provisional updates).
+
+    Parameters:
+    - mode (str): One of 'all', 'changed', 'finalized'.
+    - provisional_interval_ms (int): Throttle of provisional updates in 'finalized' mode.
+    """
+
+    def __init__(self, mode: str = CANDLE_EMIT_MODE, provisional_interval_ms: int = CANDLE_PROVISIONAL_INTERVAL_MS):
+        if mode not in EMIT_MODES:
+            raise ValueError(f"Unknown candle emit mode '{mode}', expected one of {EMIT_MODES}")
+        self.mode = mode
+        self.provisional_interval = provisional_interval_ms / 1000
+        # (instrument, interval) -> [current candle, last emitted candle, last emit time]
+        self._state: Dict[Tuple[str, str], list] = {}
+        self.received = 0
+        self.emitted = 0
+
+    def __len__(self) -> int:
+        return len(self._state)
+
+    def discard(self, instrument_keys: Iterable[str]) -> List[CandleRow]:
+        """
+        Forgets the cached candles of instruments which are no longer subscribed.
+
+        Returns:
+        - list: The discarded candles whose latest values were not written yet (see `pending`), so
+          the last bars of the instruments are not lost.
+        """
+        instrument_keys = set(instrument_keys)
+        held = []
+        for key in [key for key in self._state if key[0] in instrument_keys]:
+            entry = self._state.pop(key)
+            if len(entry) > 1 and entry[0] != entry[1]:
+                held.append(entry[0])
+        return held
+
+    def filter(self, candles: Iterable[CandleRow], now: Optional[float] = None) -> List[CandleRow]:
+        """
+        Returns the candles of `candles` which have to be written, in order.
+
+        Parameters:
+        - candles (Iterable[CandleRow]): Candles in arrival order.
+        - now (float, optional): Current monotonic time, used to throttle provisional updates.
+        """
+        if self.mode == "all":
+            out = list(candles)
+        elif self.mode == "changed":
+            out = self._filter_changed(candles)
+        else:
+            out = self._filter_finalized(candles, time.monotonic() if now is None else now)
+        self.emitted += len(out)
+        return out
+
+    def _filter_changed(self, candles: Iterable[CandleRow]) -> List[CandleRow]:
+        state = self._state
+        out = []
+        for candle in candles:
+            self.received += 1
+            key = (candle.instrument_key, candle.interval)
+            previous = state.get(key)
+            if previous is None or candle.ts > previous[0].ts or (candle.ts == previous[0].ts and candle != previous[0]):
+                state[key] = [candle]
+                out.append(candle)
+        return out
+
+    def _filter_finalized(self, candles: Iterable[CandleRow], now: float) -> List[CandleRow]:
+        state = self._state
+        provisional_interval = self.provisional_interval
+        out = []
+        for candle in candles:
+            self.received += 1
+            key = (candle.instrument_key, candle.interval)
+            entry = state.get(key)
+
+            if entry is None:
+                state[key] = [candle, None, now]
+                continue
+
+            current, emitted, last_emit = entry
+            if candle.ts > current.ts:
+                # The cached candle is complete, write its final values unless already written
+                if current != emitted:
+                    out.append(current)
+                state[key] = [candle, None, now]
+            elif candle.ts == current.ts and candle != current:
+                entry[0] = candle
+                if provisional_interval and now - last_emit >= provisional_interval:
+                    out.append(candle)
+                    entry[1] = candle
+                    entry[2] = now
+        return out
+
+    def pending(self) -> List[CandleRow]:
+        """Returns the current candles whose latest values were not written yet, e.g. to flush them on shutdown."""
+        return [entry[0] for entry in self._state.values() if len(entry) > 1 and entry[0] != entry[1]]
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Dict, Optional, Tuple
+
+from v3.decoder import CandleRow, DecodedFeed, TickRow
+from utils.metrics import REGISTRY
+from .batcher import BATCH_MAX_AGE_MS, BATCH_MAX_BYTES
+
+# 'queue' hands every decoded frame to the writer (FIFO), 'coalescing' only the latest state (see `CoalescingBuffer`)
+INGEST_BUFFER = os.getenv("INGEST_BUFFER", "queue").lower()
+
+# Estimated line protocol size of a candle, as in `DecodedFeed.nbytes`
+_CANDLE_BYTES = 128
+
+BUFFERED_ROWS = REGISTRY.counter("ingest_buffer_rows_total", "Candles and ticks put into the coalescing buffer.")
+COALESCED_ROWS = REGISTRY.counter("ingest_buffer_coalesced_rows_total", "Candles and ticks superseded in the coalescing buffer before they were written.")
+
+
+class CoalescingBuffer:
+    """
+    Latest-wins buffer between the websocket and the writer, replacing the FIFO queue.
+
+    Every frame repeats the current candle of each instrument and interval, so most queued frames
+    are superseded before they are written. The buffer keeps only the newest candle per
+    (instrument, interval, ts) and the newest tick per instrument; `get` hands out one frame holding
+    all keys which changed since the previous `get`. Completed candles keep their own key, so the
+    last value of every ts is written. Memory is bounded by the number of instruments, not by the
+    message rate, and `put` never waits.
+
+    `get` returns once the oldest pending change is `max_age_ms` old (counted from its receive time)
+    or the pending candles reach `max_bytes` of estimated line protocol, so one snapshot is taken per
+    flush. The returned frame carries the receive time of the oldest change it contains.
+
+    Items other than `DecodedFeed` (e.g. pydantic `LiveFeed` models in validation mode) cannot be
+    merged and are passed through in order, ahead of the next snapshot.
+
+    Only the queue methods used by the producers and the `Batcher` are provided, plus `drain`, which
+    hands out everything pending on shutdown whether it is due or not.
+
+    Parameters:
+    - max_age_ms (int): Maximum time a change waits in the buffer.
+    - max_bytes (int): Estimated line protocol size of pending candles which triggers an early snapshot.
+    """
+
+    def __init__(self, max_age_ms: int = BATCH_MAX_AGE_MS, max_bytes: int = BATCH_MAX_BYTES):
+        self.max_age = max_age_ms / 1000
+        self.max_candles = max(1, max_bytes // _CANDLE_BYTES)
+        self._candles: Dict[Tuple[str, str, int], CandleRow] = {}
+        self._ticks: Dict[str, TickRow] = {}
+        self._passthrough = deque()
+        self._type = ""
+        self._current_ts = 0
+        self._oldest: Optional[float] = None
+        self._changed = asyncio.Event()
+
+    def qsize(self) -> int:
+        """Number of pending keys (candles and ticks) plus passed through items."""
+        return len(self._candles) + len(self._ticks) + len(self._passthrough)
+
+    def empty(self) -> bool:
+        return not self.qsize()
+
+    def full(self) -> bool:
+        return False
+
+    def put_nowait(self, item: Any) -> None:
+        if not isinstance(item, DecodedFeed):
+            self._passthrough.append(item)
+            self._changed.set()
+            return
+        rows = len(item.candles) + len(item.ticks)
+        if not rows:
+            return
+
+        candles, ticks = self._candles, self._ticks
+        was_empty = not candles and not ticks
+        before = len(candles) + len(ticks)
+        for candle in item.candles:
+            candles[(candle.instrument_key, candle.interval, candle.ts)] = candle
+        for tick in item.ticks:
+            ticks[tick.instrument_key] = tick
+        BUFFERED_ROWS.inc(rows)
+        COALESCED_ROWS.inc(before + rows - len(candles) - len(ticks))
+
+        self._type = item.type
+        self._current_ts = item.current_ts
+        if self._oldest is None:
+            self._oldest = item.received_at
+        # The getter only has to wake up for the first change and for an early snapshot
+        if was_empty or len(candles) >= self.max_candles:
+            self._changed.set()
+
+    async def put(self, item: Any) -> None:
+        self.put_nowait(item)
+
+    def _ready(self) -> bool:
+        if self._passthrough:
+            return True
+        if not self._candles and not self._ticks:
+            return False
+        return len(self._candles) >= self.max_candles or time.time() >= self._oldest + self.max_age
+
+    def _take(self) -> Any:
+        if self._passthrough:
+            return self._passthrough.popleft()
+        feed = DecodedFeed(self._type, self._current_ts, self._oldest, list(self._candles.values()), list(self._ticks.values()))
+        self._candles = {}
+        self._ticks = {}
+        self._oldest = None
+        return feed
+
+    def get_nowait(self) -> Any:
+        """Returns the pending snapshot if it is due, raises `asyncio.QueueEmpty` otherwise."""
+        if not self._ready():
+            raise asyncio.QueueEmpty
+        return self._take()
+
+    def drain(self) -> list:
+        """Returns the passed through items and the pending snapshot, whether it is due or not, e.g. to write them on shutdown."""
+        items = list(self._passthrough)
+        self._passthrough.clear()
+        if self._candles or self._ticks:
+            items.append(self._take())
+        return items
+
+    async def get(self) -> Any:
+        """Waits until the pending snapshot is due and returns it."""
+        while not self._ready():
+            self._changed.clear()
+            timeout = None if self._oldest is None else self._oldest + self.max_age - time.time()
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._take()
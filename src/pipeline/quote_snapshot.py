@@ -0,0 +1,379 @@
+import logging
+import os
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from v3.decoder import CandleRow, DecodedFeed
+from .aggregator import AGGREGATE_INTERVALS
+
+logger = logging.getLogger(__name__)
+
+# Name of the shared memory block holding the latest quotes, empty disables the snapshot store
+QUOTE_SNAPSHOT_NAME = os.getenv("QUOTE_SNAPSHOT_NAME", "")
+QUOTE_SNAPSHOT_CAPACITY = int(os.getenv("QUOTE_SNAPSHOT_CAPACITY", 5000))
+# Intervals whose current bar is kept, aggregated intervals (see `AGGREGATE_INTERVALS`) are added automatically
+QUOTE_SNAPSHOT_INTERVALS = [i.strip() for i in os.getenv("QUOTE_SNAPSHOT_INTERVALS", "I1,I30").split(",") if i.strip()]
+
+SNAPSHOT_MAGIC = 0x5550_5351_554F_5445  # "UPSQUOTE"
+SNAPSHOT_VERSION = 2
+MAX_INTERVALS = 16
+KEY_SIZE = 64
+
+HEADER_DTYPE = np.dtype([
+    ("magic", "<u8"),
+    ("version", "<u4"),
+    ("capacity", "<u4"),
+    ("n_intervals", "<u4"),
+    ("count", "<u4"),
+    ("pid", "<u4"),
+    ("intervals", "S16", (MAX_INTERVALS,)),
+])
+
+
+def record_dtype(n_intervals: int) -> np.dtype:
+    """Layout of one instrument record, `seq` is the seqlock counter guarding the rest of the record."""
+    return np.dtype([
+        ("seq", "<u8"),
+        ("key", f"S{KEY_SIZE}"),
+        ("updated_at", "<f8"),
+        ("ltp", "<f8"),
+        ("ltt", "<i8"),
+        ("ltq", "<i8"),
+        ("cp", "<f8"),
+        ("bid_p", "<f8"),
+        ("bid_q", "<i8"),
+        ("ask_p", "<f8"),
+        ("ask_q", "<i8"),
+        ("bar_ts", "<i8", (n_intervals,)),
+        ("bar", "<f8", (n_intervals, 5)),  # open, high, low, close, volume
+    ])
+
+
+class QuoteSnapshot(NamedTuple):
+    """Consistent copy of the latest state of one instrument."""
+    instrument_key: str
+    updated_at: float
+    ltp: float
+    ltt: int
+    ltq: int
+    cp: float
+    bid_p: float
+    bid_q: int
+    ask_p: float
+    ask_q: int
+    # interval -> current bar, only intervals which received a candle
+    bars: Dict[str, CandleRow]
+
+
+def _layout(buf) -> Tuple[np.ndarray, np.ndarray]:
+    header = np.ndarray((1,), dtype=HEADER_DTYPE, buffer=buf)[0]
+    records = np.ndarray(
+        (int(header["capacity"]),),
+        dtype=record_dtype(int(header["n_intervals"])),
+        buffer=buf,
+        offset=HEADER_DTYPE.itemsize,
+    )
+    return header, records
+
+
+class QuoteSnapshotWriter:
+    """
+    Latest-state table of every instrument in shared memory, written by the ingest process.
+
+    Each instrument gets a fixed record (last LTPC, top of book and the current bar of every tracked
+    interval) in a NumPy structured array laid over a `multiprocessing.shared_memory` block, so local
+    processes can read it without going through InfluxDB (see `QuoteSnapshotReader`). Slots are handed
+    out append-only in arrival order; records are guarded by a per record seqlock, odd while a write
+    is in progress.
+
+    Frames are applied as soon as they are decoded, before they wait in the ingest queue, so readers
+    see the latest quotes even while the writer falls behind (see `get_quote_snapshot`). Aggregated
+    bars (see `AGGREGATE_INTERVALS`) are applied once the writer builds them from the queued frames.
+    The block records the pid of its writer: a block left over by a process which is gone is replaced,
+    one of a running process is not.
+
+    Parameters:
+    - name (str): Name of the shared memory block.
+    - capacity (int): Maximum number of instruments.
+    - intervals (Sequence[str]): Intervals whose current bar is kept.
+    """
+
+    def __init__(self, name: str = QUOTE_SNAPSHOT_NAME, capacity: int = QUOTE_SNAPSHOT_CAPACITY,
+                 intervals: Sequence[str] = QUOTE_SNAPSHOT_INTERVALS):
+        if len(intervals) > MAX_INTERVALS:
+            raise ValueError(f"At most {MAX_INTERVALS} snapshot intervals are supported, got {len(intervals)}")
+        self.name = name
+        self.capacity = capacity
+        self.intervals = list(intervals)
+        self._interval_index = {interval: i for i, interval in enumerate(self.intervals)}
+        self._slots: Dict[str, int] = {}
+        self._shm: Optional[shared_memory.SharedMemory] = None
+        self._header = None
+        self._records = None
+        self._full_logged = False
+
+    def open(self) -> "QuoteSnapshotWriter":
+        if self._shm is not None:
+            return self
+        self._slots = {}
+        self._full_logged = False
+        size = HEADER_DTYPE.itemsize + self.capacity * record_dtype(len(self.intervals)).itemsize
+        try:
+            self._shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        except FileExistsError:
+            existing = shared_memory.SharedMemory(name=self.name)
+            owner = _owner_pid(existing)
+            if owner is None or _is_running(owner):
+                # Attaching registered the block for removal at exit, it belongs to its owner
+                resource_tracker.unregister(existing._name, "shared_memory")
+                existing.close()
+                owned_by = f"process {owner}" if owner is not None else "another process"
+                raise FileExistsError(f"Quote snapshot '{self.name}' is in use by {owned_by}, set another QUOTE_SNAPSHOT_NAME")
+            # Left over by a previous run which did not shut down cleanly
+            existing.close()
+            existing.unlink()
+            self._shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+
+        header = np.ndarray((1,), dtype=HEADER_DTYPE, buffer=self._shm.buf)
+        header[0] = (0, SNAPSHOT_VERSION, self.capacity, len(self.intervals), 0, os.getpid(),
+                     [interval.encode() for interval in self.intervals] + [b""] * (MAX_INTERVALS - len(self.intervals)))
+        self._header, self._records = _layout(self._shm.buf)
+        self._records[:] = np.zeros(self.capacity, dtype=self._records.dtype)
+        # Written last, readers refuse blocks without a valid magic
+        self._header["magic"] = SNAPSHOT_MAGIC
+        logger.info(f"Quote snapshot '{self.name}' created for {self.capacity} instruments ({size} bytes).")
+        return self
+
+    def close(self, unlink: bool = True) -> None:
+        if self._shm is None:
+            return
+        self._header = self._records = None
+        self._shm.close()
+        if unlink:
+            self._shm.unlink()
+        self._shm = None
+
+    def _slot(self, instrument_key: str) -> Optional[int]:
+        slot = self._slots.get(instrument_key)
+        if slot is None:
+            slot = len(self._slots)
+            if slot >= self.capacity:
+                if not self._full_logged:
+                    logger.error(f"Quote snapshot '{self.name}' is full, raise QUOTE_SNAPSHOT_CAPACITY.")
+                    self._full_logged = True
+                return None
+            self._records[slot]["key"] = instrument_key.encode()
+            self._slots[instrument_key] = slot
+            self._header["count"] = slot + 1
+        return slot
+
+    def discard(self, instrument_keys: Iterable[str]) -> None:
+        """
+        Clears the records of instruments which are no longer subscribed, readers get None for them.
+        The slots stay assigned to their instruments, so readers' slot lookups remain valid.
+        """
+        if self._records is None:
+            return
+        for instrument_key in instrument_keys:
+            slot = self._slots.get(instrument_key)
+            if slot is None:
+                continue
+            record = self._records[slot]
+            record["seq"] += 1
+            for field in self._records.dtype.names:
+                if field not in ("seq", "key"):
+                    record[field] = 0
+            record["seq"] += 1
+
+    def update(self, feed: DecodedFeed) -> None:
+        """Applies the ticks and the candles of the tracked intervals of a decoded frame."""
+        if self._records is None:
+            return
+        records = self._records
+
+        for tick in feed.ticks:
+            slot = self._slot(tick.instrument_key)
+            if slot is None:
+                continue
+            record = records[slot]
+            record["seq"] += 1
+            record["updated_at"] = feed.received_at
+            record["ltp"] = tick.ltp
+            record["ltt"] = tick.ltt
+            record["ltq"] = tick.ltq
+            record["cp"] = tick.cp
+            if tick.depth:
+                record["bid_q"], record["bid_p"], record["ask_q"], record["ask_p"] = tick.depth[0]
+            record["seq"] += 1
+
+        self.update_bars(feed.candles, feed.received_at)
+
+    def update_bars(self, candles: Iterable[CandleRow], received_at: float) -> None:
+        """Applies the candles of the tracked intervals, e.g. the bars aggregated from a frame."""
+        if self._records is None:
+            return
+        records = self._records
+        interval_index = self._interval_index
+
+        for candle in candles:
+            index = interval_index.get(candle.interval)
+            if index is None:
+                continue
+            slot = self._slot(candle.instrument_key)
+            if slot is None:
+                continue
+            record = records[slot]
+            if candle.ts < record["bar_ts"][index]:
+                continue
+            record["seq"] += 1
+            record["updated_at"] = received_at
+            record["bar_ts"][index] = candle.ts
+            record["bar"][index] = (candle.open, candle.high, candle.low, candle.close, candle.volume)
+            record["seq"] += 1
+
+
+def _owner_pid(shm: shared_memory.SharedMemory) -> Optional[int]:
+    """Returns the pid of the writer of an existing block, None if it is not a quote snapshot of this version."""
+    if shm.size < HEADER_DTYPE.itemsize:
+        return None
+    header = np.ndarray((1,), dtype=HEADER_DTYPE, buffer=shm.buf)[0]
+    if int(header["magic"]) != SNAPSHOT_MAGIC or int(header["version"]) != SNAPSHOT_VERSION:
+        return None
+    return int(header["pid"])
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+_quote_snapshot: Optional[QuoteSnapshotWriter] = None
+
+
+def get_quote_snapshot() -> Optional[QuoteSnapshotWriter]:
+    """
+    Returns the shared quote snapshot writer, None when `QUOTE_SNAPSHOT_NAME` is not set. It tracks the
+    `QUOTE_SNAPSHOT_INTERVALS` plus the `AGGREGATE_INTERVALS` and ignores updates until it is opened.
+    """
+    global _quote_snapshot
+    if _quote_snapshot is None and QUOTE_SNAPSHOT_NAME:
+        _quote_snapshot = QuoteSnapshotWriter(
+            intervals=QUOTE_SNAPSHOT_INTERVALS + [i for i in AGGREGATE_INTERVALS if i not in QUOTE_SNAPSHOT_INTERVALS]
+        )
+    return _quote_snapshot
+
+
+class QuoteSnapshotReader:
+    """
+    Reader of the shared memory quote snapshot, for processes running next to the ingest process.
+
+    `get` copies a record and retries while the writer is updating it, so every snapshot is consistent
+    and reading one takes a few microseconds.
+
+    Parameters:
+    - name (str): Name of the shared memory block, see `QUOTE_SNAPSHOT_NAME`.
+    - max_retries (int): Attempts before `get` gives up on a record which is being written.
+
+    Example:
+        reader = QuoteSnapshotReader("upstox_quotes")
+        quote = reader.get("NSE_INDEX|Nifty 50")
+        print(quote.ltp, quote.bars["I1"].close)
+    """
+
+    def __init__(self, name: str = QUOTE_SNAPSHOT_NAME, max_retries: int = 1000):
+        self.name = name
+        self.max_retries = max_retries
+        self._shm = shared_memory.SharedMemory(name=name)
+        # Readers must not unlink the block when they exit, it is owned by the writer
+        resource_tracker.unregister(self._shm._name, "shared_memory")
+        self._header, self._records = _layout(self._shm.buf)
+        if int(self._header["magic"]) != SNAPSHOT_MAGIC or int(self._header["version"]) != SNAPSHOT_VERSION:
+            self.close()
+            raise ValueError(f"Shared memory block '{name}' is not a quote snapshot of version {SNAPSHOT_VERSION}")
+        n_intervals = int(self._header["n_intervals"])
+        self.intervals = [interval.decode() for interval in self._header["intervals"][:n_intervals]]
+        self._slots: Dict[str, int] = {}
+
+    def __enter__(self) -> "QuoteSnapshotReader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._shm is not None:
+            self._header = self._records = None
+            self._shm.close()
+            self._shm = None
+
+    def _refresh_slots(self) -> None:
+        count = int(self._header["count"])
+        for slot in range(len(self._slots), count):
+            self._slots[self._records[slot]["key"].decode()] = slot
+
+    def keys(self) -> List[str]:
+        """Returns the instrument keys present in the snapshot."""
+        self._refresh_slots()
+        return list(self._slots)
+
+    def get(self, instrument_key: str) -> Optional[QuoteSnapshot]:
+        """
+        Returns a consistent snapshot of an instrument, or None when it has not been seen yet or was
+        unsubscribed.
+
+        Raises:
+        - TimeoutError: If the record was being written during all `max_retries` attempts.
+        """
+        slot = self._slots.get(instrument_key)
+        if slot is None:
+            self._refresh_slots()
+            slot = self._slots.get(instrument_key)
+            if slot is None:
+                return None
+
+        record = self._records[slot:slot + 1]
+        for _ in range(self.max_retries):
+            seq = int(record["seq"][0])
+            if seq & 1:
+                continue
+            copy = record.copy()[0]
+            if int(record["seq"][0]) == seq:
+                if not copy["updated_at"]:
+                    return None
+                return self._to_snapshot(instrument_key, copy)
+        raise TimeoutError(f"Snapshot of '{instrument_key}' was being written during {self.max_retries} attempts")
+
+    def get_many(self, instrument_keys: Iterable[str]) -> Dict[str, QuoteSnapshot]:
+        """Returns the snapshots of several instruments, instruments not seen yet are left out."""
+        snapshots = {}
+        for instrument_key in instrument_keys:
+            snapshot = self.get(instrument_key)
+            if snapshot is not None:
+                snapshots[instrument_key] = snapshot
+        return snapshots
+
+    def _to_snapshot(self, instrument_key: str, record) -> QuoteSnapshot:
+        bars = {}
+        for interval, ts, (o, h, l, c, v) in zip(self.intervals, record["bar_ts"].tolist(), record["bar"].tolist()):
+            if ts:
+                bars[interval] = CandleRow(instrument_key, interval, o, h, l, c, int(v), ts)
+        return QuoteSnapshot(
+            instrument_key,
+            float(record["updated_at"]),
+            float(record["ltp"]),
+            int(record["ltt"]),
+            int(record["ltq"]),
+            float(record["cp"]),
+            float(record["bid_p"]),
+            int(record["bid_q"]),
+            float(record["ask_p"]),
+            int(record["ask_q"]),
+            bars,
+        )
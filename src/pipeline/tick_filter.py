@@ -0,0 +1,97 @@
+import os
+from typing import Dict, Iterable, List, Tuple
+
+from v3.decoder import CAPTURE_DEPTH, DecodedFeed, TickRow
+
+# Write ticks (LTPC, market level, OI/IV and greeks) to the `tick` measurement
+CAPTURE_TICKS = os.getenv("CAPTURE_TICKS", "False").lower() == "true"
+# Minimum time between two ticks (and depth snapshots) written for the same instrument, 0 writes every change
+TICK_THROTTLE_MS = int(os.getenv("TICK_THROTTLE_MS", 1000))
+
+
+class TickThrottle:
+    """
+    Per instrument throttle of the ticks written to InfluxDB.
+
+    Every frame carries one tick per instrument, which would multiply the write volume. A tick is
+    passed through when it differs from the last one written for its instrument and at least
+    `interval_ms` passed since then, measured on the feed's own clock (`current_ts` of the frame).
+    The latest tick dropped in between is held back and written, with its own timestamp, once the
+    interval expired without a newer change (checked against the newest frame of each call), so the
+    last value of an instrument that stops moving is not lost. Held back ticks are returned by
+    `pending` and `discard`, e.g. to write them on shutdown.
+
+    Parameters:
+    - interval_ms (int): Minimum time between two ticks of the same instrument.
+    """
+
+    def __init__(self, interval_ms: int = TICK_THROTTLE_MS):
+        self.interval_ms = interval_ms
+        # instrument -> (last written tick, its timestamp)
+        self._last: Dict[str, Tuple[TickRow, int]] = {}
+        # instrument -> (timestamp, latest dropped tick) which differs from the last written one
+        self._held: Dict[str, Tuple[int, TickRow]] = {}
+        self.received = 0
+        self.emitted = 0
+
+    def __len__(self) -> int:
+        return len(self._last)
+
+    def discard(self, instrument_keys: Iterable[str]) -> List[Tuple[int, TickRow]]:
+        """
+        Forgets the last written ticks of instruments which are no longer subscribed.
+
+        Returns:
+        - list: The (timestamp, tick) pairs held back for these instruments, so their last values are not lost.
+        """
+        held = []
+        for instrument_key in instrument_keys:
+            self._last.pop(instrument_key, None)
+            pair = self._held.pop(instrument_key, None)
+            if pair is not None:
+                held.append(pair)
+        return held
+
+    def filter(self, feeds: Iterable[DecodedFeed]) -> List[Tuple[int, TickRow]]:
+        """
+        Returns the (timestamp, tick) pairs of `feeds` which have to be written, in order, followed by
+        the held back ticks whose interval expired.
+
+        Parameters:
+        - feeds (Iterable[DecodedFeed]): Decoded frames in arrival order.
+        """
+        last = self._last
+        held = self._held
+        interval_ms = self.interval_ms
+        out = []
+        ts = None
+        for feed in feeds:
+            ts = feed.current_ts
+            for tick in feed.ticks:
+                self.received += 1
+                key = tick.instrument_key
+                previous = last.get(key)
+                if previous is not None:
+                    if tick == previous[0]:
+                        # Back at the written values, nothing is left to write
+                        held.pop(key, None)
+                        continue
+                    if ts - previous[1] < interval_ms:
+                        held[key] = (ts, tick)
+                        continue
+                    held.pop(key, None)
+                last[key] = (tick, ts)
+                out.append((ts, tick))
+
+        if held and ts is not None:
+            expired = [key for key, (held_ts, _) in held.items() if ts - last[key][1] >= interval_ms]
+            for key in expired:
+                held_ts, tick = held.pop(key)
+                last[key] = (tick, held_ts)
+                out.append((held_ts, tick))
+        self.emitted += len(out)
+        return out
+
+    def pending(self) -> List[Tuple[int, TickRow]]:
+        """Returns the held back (timestamp, tick) pairs which were not written yet, e.g. to flush them on shutdown."""
+        return list(self._held.values())
@@ -1,3 +1,4 @@
 from .access_token_util import fetch_token
 from .utils import convert_datetime_to_influxdb_string, is_influxdb_online
-from .data_transfer_intimation import monitor_data_transfer
\ No newline at end of file
+from .data_transfer_intimation import monitor_data_transfer
+from .instrument_master import InstrumentMaster
@@ -0,0 +1,201 @@
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+import requests
+
+from .utils import UPSTOX_INSTRUMENTS_URL
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENT_CACHE_DIR = os.getenv("INSTRUMENT_CACHE_DIR", "instrument_cache")
+INSTRUMENT_CACHE_MAX_AGE_HOURS = float(os.getenv("INSTRUMENT_CACHE_MAX_AGE_HOURS", 24))
+
+INDEX_FILE_NAME = "trade_symbols.npy"
+META_FILE_NAME = "meta.json"
+
+
+class InstrumentMaster:
+    """
+    On-disk cache of the Upstox instrument master, reduced to an instrument key -> trade symbol index.
+
+    The index is stored as a NumPy structured array of fixed width byte strings sorted by instrument
+    key and memory-mapped on load, so lookups are a binary search over the mapped file and a restart
+    does no network or JSON work. The master is only downloaded synchronously when no cache exists;
+    once the cache is older than `max_age_hours` it is refreshed in a background thread with a
+    conditional request (ETag / Last-Modified) and swapped in atomically.
+
+    Parameters:
+    - cache_dir (str): Directory holding the index and its metadata.
+    - url (str): URL of the gzipped instrument master JSON.
+    - max_age_hours (float): Age after which the cache is refreshed.
+    """
+
+    def __init__(self,
+                 cache_dir: str = INSTRUMENT_CACHE_DIR,
+                 url: str = UPSTOX_INSTRUMENTS_URL,
+                 max_age_hours: float = INSTRUMENT_CACHE_MAX_AGE_HOURS):
+        self.cache_dir = cache_dir
+        self.url = url
+        self.max_age = max_age_hours * 3600
+        self.version = 0
+
+        self._index: Optional[np.ndarray] = None
+        self._meta: dict = {}
+        self._load_lock = threading.RLock()
+        self._refreshing = threading.Event()
+        self._listeners: List[Callable[[], None]] = []
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.cache_dir, INDEX_FILE_NAME)
+
+    @property
+    def meta_path(self) -> str:
+        return os.path.join(self.cache_dir, META_FILE_NAME)
+
+    @property
+    def is_stale(self) -> bool:
+        return time.time() - self._meta.get("fetched_at", 0) > self.max_age
+
+    def add_listener(self, callback: Callable[[], None]) -> None:
+        """Registers a callback invoked (from the refresh thread) whenever a new index is swapped in."""
+        self._listeners.append(callback)
+
+    def load(self) -> "InstrumentMaster":
+        """
+        Memory-maps the cached index, downloading the master first if there is no cache yet.
+        A background refresh is started if the cache is stale.
+        """
+        with self._load_lock:
+            if self._index is None:
+                if os.path.exists(self.index_path) and os.path.exists(self.meta_path):
+                    self._map_index()
+                    logger.info(f"Loaded {len(self._index)} instruments from cache {self.index_path}.")
+                else:
+                    logger.info("No instrument master cache found. Downloading instrument master.")
+                    self.refresh()
+
+        if self.is_stale:
+            self.refresh_in_background()
+        return self
+
+    def _map_index(self) -> None:
+        with open(self.meta_path) as f:
+            self._meta = json.load(f)
+        self._index = np.load(self.index_path, mmap_mode="r")
+        self.version += 1
+
+    def _write_index(self, instruments: list, meta: dict) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        pairs = sorted(
+            (item["instrument_key"].encode("utf-8"), (item.get("trading_symbol") or "").encode("utf-8"))
+            for item in instruments
+            if item.get("instrument_key")
+        )
+        key_width = max((len(key) for key, _ in pairs), default=1)
+        symbol_width = max((len(symbol) for _, symbol in pairs), default=1)
+        index = np.array(pairs, dtype=[("key", f"S{key_width}"), ("symbol", f"S{symbol_width}")])
+
+        # Write next to the live files and swap atomically, readers keep their old mapping
+        tmp_index = self.index_path + ".tmp"
+        with open(tmp_index, "wb") as f:
+            np.save(f, index)
+        tmp_meta = self.meta_path + ".tmp"
+        with open(tmp_meta, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_index, self.index_path)
+        os.replace(tmp_meta, self.meta_path)
+
+    def _write_meta(self, meta: dict) -> None:
+        tmp_meta = self.meta_path + ".tmp"
+        with open(tmp_meta, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_meta, self.meta_path)
+
+    def refresh(self) -> bool:
+        """
+        Downloads the instrument master if it changed since the cached copy.
+
+        Returns:
+        - bool: True if a new index was swapped in, False if the cached copy is still current.
+        """
+        headers = {}
+        with self._load_lock:
+            cached_meta = self._meta if self._index is not None else {}
+        if cached_meta.get("etag"):
+            headers["If-None-Match"] = cached_meta["etag"]
+        if cached_meta.get("last_modified"):
+            headers["If-Modified-Since"] = cached_meta["last_modified"]
+
+        response = requests.get(self.url, headers=headers, timeout=60)
+        if response.status_code == 304:
+            # Swapped in as a new dict, `is_stale` reads `_meta` without the lock
+            with self._load_lock:
+                self._meta = dict(self._meta, fetched_at=time.time())
+                self._write_meta(self._meta)
+            logger.info("Instrument master not modified, cache is current.")
+            return False
+        response.raise_for_status()
+
+        instruments = json.loads(gzip.decompress(response.content))
+        meta = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        }
+        self._write_index(instruments, meta)
+
+        with self._load_lock:
+            self._map_index()
+        logger.info(f"Instrument master refreshed with {len(self._index)} instruments.")
+
+        for callback in self._listeners:
+            callback()
+        return True
+
+    def refresh_in_background(self) -> None:
+        """Starts a conditional refresh in a daemon thread unless one is already running."""
+        if self._refreshing.is_set():
+            return
+        self._refreshing.set()
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Refreshing the instrument master failed, keeping the cached copy: {e}")
+            finally:
+                self._refreshing.clear()
+
+        threading.Thread(target=run, name="instrument-master-refresh", daemon=True).start()
+
+    def get(self, instrument_key: str, default: Optional[str] = None) -> Optional[str]:
+        """Returns the trade symbol of the instrument key, `default` if it is unknown."""
+        index = self._index
+        if index is None:
+            index = self.load()._index
+        elif self.is_stale:
+            self.refresh_in_background()
+
+        keys = index["key"]
+        key = instrument_key.encode("utf-8")
+        position = int(np.searchsorted(keys, key))
+        if position < len(keys) and keys[position] == key:
+            symbol = index["symbol"][position]
+            if symbol:
+                return symbol.decode("utf-8")
+        return default
+
+    def __getitem__(self, instrument_key: str) -> str:
+        symbol = self.get(instrument_key)
+        if symbol is None:
+            raise KeyError(instrument_key)
+        return symbol
+
@@ -1 +1,2 @@
-from .websocket_client import fetch_market_data
\ No newline at end of file
+from .websocket_client import fetch_market_data
+from .connection_manager import ShardedFeedManager
@@ -0,0 +1,352 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote
+
+import aiohttp
+
+from .decoder import CandleRow, DecodedFeed
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Source of missed bars after a reconnect: empty disables backfill, 'upstox' uses the historical
+# candle API, 'file:<directory>' reads candle files (see `FileCandleSource`)
+BACKFILL_SOURCE = os.getenv("BACKFILL_SOURCE", "")
+# Backfill requests per second, shared by all instruments
+BACKFILL_RATE_LIMIT = float(os.getenv("BACKFILL_RATE_LIMIT", 2))
+# Longest gap (in bars) which is backfilled, older bars are left out
+BACKFILL_MAX_BARS = int(os.getenv("BACKFILL_MAX_BARS", 375))
+# File the last acknowledged I1 bar per instrument is kept in, so gaps spanning a restart are found
+# as well. Empty keeps them in memory only
+BACKFILL_STATE_PATH = os.getenv("BACKFILL_STATE_PATH", os.path.join("sqlite_db", "backfill_last_bars.json"))
+BACKFILL_STATE_SAVE_INTERVAL = float(os.getenv("BACKFILL_STATE_SAVE_INTERVAL", 5))
+UPSTOX_HISTORICAL_URL = os.getenv("UPSTOX_HISTORICAL_URL", "https://api.upstox.com/v3/historical-candle")
+
+BACKFILL_INTERVAL = "I1"
+BAR_MS = 60_000
+IST = timezone(timedelta(hours=5, minutes=30))
+
+GAPS = REGISTRY.counter("backfill_gaps_total", "Per instrument gaps of missed I1 bars detected on reconnect.")
+GAP_BARS = REGISTRY.counter("backfill_gap_bars_total", "I1 bars missed during disconnects and requested, at most BACKFILL_MAX_BARS per gap.")
+BACKFILLED_BARS = REGISTRY.counter("backfill_bars_total", "Bars fetched from the backfill source and queued for writing.")
+BACKFILL_ERRORS = REGISTRY.counter("backfill_errors_total", "Backfill requests which failed.")
+BACKFILL_PENDING = REGISTRY.gauge("backfill_pending_instruments", "Instruments waiting to be backfilled.")
+
+
+class BackfillFeed(NamedTuple):
+    """
+    I1 bars fetched for the gap of one instrument, put on the ingest queue next to the live frames so
+    they are written by the same batched writer (and aggregated and fanned out to the sinks).
+    """
+    instrument_key: str
+    # Gap range, see `find_gaps`
+    start_ts: int
+    end_ts: int
+    received_at: float
+    candles: List[CandleRow]
+    ticks: Tuple = ()
+
+    @property
+    def type(self) -> str:
+        return "backfill"
+
+    @property
+    def current_ts(self) -> int:
+        return self.end_ts
+
+    @property
+    def nbytes(self) -> int:
+        return 128 * len(self.candles)
+
+
+class PersistedBars:
+    """
+    Latest I1 bar ts per instrument acknowledged by InfluxDB, the start of the gaps detected after a
+    reconnect (see `find_gaps`). Updated by the writer once a batch was written completely, so bars
+    which were received but lost with a failed or unfinished write are backfilled as well.
+
+    With a `path`, the bars are saved at most every `save_interval` seconds and loaded again on start,
+    so an outage spanning a restart is backfilled too. Bars older than `max_age_ms` are not loaded, a
+    gap starting before them would be cut to `BACKFILL_MAX_BARS` anyway and mostly covers the hours
+    the market was closed. What was acknowledged after the last save is backfilled again.
+
+    Parameters:
+    - path (str): JSON file the bars are kept in, empty keeps them in memory only.
+    - save_interval (float): Minimum number of seconds between two saves.
+    - max_age_ms (int): Maximum age of the loaded bars.
+    """
+
+    def __init__(self, path: str = BACKFILL_STATE_PATH, save_interval: float = BACKFILL_STATE_SAVE_INTERVAL,
+                 max_age_ms: int = BACKFILL_MAX_BARS * BAR_MS):
+        self.path = path
+        self.save_interval = save_interval
+        self.last_ts: Dict[str, int] = self._load(max_age_ms)
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def _load(self, max_age_ms: int) -> Dict[str, int]:
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as f:
+                last_ts = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load the last written bars from {self.path}, gaps before the restart are not backfilled :: {e}")
+            return {}
+        oldest = time.time() * 1000 - max_age_ms
+        return {instrument_key: int(ts) for instrument_key, ts in last_ts.items() if ts >= oldest}
+
+    def update(self, candles: Iterable[CandleRow]) -> None:
+        last_ts = self.last_ts
+        for candle in candles:
+            if candle.interval == BACKFILL_INTERVAL and candle.ts > last_ts.get(candle.instrument_key, 0):
+                last_ts[candle.instrument_key] = candle.ts
+                self._dirty = True
+        if self._dirty and time.monotonic() - self._saved_at >= self.save_interval:
+            self.save()
+
+    def discard(self, instrument_keys) -> None:
+        """Forgets the last bars of unsubscribed instruments, so a later subscription is not taken for a gap."""
+        for instrument_key in instrument_keys:
+            if self.last_ts.pop(instrument_key, None) is not None:
+                self._dirty = True
+
+    def save(self) -> None:
+        """Writes the bars to `path` if they changed since the last save, e.g. on shutdown."""
+        if not self.path or not self._dirty:
+            return
+        self._saved_at = time.monotonic()
+        tmp_path = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump(self.last_ts, f)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as e:
+            logger.warning(f"Could not save the last written bars to {self.path} :: {e}")
+
+
+_persisted_bars: Optional[PersistedBars] = None
+
+
+def get_persisted_bars() -> PersistedBars:
+    """Returns the process wide `PersistedBars`, shared by the writer and the websocket connections."""
+    global _persisted_bars
+    if _persisted_bars is None:
+        _persisted_bars = PersistedBars()
+    return _persisted_bars
+
+
+def find_gaps(last_bar_ts: Dict[str, int], snapshot: DecodedFeed) -> List[Tuple[str, int, int]]:
+    """
+    Compares the I1 candles of the snapshot received after a (re)subscription with the last bar
+    written per instrument before the disconnect (see `PersistedBars`).
+
+    Returns:
+    - list: (instrument_key, start_ts, end_ts) per instrument with at least one whole bar missing. The
+      range starts at the last seen bar, whose final values were missed as well, and ends before the
+      bar of the snapshot.
+    """
+    gaps = []
+    for candle in snapshot.candles:
+        if candle.interval != BACKFILL_INTERVAL:
+            continue
+        last_ts = last_bar_ts.get(candle.instrument_key)
+        if last_ts is not None and candle.ts - last_ts > BAR_MS:
+            gaps.append((candle.instrument_key, last_ts, candle.ts))
+    return gaps
+
+
+def parse_candles(instrument_key: str, payload: dict, start_ts: int, end_ts: int) -> List[CandleRow]:
+    """
+    Converts a historical candle response (`{"data": {"candles": [[timestamp, open, high, low, close,
+    volume, oi], ...]}}`) into the I1 `CandleRow`s in [start_ts, end_ts), oldest first.
+    """
+    rows = []
+    for candle in (payload.get("data") or {}).get("candles") or []:
+        ts = int(datetime.fromisoformat(candle[0]).timestamp() * 1000)
+        if start_ts <= ts < end_ts:
+            rows.append(CandleRow(instrument_key, BACKFILL_INTERVAL, float(candle[1]), float(candle[2]),
+                                  float(candle[3]), float(candle[4]), int(candle[5]), ts))
+    rows.sort(key=lambda row: row.ts)
+    return rows
+
+
+class UpstoxCandleSource:
+    """
+    Fetches missed I1 bars from the Upstox v3 historical candle API, the intraday endpoint for the
+    current day and the historical endpoint for earlier days.
+
+    Parameters:
+    - access_token (callable): Coroutine function returning the current access token.
+    - base_url (str): Historical candle API root.
+    """
+
+    def __init__(self, access_token: Callable[[], Awaitable[str]], base_url: str = UPSTOX_HISTORICAL_URL):
+        self.access_token = access_token
+        self.base_url = base_url.rstrip("/")
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    async def _get(self, url: str) -> dict:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        headers = {"Accept": "application/json", "Authorization": f"Bearer {await self.access_token()}"}
+        async with self._session.get(url, headers=headers) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def fetch(self, instrument_key: str, start_ts: int, end_ts: int) -> List[CandleRow]:
+        key = quote(instrument_key, safe="")
+        today = datetime.now(IST).date()
+        first_day = datetime.fromtimestamp(start_ts / 1000, IST).date()
+        candles = []
+        if first_day < today:
+            last_day = min(today - timedelta(days=1), datetime.fromtimestamp(end_ts / 1000, IST).date())
+            payload = await self._get(f"{self.base_url}/{key}/minutes/1/{last_day.isoformat()}/{first_day.isoformat()}")
+            candles.extend(parse_candles(instrument_key, payload, start_ts, end_ts))
+        if datetime.fromtimestamp(end_ts / 1000, IST).date() >= today:
+            payload = await self._get(f"{self.base_url}/intraday/{key}/minutes/1")
+            candles.extend(parse_candles(instrument_key, payload, start_ts, end_ts))
+        return candles
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+
+
+class FileCandleSource:
+    """
+    Reads missed bars from `<directory>/<instrument_key>.json` ('|' replaced by '_'), in the format of
+    the historical candle API response. Meant for tests and for replaying exported data.
+
+    Parameters:
+    - directory (str): Directory of the candle files.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _read(self, instrument_key: str) -> dict:
+        path = os.path.join(self.directory, f"{instrument_key.replace('|', '_')}.json")
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    async def fetch(self, instrument_key: str, start_ts: int, end_ts: int) -> List[CandleRow]:
+        payload = await asyncio.get_running_loop().run_in_executor(None, self._read, instrument_key)
+        return parse_candles(instrument_key, payload, start_ts, end_ts)
+
+    async def close(self) -> None:
+        pass
+
+
+class Backfiller:
+    """
+    Fetches the bars missed during a disconnect from a `source` and hands them to `put` as a
+    `BackfillFeed` per instrument, usually the `put` of the ingest queue.
+
+    Gaps are queued per instrument (overlapping requests of the same instrument are merged) and
+    worked off by one background task at no more than `rate_limit` source requests per second, so
+    the live stream is never waited on. Gaps longer than `max_bars` are cut to their most recent bars.
+
+    Parameters:
+    - source: Object with `async fetch(instrument_key, start_ts, end_ts) -> List[CandleRow]` and `async close()`.
+    - put (callable): Coroutine function taking a `BackfillFeed`, e.g. the ingest queue's `put`.
+    - rate_limit (float): Maximum source requests per second.
+    - max_bars (int): Maximum number of bars backfilled per gap.
+    """
+
+    def __init__(self, source, put: Callable[[Any], Awaitable[None]],
+                 rate_limit: float = BACKFILL_RATE_LIMIT, max_bars: int = BACKFILL_MAX_BARS):
+        self.source = source
+        self.put = put
+        self.interval = 1 / rate_limit if rate_limit > 0 else 0
+        self.max_bars = max_bars
+        self._pending: Dict[str, Tuple[int, int]] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        BACKFILL_PENDING.set_function(lambda: len(self._pending))
+
+    def submit(self, gaps: List[Tuple[str, int, int]]) -> None:
+        """Queues (instrument_key, start_ts, end_ts) gaps, see `find_gaps`."""
+        for instrument_key, start_ts, end_ts in gaps:
+            GAPS.inc()
+            start_ts = max(start_ts, end_ts - self.max_bars * BAR_MS)
+            GAP_BARS.inc((end_ts - start_ts) // BAR_MS - 1)
+            pending = self._pending.get(instrument_key)
+            if pending is not None:
+                start_ts, end_ts = min(start_ts, pending[0]), max(end_ts, pending[1])
+            self._pending[instrument_key] = (start_ts, end_ts)
+        if gaps:
+            logger.info(f"Detected missed bars of {len(gaps)} instruments :: {len(self._pending)} instruments pending backfill")
+            self._wakeup.set()
+
+    def start(self) -> "Backfiller":
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        return self
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.source.close()
+
+    async def _run(self) -> None:
+        next_request_at = 0.0
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            delay = next_request_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_request_at = time.monotonic() + self.interval
+
+            instrument_key = next(iter(self._pending))
+            start_ts, end_ts = self._pending.pop(instrument_key)
+            try:
+                candles = await self.source.fetch(instrument_key, start_ts, end_ts)
+                if candles:
+                    await self.put(BackfillFeed(instrument_key, start_ts, end_ts, time.time(), candles))
+                    BACKFILLED_BARS.inc(len(candles))
+                logger.debug(f"Backfilled {len(candles)} bars of {instrument_key}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                BACKFILL_ERRORS.inc()
+                logger.warning(f"Backfilling {instrument_key} from {start_ts} to {end_ts} failed :: {e}")
+
+
+def create_backfill_source(spec: str = BACKFILL_SOURCE, access_token: Optional[Callable[[], Awaitable[str]]] = None):
+    """
+    Creates the backfill source of `spec` ('upstox' or 'file:<directory>'), None if `spec` is empty.
+
+    Parameters:
+    - spec (str): Source specification, see `BACKFILL_SOURCE`.
+    - access_token (callable, optional): Coroutine function returning the access token, required by 'upstox'.
+    """
+    if not spec:
+        return None
+    if spec == "upstox":
+        if access_token is None:
+            raise ValueError("The 'upstox' backfill source needs an access token")
+        return UpstoxCandleSource(access_token)
+    if spec.startswith("file:"):
+        return FileCandleSource(spec[len("file:"):])
+    raise ValueError(f"Unknown backfill source '{spec}', expected 'upstox' or 'file:<directory>'")
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+import time
+import zlib
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from .backfill import Backfiller
+from .credentials import CredentialManager
+from .subscriptions import Watchlist
+from .decode_pool import DecodePool
+from .frame_recorder import FrameRecorder
+from .websocket_client import FeedStats, get_instruments, run_feed_connection
+
+logger = logging.getLogger(__name__)
+
+SHARD_STATS_INTERVAL = float(os.getenv("SHARD_STATS_INTERVAL", 60))
+SHARD_RESTART_DELAY = float(os.getenv("SHARD_RESTART_DELAY", 5))
+
+
+def partition_instruments(instruments: List[str], shards: int) -> List[List[str]]:
+    """
+    Partitions instruments across shards by a hash of their key, so that every instrument stays on
+    its shard regardless of the order of the list and of instruments being added or removed.
+    """
+    partitions = [[] for _ in range(shards)]
+    for instrument_key in sorted(set(instruments)):
+        partitions[zlib.crc32(instrument_key.encode()) % shards].append(instrument_key)
+    return partitions
+
+
+class ShardedFeedManager:
+    """
+    Runs the market data feed over several websocket connections.
+
+    The instrument list is partitioned across `shards` connections which all feed the same queue.
+    Each shard authorizes, connects and reconnects on its own; a shard failing with an unexpected
+    error is restarted after `SHARD_RESTART_DELAY` seconds without affecting the other shards.
+    Per shard message rate, feed lag and connection count are logged every `SHARD_STATS_INTERVAL`
+    seconds.
+
+    Parameters:
+    - q (asyncio.Queue): The queue where decoded market data of every shard will be placed.
+    - shards (int): Number of websocket connections.
+    - instruments_getter (coroutine function): Returns the full instrument list, awaited on every (re)connect.
+    - decode_pool (DecodePool, optional): Shared pool decoding the frames of every shard.
+    - recorder (FrameRecorder, optional): Shared recorder of the raw frames of every shard.
+    - credentials (CredentialManager, optional): Shared token and authorization cache of every shard.
+    - backfiller (Backfiller, optional): Shared backfill of the bars missed by any shard.
+    - watchlist (Watchlist, optional): Desired subscription set, every shard applies the changes of its
+      partition on its live socket.
+    """
+
+    def __init__(self, q: asyncio.Queue, shards: int, instruments_getter: Callable[[], Awaitable[List[str]]] = get_instruments,
+                 decode_pool: Optional[DecodePool] = None, recorder: Optional[FrameRecorder] = None,
+                 credentials: Optional[CredentialManager] = None, backfiller: Optional[Backfiller] = None,
+                 watchlist: Optional[Watchlist] = None):
+        self.q = q
+        self.decode_pool = decode_pool
+        self.recorder = recorder
+        self.credentials = credentials
+        self.backfiller = backfiller
+        self.watchlist = watchlist
+        self.shards = shards
+        self.instruments_getter = instruments_getter
+        self.stats: Dict[int, FeedStats] = {shard: FeedStats(name=f"shard-{shard}") for shard in range(shards)}
+
+    async def shard_instruments(self, shard: int) -> List[str]:
+        return partition_instruments(await self.instruments_getter(), self.shards)[shard]
+
+    async def run_shard(self, shard: int) -> None:
+        """Runs one shard forever, restarting it whenever its connection loop fails."""
+        stats = self.stats[shard]
+        while True:
+            try:
+                await run_feed_connection(
+                    q=self.q,
+                    instruments_getter=lambda: self.shard_instruments(shard),
+                    stats=stats,
+                    name=stats.name,
+                    decode_pool=self.decode_pool,
+                    recorder=self.recorder,
+                    credentials=self.credentials,
+                    backfiller=self.backfiller,
+                    watchlist=self.watchlist,
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"{stats.name} stopped :: {e} :: Restarting in {SHARD_RESTART_DELAY}s")
+                await asyncio.sleep(SHARD_RESTART_DELAY)
+
+    async def report_stats(self) -> None:
+        previous = {shard: 0 for shard in self.stats}
+        previous_time = time.monotonic()
+        while True:
+            await asyncio.sleep(SHARD_STATS_INTERVAL)
+            now = time.monotonic()
+            elapsed = now - previous_time
+            for shard, stats in self.stats.items():
+                rate = (stats.messages - previous[shard]) / elapsed
+                previous[shard] = stats.messages
+                lag = f"{stats.lag_ms:.0f} ms" if stats.lag_ms is not None else "n/a"
+                logger.info(
+                    f"{stats.name} :: {rate:.1f} msg/s :: lag : {lag} :: "
+                    f"messages : {stats.messages} :: connections : {stats.connections}"
+                )
+            previous_time = now
+
+    async def run(self) -> None:
+        logger.info(f"Starting {self.shards} websocket shards.")
+        await asyncio.gather(
+            *(self.run_shard(shard) for shard in range(self.shards)),
+            self.report_stats(),
+        )
@@ -0,0 +1,247 @@
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import os
+import time
+from typing import Optional, Tuple
+
+import aiohttp
+
+from utils import fetch_token
+
+logger = logging.getLogger(__name__)
+
+FETCH_TOKEN_API = os.getenv("API_FETCH_TOKEN", None)
+ACCESS_TOKEN = os.getenv("ACCESS_TOKEN", None)
+# Market data feed authorize endpoint, point it to `feed_server_mock` to run against a local feed
+UPSTOX_AUTHORIZE_URL = os.getenv("UPSTOX_AUTHORIZE_URL", "https://api.upstox.com/v3/feed/market-data-feed/authorize")
+# Seconds before its expiry a fetched access token is replaced
+CREDENTIAL_REFRESH_MARGIN = float(os.getenv("CREDENTIAL_REFRESH_MARGIN", 300))
+# Lifetime assumed for fetched access tokens which do not carry an expiry
+ACCESS_TOKEN_TTL = float(os.getenv("ACCESS_TOKEN_TTL", 6 * 3600))
+# Seconds a prefetched authorized websocket URI is used for, 0 authorizes on every connect
+AUTHORIZED_URI_TTL = float(os.getenv("AUTHORIZED_URI_TTL", 60))
+CREDENTIAL_RETRY_DELAY = 5
+AUTHORIZE_TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+
+class InvalidTokenError(Exception):
+    """Raised when the API indicates the access token is invalid or expired."""
+    pass
+
+
+def token_expiry(access_token: str) -> Optional[float]:
+    """
+    Returns the expiry (unix seconds) of a JWT access token from its `exp` claim, None if the token
+    does not carry one. The signature is not verified, the value is only used to schedule refreshes.
+    """
+    try:
+        payload = access_token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        expires_at = claims.get("exp")
+        return float(expires_at) if expires_at else None
+    except (AttributeError, IndexError, TypeError, ValueError, binascii.Error):
+        return None
+
+
+async def get_market_data_feed_authorize_v3(access_token: str, session: Optional[aiohttp.ClientSession] = None,
+                                            url: str = UPSTOX_AUTHORIZE_URL) -> dict:
+    """Get authorization for market data feed.
+
+    Raises
+    ------
+    InvalidTokenError
+        If the API responds with status "error" and error_code "UDAPI100050".
+    aiohttp.ClientError
+        If the request fails or the response is neither JSON nor successful.
+    """
+    headers = {
+        'Accept': 'application/json',
+        'Authorization': f'Bearer {access_token}'
+    }
+    if session is None:
+        async with aiohttp.ClientSession(timeout=AUTHORIZE_TIMEOUT) as session:
+            return await get_market_data_feed_authorize_v3(access_token, session, url)
+
+    async with session.get(url, headers=headers) as api_response:
+        # Parse and handle potential error response structure
+        try:
+            payload = await api_response.json(content_type=None)
+        except ValueError:
+            # If not JSON, raise with HTTP status context
+            api_response.raise_for_status()
+            # If no exception raised by raise_for_status, rethrow a generic error
+            raise Exception("Unexpected non-JSON response from authorize endpoint.")
+
+    # Handle error structure: {"status": "error", "errors": [{"error_code": "...", "message": "..."}]}
+    if isinstance(payload, dict) and payload.get("status") == "error":
+        errors = payload.get("errors") or []
+        for err in errors:
+            if isinstance(err, dict) and err.get("error_code") == "UDAPI100050":
+                message = err.get("message") or "Invalid or expired access token."
+                raise InvalidTokenError(message)
+        # For other errors, raise a generic exception including first error message if present
+        if errors:
+            raise Exception(errors[0].get("message") if isinstance(errors[0], dict) else "Authorization failed with error status.")
+        raise Exception("Authorization failed with error status.")
+
+    return payload
+
+
+class CredentialManager:
+    """
+    Caches the access token and an authorized websocket URI and refreshes them ahead of time.
+
+    Connecting used to fetch a token and call the authorize endpoint first, which took several
+    seconds on every reconnect. The manager keeps both ready instead:
+    - The access token is taken from `ACCESS_TOKEN` or fetched from `API_FETCH_TOKEN`. A fetched token
+      is replaced `refresh_margin` seconds before it expires (from its JWT `exp` claim, else after
+      `token_ttl`) and whenever it was rejected (`invalidate_token`).
+    - An authorized URI is prefetched in the background once a connection dropped (`prefetch_uri`),
+      during the reconnect delay. The reconnect's `authorized_uri` awaits that prefetch instead of
+      authorizing again, so every reconnect makes one authorize call. Every URI is handed out once and
+      a stale or failed one is authorized again on demand; while connected, nothing but the token is
+      refreshed.
+
+    All HTTP calls are made with aiohttp on the running loop and share one session. Without `start`,
+    nothing is prefetched and `authorized_uri` authorizes on demand.
+
+    Parameters:
+    - access_token (str, optional): Static access token.
+    - token_url (str, optional): URL to fetch the access token from, see `fetch_token`.
+    - authorize_url (str): Market data feed authorize endpoint.
+    - refresh_margin (float): Seconds before its expiry a fetched token is replaced.
+    - token_ttl (float): Lifetime of fetched tokens without an `exp` claim.
+    - authorize_ttl (float): Seconds a prefetched URI is used for, 0 disables prefetching.
+    """
+
+    def __init__(self, access_token: Optional[str] = ACCESS_TOKEN, token_url: Optional[str] = FETCH_TOKEN_API,
+                 authorize_url: str = UPSTOX_AUTHORIZE_URL, refresh_margin: float = CREDENTIAL_REFRESH_MARGIN,
+                 token_ttl: float = ACCESS_TOKEN_TTL, authorize_ttl: float = AUTHORIZED_URI_TTL):
+        if access_token is None and token_url is None:
+            raise Exception(f"Neither access token nor url to fetch is provided. Terminating...")
+        self.token_url = None if access_token is not None else token_url
+        self.authorize_url = authorize_url
+        self.refresh_margin = refresh_margin
+        self.token_ttl = token_ttl
+        self.authorize_ttl = authorize_ttl
+        self._token = access_token
+        self._token_expires_at = token_expiry(access_token) if access_token is not None else None
+        # Authorization started when a connection dropped, resolves to the URI and when it was fetched
+        self._prefetch: Optional[asyncio.Task] = None
+        self._token_lock = asyncio.Lock()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._refresher: Optional[asyncio.Task] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=AUTHORIZE_TIMEOUT)
+        return self._session
+
+    async def start(self) -> "CredentialManager":
+        """Starts refreshing the credentials in the background."""
+        if self._refresher is None and (self.token_url is not None or self.authorize_ttl > 0):
+            self._refresher = asyncio.create_task(self._refresh())
+        return self
+
+    async def close(self) -> None:
+        self._drop_prefetch()
+        if self._refresher is not None:
+            self._refresher.cancel()
+            try:
+                await self._refresher
+            except asyncio.CancelledError:
+                pass
+            self._refresher = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _token_due(self) -> bool:
+        if self._token is None:
+            return True
+        return (self.token_url is not None and self._token_expires_at is not None
+                and time.time() >= self._token_expires_at - self.refresh_margin)
+
+    async def access_token(self) -> str:
+        """Returns the cached access token, fetching a new one if it is missing or about to expire."""
+        async with self._token_lock:
+            if self._token_due():
+                token = await fetch_token(url=self.token_url)
+                self._token = token
+                self._token_expires_at = token_expiry(token) or time.time() + self.token_ttl
+                # URIs authorized with the previous token are not reused
+                if self._prefetch is not None and self._prefetch.done():
+                    self._drop_prefetch()
+                logger.info(f"Access token refreshed, valid until {time.ctime(self._token_expires_at)}.")
+            return self._token
+
+    def invalidate_token(self) -> None:
+        """Drops the cached credentials after the token was rejected, a fetched token is fetched again."""
+        self._drop_prefetch()
+        if self.token_url is not None:
+            self._token = None
+        self.prefetch_uri()
+
+    def prefetch_uri(self) -> None:
+        """Starts authorizing a URI in the background for an upcoming reconnect, see `authorized_uri`."""
+        if self._refresher is None or self.authorize_ttl <= 0:
+            return
+        if self._prefetch is not None and not self._prefetch.done():
+            return
+        self._prefetch = asyncio.create_task(self._prefetch_uri())
+        self._prefetch.add_done_callback(self._prefetched)
+
+    async def _prefetch_uri(self) -> Tuple[str, float]:
+        uri = await self._authorize()
+        logger.debug("Prefetched authorized websocket URI.")
+        return uri, time.monotonic()
+
+    @staticmethod
+    def _prefetched(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Prefetching the feed authorization failed :: {task.exception()}")
+
+    def _drop_prefetch(self) -> None:
+        if self._prefetch is not None:
+            self._prefetch.cancel()
+            self._prefetch = None
+
+    async def _authorize(self) -> str:
+        payload = await get_market_data_feed_authorize_v3(await self.access_token(), self.session, self.authorize_url)
+        return payload["data"]["authorized_redirect_uri"]
+
+    async def authorized_uri(self) -> str:
+        """
+        Returns an authorized websocket URI. A prefetch started by `prefetch_uri` is awaited and its URI
+        returned if it is still fresh; without one, or when it failed, the URI is authorized now.
+        """
+        prefetch, self._prefetch = self._prefetch, None
+        if prefetch is not None:
+            try:
+                uri, fetched_at = await prefetch
+                if time.monotonic() - fetched_at < self.authorize_ttl:
+                    return uri
+            except Exception:
+                # Logged by `_prefetched`, authorized again below
+                pass
+        return await self._authorize()
+
+    def _next_refresh_in(self) -> float:
+        if self.token_url is not None and self._token_expires_at is not None:
+            return max(0.0, self._token_expires_at - self.refresh_margin - time.time())
+        return 3600.0
+
+    async def _refresh(self) -> None:
+        while True:
+            await asyncio.sleep(self._next_refresh_in())
+            try:
+                await self.access_token()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Refreshing the access token failed :: {e} :: Retrying in {CREDENTIAL_RETRY_DELAY}s")
+                await asyncio.sleep(CREDENTIAL_RETRY_DELAY)
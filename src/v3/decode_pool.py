@@ -0,0 +1,215 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple, Union
+
+from .decoder import CAPTURE_DEPTH, DECODE_TOP_OF_BOOK, DecodedFeed, decode_feed_response
+from pipeline.quote_snapshot import get_quote_snapshot
+from utils.metrics import COUNT_BUCKETS, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Number of decode worker processes, 0 decodes inline on the event loop
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", 0))
+DECODE_CHUNK_SIZE = int(os.getenv("DECODE_CHUNK_SIZE", 64))
+DECODE_CHUNK_WAIT_MS = int(os.getenv("DECODE_CHUNK_WAIT_MS", 5))
+DECODE_MAX_PENDING_CHUNKS = int(os.getenv("DECODE_MAX_PENDING_CHUNKS", 64))
+# Seconds `DecodePool.close` waits for the chunks in flight to be decoded and put into the queue
+DECODE_CLOSE_TIMEOUT = float(os.getenv("DECODE_CLOSE_TIMEOUT", 5))
+# Workers are started from a clean server process instead of forking the event loop process, whose
+# threads (executors, aiosqlite, the Parquet writer) and open sockets must not be copied
+DECODE_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+CHUNK_SECONDS = REGISTRY.histogram("decode_pool_chunk_seconds", "Time from dispatching a chunk of frames to its decoded feeds.")
+CHUNK_FRAMES = REGISTRY.histogram("decode_pool_chunk_frames", "Frames per decoded chunk.", buckets=COUNT_BUCKETS)
+PENDING_CHUNKS = REGISTRY.gauge("decode_pool_pending_chunks", "Chunks dispatched to the decode workers but not yet put into the queue.")
+
+
+def decode_chunk(frames: List[Tuple[bytes, float]], depth: bool = CAPTURE_DEPTH,
+                 top_of_book: bool = DECODE_TOP_OF_BOOK) -> List[Union[DecodedFeed, Exception]]:
+    """
+    Decodes a chunk of (frame, received_at) pairs, runs in the worker processes.
+
+    A frame which cannot be decoded is returned as its exception, so it does not cost the other
+    frames of the chunk.
+    """
+    try:
+        return [decode_feed_response(frame, received_at, depth, top_of_book) for frame, received_at in frames]
+    except Exception:
+        pass
+    # Rare slow path, decode frame by frame to find the bad ones
+    feeds = []
+    for frame, received_at in frames:
+        try:
+            feeds.append(decode_feed_response(frame, received_at, depth, top_of_book))
+        except Exception as e:
+            feeds.append(e)
+    return feeds
+
+
+class DecodePool:
+    """
+    Decodes raw websocket frames in a pool of worker processes.
+
+    Frames are grouped into chunks of up to `chunk_size` frames (or whatever arrived within
+    `chunk_wait_ms`) to amortize the inter-process overhead, and every chunk is decoded by the next
+    free worker. Decoded feeds are put into the output queue strictly in arrival order, chunk by
+    chunk, no matter which worker finishes first. At most `max_pending_chunks` chunks are submitted
+    to the workers and not yet put into the queue; beyond that `submit` waits before handing another
+    chunk to the workers, which pushes back on the websocket reader. Frames which cannot be decoded
+    are logged and skipped. Workers are started with the 'forkserver' method ('spawn' where it is not
+    available), see `DECODE_START_METHOD`.
+
+    Parameters:
+    - q (asyncio.Queue): The queue where decoded market data will be placed.
+    - workers (int): Number of worker processes.
+    - chunk_size (int): Maximum number of frames per chunk.
+    - chunk_wait_ms (int): Maximum time a partial chunk waits for more frames.
+    - max_pending_chunks (int): Maximum number of chunks submitted but not yet put into `q`.
+    - depth (bool): Whether to decode market depth, see `decode_feed_response`.
+    - top_of_book (bool): Whether to decode the best bid and ask without the depth, see `decode_feed_response`.
+    - close_timeout (float): Seconds `close` waits for the chunks in flight.
+    """
+
+    def __init__(self,
+                 q: asyncio.Queue,
+                 workers: int = DECODE_WORKERS,
+                 chunk_size: int = DECODE_CHUNK_SIZE,
+                 chunk_wait_ms: int = DECODE_CHUNK_WAIT_MS,
+                 max_pending_chunks: int = DECODE_MAX_PENDING_CHUNKS,
+                 depth: bool = CAPTURE_DEPTH,
+                 top_of_book: bool = DECODE_TOP_OF_BOOK,
+                 close_timeout: float = DECODE_CLOSE_TIMEOUT):
+        self.q = q
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.chunk_wait = chunk_wait_ms / 1000
+        self.depth = depth
+        self.top_of_book = top_of_book
+        self.max_pending_chunks = max_pending_chunks
+        self.close_timeout = close_timeout
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # Chunks in submission order, each counted in `_pending` until it was put into `q`
+        self._ordered: asyncio.Queue = asyncio.Queue()
+        self._pending = 0
+        self._slot_freed = asyncio.Event()
+        self._frames: List[Tuple[bytes, float]] = []
+        self._stats: list = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._drainer: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "DecodePool":
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def start(self) -> None:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context(DECODE_START_METHOD))
+            self._drainer = asyncio.create_task(self._drain())
+            PENDING_CHUNKS.set_function(lambda: self._pending)
+            logger.info(f"Decode pool started with {self.workers} worker processes.")
+
+    async def close(self) -> None:
+        """Puts the frames submitted so far into the queue, waiting up to `close_timeout`, and stops the workers."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._drainer is not None:
+            try:
+                await asyncio.wait_for(self.join(), self.close_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Decode pool closed with {self._pending} chunks not put into the queue.")
+            self._drainer.cancel()
+            self._drainer = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def submit(self, frame: bytes, received_at: float, stats=None) -> None:
+        """
+        Queues a raw frame for decoding.
+
+        Parameters:
+        - frame (bytes): The raw binary frame.
+        - received_at (float): Epoch seconds at which the frame was received.
+        - stats (FeedStats, optional): Counters of the connection the frame came from, updated
+          with the decoded feed.
+        """
+        self._frames.append((frame, received_at))
+        self._stats.append(stats)
+
+        if len(self._frames) >= self.chunk_size:
+            await self._dispatch()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.chunk_wait, self._dispatch_partial)
+
+    async def join(self) -> None:
+        """Waits until every submitted frame was decoded and put into the output queue."""
+        if self._frames:
+            await self._dispatch()
+        await self._ordered.join()
+
+    def _dispatch_partial(self) -> None:
+        self._flush_handle = None
+        if not self._frames:
+            return
+        if self._pending >= self.max_pending_chunks:
+            # Retry later instead of blocking in a timer callback
+            self._flush_handle = asyncio.get_running_loop().call_later(self.chunk_wait, self._dispatch_partial)
+            return
+        self._pending += 1
+        self._ordered.put_nowait(self._take_chunk())
+
+    async def _dispatch(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        # The slot is taken before the chunk goes to the workers, so waiting here bounds the chunks in flight
+        while self._pending >= self.max_pending_chunks:
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+        if not self._frames:
+            # Taken by another dispatch while waiting
+            return
+        self._pending += 1
+        self._ordered.put_nowait(self._take_chunk())
+
+    def _take_chunk(self):
+        frames, self._frames = self._frames, []
+        stats, self._stats = self._stats, []
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, decode_chunk, frames, self.depth, self.top_of_book)
+        return future, stats, time.perf_counter()
+
+    async def _drain(self) -> None:
+        # Latest quotes for local readers, updated before the frames wait in `q`
+        quotes = get_quote_snapshot()
+        while True:
+            future, stats, dispatched_at = await self._ordered.get()
+            try:
+                feeds = await future
+                CHUNK_SECONDS.observe(time.perf_counter() - dispatched_at)
+                CHUNK_FRAMES.observe(len(feeds))
+            except Exception as e:
+                logger.error(f"Decoding a chunk of {len(stats)} frames failed: {e}")
+                feeds = []
+            for feed, feed_stats in zip(feeds, stats):
+                if isinstance(feed, Exception):
+                    logger.error(f"Skipping a frame which could not be decoded: {feed}")
+                    continue
+                if feed_stats is not None:
+                    feed_stats.record(feed)
+                if quotes is not None:
+                    quotes.update(feed)
+                await self.q.put(feed)
+            self._pending -= 1
+            self._slot_freed.set()
+            self._ordered.task_done()
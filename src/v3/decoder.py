@@ -0,0 +1,175 @@
+import os
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+from . import MarketDataFeedV3_pb2 as pb
+
+# Decode `marketLevel.bidAskQuote` of every frame, needed to capture market depth
+CAPTURE_DEPTH = os.getenv("CAPTURE_DEPTH", "False").lower() == "true"
+# Decode the best bid and ask of every frame for the quote snapshot (see `QUOTE_SNAPSHOT_NAME`), also without `CAPTURE_DEPTH`
+DECODE_TOP_OF_BOOK = bool(os.getenv("QUOTE_SNAPSHOT_NAME", ""))
+
+# Enum value -> name lookups, resolved once instead of per frame
+FEED_TYPE_NAMES = {value: name for name, value in pb.Type.items()}
+
+
+class CandleRow(NamedTuple):
+    """A single OHLC entry of an instrument as pushed by the feed."""
+    instrument_key: str
+    interval: str
+    open: float
+    high: float
+    low: float
+    close: float
+    volume: int
+    ts: int
+
+
+class TickRow(NamedTuple):
+    """
+    Last traded price, market level and greeks of an instrument for one frame.
+
+    Market level and greek fields the frame does not carry are None. Like `MessageToDict`, a
+    proto3 zero value counts as not carried, so these fields are never 0.
+    """
+    instrument_key: str
+    ltp: float
+    ltt: int
+    ltq: int
+    cp: float
+    atp: Optional[float] = None
+    vtt: Optional[int] = None
+    oi: Optional[float] = None
+    iv: Optional[float] = None
+    tbq: Optional[float] = None
+    tsq: Optional[float] = None
+    delta: Optional[float] = None
+    theta: Optional[float] = None
+    gamma: Optional[float] = None
+    vega: Optional[float] = None
+    rho: Optional[float] = None
+    # Tuple of (bidQ, bidP, askQ, askP) per level, every level when depth decoding is requested, only
+    # the first one when the top of book is
+    depth: Tuple[Tuple[int, float, int, float], ...] = ()
+
+
+class DecodedFeed(NamedTuple):
+    """Flat representation of a `FeedResponse` frame."""
+    type: str
+    current_ts: int
+    received_at: float
+    candles: List[CandleRow]
+    ticks: List[TickRow]
+
+    @property
+    def nbytes(self) -> int:
+        """Rough size of the line protocol generated from this frame."""
+        return 128 * len(self.candles)
+
+
+def _append_candles(instrument_key: str, market_ohlc, candles: list) -> None:
+    for ohlc in market_ohlc.ohlc:
+        # Upstox pads the list with empty entries which have no interval
+        if not ohlc.interval:
+            continue
+        candles.append(CandleRow(
+            instrument_key,
+            ohlc.interval,
+            ohlc.open,
+            ohlc.high,
+            ohlc.low,
+            ohlc.close,
+            ohlc.vol,
+            ohlc.ts,
+        ))
+
+
+def decode_feed_response(buffer: bytes, received_at: Optional[float] = None, depth: bool = CAPTURE_DEPTH,
+                         top_of_book: bool = DECODE_TOP_OF_BOOK) -> DecodedFeed:
+    """
+    Decodes a binary `FeedResponse` frame straight into flat candle and tick records.
+
+    The protobuf message is walked field by field, skipping the `MessageToDict` and
+    pydantic validation steps. Instruments subscribed in `full` mode (`marketFF`), index
+    instruments (`indexFF`), `ltpc` and `option_greeks` modes are all supported.
+
+    Parameters:
+    - buffer (bytes): The raw binary frame received from the websocket.
+    - received_at (float, optional): Epoch seconds at which the frame was received. Defaults to now.
+    - depth (bool): Whether to decode `marketLevel.bidAskQuote` into `TickRow.depth`. Defaults to `CAPTURE_DEPTH`.
+    - top_of_book (bool): Whether to decode the first level into `TickRow.depth` when `depth` is not
+      requested. Defaults to `DECODE_TOP_OF_BOOK`.
+
+    Returns:
+    - DecodedFeed: The decoded frame with one `CandleRow` per OHLC entry and one `TickRow` per instrument.
+    """
+    if received_at is None:
+        received_at = time.time()
+
+    feed_response = pb.FeedResponse()
+    feed_response.ParseFromString(buffer)
+
+    candles = []
+    ticks = []
+
+    for instrument_key, feed in feed_response.feeds.items():
+        kind = feed.WhichOneof("FeedUnion")
+
+        if kind == "fullFeed":
+            full_feed = feed.fullFeed
+            if full_feed.WhichOneof("FullFeedUnion") == "indexFF":
+                index_ff = full_feed.indexFF
+                _append_candles(instrument_key, index_ff.marketOHLC, candles)
+                ltpc = index_ff.ltpc
+                ticks.append(TickRow(instrument_key, ltpc.ltp, ltpc.ltt, ltpc.ltq, ltpc.cp))
+                continue
+
+            market_ff = full_feed.marketFF
+            _append_candles(instrument_key, market_ff.marketOHLC, candles)
+            ltpc = market_ff.ltpc
+            greeks = market_ff.optionGreeks
+            levels = ()
+            if depth:
+                levels = tuple(
+                    (quote.bidQ, quote.bidP, quote.askQ, quote.askP)
+                    for quote in market_ff.marketLevel.bidAskQuote
+                )
+            elif top_of_book and market_ff.marketLevel.bidAskQuote:
+                quote = market_ff.marketLevel.bidAskQuote[0]
+                levels = ((quote.bidQ, quote.bidP, quote.askQ, quote.askP),)
+            ticks.append(TickRow(
+                instrument_key, ltpc.ltp, ltpc.ltt, ltpc.ltq, ltpc.cp,
+                market_ff.atp or None, market_ff.vtt or None, market_ff.oi or None, market_ff.iv or None,
+                market_ff.tbq or None, market_ff.tsq or None,
+                greeks.delta or None, greeks.theta or None, greeks.gamma or None, greeks.vega or None,
+                greeks.rho or None,
+                levels,
+            ))
+
+        elif kind == "firstLevelWithGreeks":
+            first_level = feed.firstLevelWithGreeks
+            ltpc = first_level.ltpc
+            greeks = first_level.optionGreeks
+            levels = ()
+            if depth or top_of_book:
+                quote = first_level.firstDepth
+                levels = ((quote.bidQ, quote.bidP, quote.askQ, quote.askP),)
+            ticks.append(TickRow(
+                instrument_key, ltpc.ltp, ltpc.ltt, ltpc.ltq, ltpc.cp,
+                None, first_level.vtt or None, first_level.oi or None, first_level.iv or None, None, None,
+                greeks.delta or None, greeks.theta or None, greeks.gamma or None, greeks.vega or None,
+                greeks.rho or None,
+                levels,
+            ))
+
+        elif kind == "ltpc":
+            ltpc = feed.ltpc
+            ticks.append(TickRow(instrument_key, ltpc.ltp, ltpc.ltt, ltpc.ltq, ltpc.cp))
+
+    return DecodedFeed(
+        FEED_TYPE_NAMES.get(feed_response.type, str(feed_response.type)),
+        feed_response.currentTs,
+        received_at,
+        candles,
+        ticks,
+    )
@@ -0,0 +1,190 @@
+import asyncio
+import glob
+import logging
+import os
+import struct
+import time
+from datetime import datetime
+from typing import BinaryIO, Iterator, List, Optional, Sequence, Tuple, Union
+
+from .decode_pool import DecodePool
+from .decoder import decode_feed_response
+from pipeline.quote_snapshot import get_quote_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Directory the raw websocket frames are recorded to, empty disables recording
+RECORD_FRAMES_DIR = os.getenv("RECORD_FRAMES_DIR", "")
+# Size after which a new segment file is started
+RECORD_SEGMENT_MB = float(os.getenv("RECORD_SEGMENT_MB", 256))
+# Directory (or glob) of recorded segments to replay instead of connecting to Upstox, empty disables replay
+REPLAY_FRAMES_DIR = os.getenv("REPLAY_FRAMES_DIR", "")
+# Replay speed, 1 replays in real time, N N times faster, 'max' as fast as the pipeline accepts
+REPLAY_SPEED = os.getenv("REPLAY_SPEED", "1")
+
+SEGMENT_MAGIC = b"UPXFRM1\n"
+SEGMENT_SUFFIX = ".frames"
+# Every record is the receive time (epoch seconds, float64) and the frame length (uint32), then the frame
+RECORD_HEADER = struct.Struct("<dI")
+
+
+def parse_speed(speed: Union[str, float, None]) -> float:
+    """Parses a replay speed, 'max' (or 0) means no pacing and is returned as 0."""
+    if speed is None or str(speed).strip().lower() in ("max", "0", ""):
+        return 0.0
+    value = float(speed)
+    if value < 0:
+        raise ValueError(f"Replay speed must be positive or 'max', got {speed}")
+    return value
+
+
+class FrameRecorder:
+    """
+    Appends raw websocket frames with their receive time to segment files.
+
+    Each record is length prefixed (`RECORD_HEADER` followed by the frame), so segments can be read
+    back without decoding. A new segment is started once the current one exceeds `segment_bytes`;
+    segment names start with the time they were opened, so they sort in recording order, and carry the
+    process id, so recorders of concurrent or restarted processes never append to the same segment.
+    Writes go through a large userspace buffer, the recorder adds about a memcpy per frame to the
+    receive loop.
+
+    Parameters:
+    - directory (str): Directory the segments are written to, created when missing.
+    - segment_bytes (int): Size after which a new segment is started.
+    - buffer_size (int): Size of the write buffer of the open segment.
+    """
+
+    def __init__(self, directory: str = RECORD_FRAMES_DIR, segment_bytes: int = int(RECORD_SEGMENT_MB * 1024 * 1024),
+                 buffer_size: int = 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.buffer_size = buffer_size
+        self.frames = 0
+        self._file: Optional[BinaryIO] = None
+        self._segment_size = 0
+        self._segment_no = 0
+
+    def _open_segment(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            self._segment_no += 1
+            name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._segment_no:05d}{SEGMENT_SUFFIX}"
+            path = os.path.join(self.directory, name)
+            try:
+                self._file = open(path, "xb", buffering=self.buffer_size)
+                break
+            except FileExistsError:
+                # A reused process id within the same second, take the next number
+                continue
+        self._file.write(SEGMENT_MAGIC)
+        self._segment_size = len(SEGMENT_MAGIC)
+        logger.info(f"Recording websocket frames to {path}")
+
+    def record(self, frame: bytes, received_at: float) -> None:
+        """Appends a frame received at `received_at` (epoch seconds)."""
+        if self._file is None or self._segment_size >= self.segment_bytes:
+            self.close()
+            self._open_segment()
+        self._file.write(RECORD_HEADER.pack(received_at, len(frame)))
+        self._file.write(frame)
+        self._segment_size += RECORD_HEADER.size + len(frame)
+        self.frames += 1
+
+    def flush(self) -> None:
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def segment_paths(source: Union[str, Sequence[str]]) -> List[str]:
+    """Resolves a directory, glob or list of segment files into segment paths in recording order."""
+    if not isinstance(source, str):
+        return list(source)
+    if os.path.isdir(source):
+        source = os.path.join(source, f"*{SEGMENT_SUFFIX}")
+    return sorted(glob.glob(source))
+
+
+def iter_frames(source: Union[str, Sequence[str]]) -> Iterator[Tuple[float, bytes]]:
+    """
+    Yields the (received_at, frame) records of recorded segments in order.
+
+    A truncated record at the end of a segment (e.g. after a crash) ends that segment.
+    """
+    for path in segment_paths(source):
+        with open(path, "rb") as f:
+            if f.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+                logger.warning(f"Skipping {path}, not a frame segment.")
+                continue
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                received_at, length = RECORD_HEADER.unpack(header)
+                frame = f.read(length)
+                if len(frame) < length:
+                    logger.warning(f"Truncated record at the end of {path}.")
+                    break
+                yield received_at, frame
+
+
+async def replay_frames(q: asyncio.Queue,
+                        source: Union[str, Sequence[str]] = REPLAY_FRAMES_DIR,
+                        speed: Union[str, float] = REPLAY_SPEED,
+                        decode_pool: Optional[DecodePool] = None,
+                        stats=None) -> int:
+    """
+    Feeds recorded frames into the pipeline as if they came from the websocket.
+
+    Frames are decoded like live frames (inline or by `decode_pool`) and put into `q`. With a
+    `speed` of 1 the original inter-arrival times are reproduced, N replays N times faster and 'max'
+    does not wait at all, so the queue's back pressure sets the pace. Decoded feeds carry the replay
+    time as `received_at`, so freshness metrics measure the pipeline rather than the recording.
+
+    Parameters:
+    - q (asyncio.Queue): The queue where decoded market data will be placed.
+    - source (str or Sequence[str]): Directory, glob or list of recorded segments.
+    - speed (str or float): Replay speed, see `REPLAY_SPEED`.
+    - decode_pool (DecodePool, optional): Decodes the frames in worker processes.
+    - stats (FeedStats, optional): Message counters updated with every frame.
+
+    Returns:
+    - int: Number of frames replayed.
+    """
+    speed = parse_speed(speed)
+    started = time.monotonic()
+    first_received_at = None
+    frames = 0
+    quotes = get_quote_snapshot()
+
+    for received_at, frame in iter_frames(source):
+        if speed:
+            if first_received_at is None:
+                first_received_at = received_at
+            delay = (received_at - first_received_at) / speed - (time.monotonic() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        elif frames % 256 == 0:
+            # Let the consumers run between chunks of unpaced frames
+            await asyncio.sleep(0)
+
+        now = time.time()
+        if decode_pool is not None:
+            await decode_pool.submit(frame, now, stats)
+        else:
+            feed = decode_feed_response(frame, now)
+            if stats is not None:
+                stats.record(feed)
+            if quotes is not None:
+                quotes.update(feed)
+            await q.put(feed)
+        frames += 1
+
+    elapsed = time.monotonic() - started
+    logger.info(f"Replayed {frames} frames in {elapsed:.1f}s ({frames / max(elapsed, 1e-9):.0f} frames/s).")
+    return frames
@@ -0,0 +1,265 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+import websockets
+from aiohttp import web
+
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+# Feed mode of instruments which do not ask for another one: 'ltpc', 'full', 'option_greeks' or 'full_d30'
+SUBSCRIPTION_MODE = os.getenv("SUBSCRIPTION_MODE", "full")
+# Seconds between two polls of the instrument list, 0 only reads it at start up
+SUBSCRIPTION_REFRESH_INTERVAL = float(os.getenv("SUBSCRIPTION_REFRESH_INTERVAL", 60))
+# Port of the local subscription control endpoint (`/subscriptions`), 0 disables it
+SUBSCRIPTION_CONTROL_PORT = int(os.getenv("SUBSCRIPTION_CONTROL_PORT", 0))
+SUBSCRIPTION_CONTROL_HOST = os.getenv("SUBSCRIPTION_CONTROL_HOST", "127.0.0.1")
+# Maximum instrument keys per subscription message
+SUBSCRIPTION_BATCH_SIZE = int(os.getenv("SUBSCRIPTION_BATCH_SIZE", 1000))
+
+SUBSCRIPTION_MESSAGES = REGISTRY.counter("feed_subscription_messages_total", "Subscription messages sent on live connections.", ("method",))
+WATCHLIST_SIZE = REGISTRY.gauge("feed_watchlist_instruments", "Instruments in the desired subscription set.")
+
+
+class Watchlist:
+    """
+    Desired subscription set (instrument key -> mode), shared by all connections and the downstream caches.
+
+    The set is the instrument list returned by `instruments_getter`, polled every `refresh_interval`
+    seconds, combined with the additions and removals made through the control endpoint (see
+    `start_control_server`). Connections wait for changes with `wait_changed` and apply them with a
+    `SubscriptionManager`; listeners registered with `add_listener` are called with the instrument
+    keys which left the set, so caches can drop their state.
+
+    Parameters:
+    - mode (str): Mode of instruments without an explicit one.
+    - refresh_interval (float): Seconds between two polls of `instruments_getter`, 0 disables polling.
+    """
+
+    def __init__(self, mode: str = SUBSCRIPTION_MODE, refresh_interval: float = SUBSCRIPTION_REFRESH_INTERVAL):
+        self.mode = mode
+        self.refresh_interval = refresh_interval
+        self.instruments_getter: Optional[Callable[[], Awaitable[List[str]]]] = None
+        self.version = 0
+        self._base: Dict[str, str] = {}
+        self._added: Dict[str, str] = {}
+        self._removed: Set[str] = set()
+        self._desired: Dict[str, str] = {}
+        self._changed = asyncio.Condition()
+        self._listeners: List[Callable[[Set[str]], None]] = []
+        self._poller: Optional[asyncio.Task] = None
+        WATCHLIST_SIZE.set_function(lambda: len(self._desired))
+
+    @property
+    def desired(self) -> Dict[str, str]:
+        return self._desired
+
+    async def instruments(self) -> List[str]:
+        """Returns the desired instrument keys, the signature of an `instruments_getter`."""
+        if self.instruments_getter is not None and self.version == 0:
+            await self.refresh()
+        return list(self._desired)
+
+    def add_listener(self, listener: Callable[[Set[str]], None]) -> None:
+        """Registers `listener`, called with the instrument keys which left the desired set."""
+        self._listeners.append(listener)
+
+    async def _update(self) -> None:
+        desired = {key: mode for key, mode in self._base.items() if key not in self._removed}
+        desired.update(self._added)
+        removed = set(self._desired) - set(desired)
+        changed = desired != self._desired
+        self._desired = desired
+        if not changed and self.version:
+            return
+        self.version += 1
+        if removed:
+            for listener in self._listeners:
+                try:
+                    listener(removed)
+                except Exception as e:
+                    logger.error(f"Watchlist listener failed :: {e}")
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def wait_changed(self, version: int) -> int:
+        """Waits until the set differs from `version` and returns the new version."""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.version != version)
+            return self.version
+
+    async def refresh(self) -> None:
+        """Reads the instrument list again and applies it."""
+        instruments = await self.instruments_getter()
+        self._base = {key: self.mode for key in instruments}
+        await self._update()
+
+    async def apply(self, add: Iterable[str] = (), remove: Iterable[str] = (), mode: Optional[str] = None) -> None:
+        """Adds (in `mode`, default `self.mode`) and removes instruments on top of the polled list."""
+        for key in remove:
+            self._added.pop(key, None)
+            self._removed.add(key)
+        for key in add:
+            self._removed.discard(key)
+            self._added[key] = mode or self.mode
+        await self._update()
+
+    async def start(self, instruments_getter: Callable[[], Awaitable[List[str]]]) -> "Watchlist":
+        """Reads the instrument list and keeps polling it in the background."""
+        self.instruments_getter = instruments_getter
+        await self.refresh()
+        if self.refresh_interval > 0 and self._poller is None:
+            self._poller = asyncio.create_task(self._poll())
+        return self
+
+    async def close(self) -> None:
+        if self._poller is not None:
+            self._poller.cancel()
+            try:
+                await self._poller
+            except asyncio.CancelledError:
+                pass
+            self._poller = None
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Refreshing the instrument list failed :: {e} :: Keeping {len(self._desired)} instruments")
+
+
+_WATCHLIST: Optional[Watchlist] = None
+
+
+def get_watchlist() -> Watchlist:
+    """Returns the process wide watchlist, shared by the feed connections and the ingest stage."""
+    global _WATCHLIST
+    if _WATCHLIST is None:
+        _WATCHLIST = Watchlist()
+    return _WATCHLIST
+
+
+def subscription_message(method: str, instrument_keys: List[str], mode: Optional[str] = None) -> bytes:
+    """Builds a `sub`, `unsub` or `change_mode` request of the v3 market data feed."""
+    data = {"instrumentKeys": instrument_keys}
+    if mode is not None:
+        data["mode"] = mode
+    return json.dumps({"guid": uuid.uuid4().hex, "method": method, "data": data}).encode("utf-8")
+
+
+class SubscriptionManager:
+    """
+    Keeps the subscriptions of one live websocket in line with a desired set.
+
+    `sync` diffs the desired instruments (key -> mode) against the active ones and sends only the
+    difference: `unsub` for removed instruments, `sub` for new ones and `change_mode` for instruments
+    whose mode changed, grouped by mode and in batches of `SUBSCRIPTION_BATCH_SIZE` keys. The
+    connection stays open, so the other instruments keep streaming.
+
+    Parameters:
+    - websocket: The connected websocket.
+    - name (str): Name of the connection used in log messages.
+    """
+
+    def __init__(self, websocket, name: str = "feed"):
+        self.websocket = websocket
+        self.name = name
+        self.active: Dict[str, str] = {}
+
+    async def _send(self, method: str, instrument_keys: List[str], mode: Optional[str] = None) -> None:
+        for start in range(0, len(instrument_keys), SUBSCRIPTION_BATCH_SIZE):
+            await self.websocket.send(subscription_message(method, instrument_keys[start:start + SUBSCRIPTION_BATCH_SIZE], mode))
+            SUBSCRIPTION_MESSAGES.labels(method).inc()
+
+    async def sync(self, desired: Dict[str, str]) -> List[str]:
+        """Sends the difference between `desired` and the active subscriptions, returns the removed keys."""
+        removed = [key for key in self.active if key not in desired]
+        added: Dict[str, List[str]] = {}
+        changed: Dict[str, List[str]] = {}
+        for key, mode in desired.items():
+            active_mode = self.active.get(key)
+            if active_mode is None:
+                added.setdefault(mode, []).append(key)
+            elif active_mode != mode:
+                changed.setdefault(mode, []).append(key)
+
+        if removed:
+            await self._send("unsub", removed)
+        for mode, keys in added.items():
+            await self._send("sub", keys, mode)
+        for mode, keys in changed.items():
+            await self._send("change_mode", keys, mode)
+        self.active = dict(desired)
+
+        if self.active and (removed or added or changed):
+            logger.info(
+                f"Subscriptions updated :: {self.name} :: +{sum(map(len, added.values()))} "
+                f"-{len(removed)} ~{sum(map(len, changed.values()))} :: active : {len(self.active)}"
+            )
+        return removed
+
+    async def follow(self, watchlist: Watchlist, instruments_getter: Callable[[], Awaitable[List[str]]],
+                     version: int, on_removed: Optional[Callable[[List[str]], None]] = None) -> None:
+        """
+        Applies every change of `watchlist` after `version` until cancelled or the socket is closed.
+        `instruments_getter` returns the keys this connection is responsible for, their modes are taken
+        from the watchlist. `on_removed` is called with the keys unsubscribed from this socket.
+        """
+        try:
+            while True:
+                version = await watchlist.wait_changed(version)
+                keys = await instruments_getter()
+                desired = watchlist.desired
+                removed = await self.sync({key: desired.get(key, watchlist.mode) for key in keys})
+                if removed and on_removed is not None:
+                    on_removed(removed)
+        except websockets.exceptions.ConnectionClosed:
+            # The receive loop notices as well and reconnects with the then desired set
+            pass
+
+
+async def start_control_server(watchlist: Watchlist, port: int = SUBSCRIPTION_CONTROL_PORT,
+                               host: str = SUBSCRIPTION_CONTROL_HOST) -> Optional[web.AppRunner]:
+    """
+    Serves the subscription control endpoint at `http://<host>:<port>/subscriptions`:
+    - `GET` returns the desired instruments and their modes.
+    - `POST` with `{"add": [...], "remove": [...], "mode": "full"}` changes them, the connections
+      apply the difference without reconnecting.
+
+    Returns:
+    - web.AppRunner: The runner to clean up on shutdown, None if `port` is 0.
+    """
+    if not port:
+        return None
+
+    async def get_subscriptions(request: web.Request) -> web.Response:
+        return web.json_response({"version": watchlist.version, "instruments": watchlist.desired})
+
+    async def post_subscriptions(request: web.Request) -> web.Response:
+        try:
+            body = await request.json()
+            add, remove, mode = body.get("add", []), body.get("remove", []), body.get("mode")
+            if not isinstance(add, list) or not isinstance(remove, list):
+                raise ValueError("'add' and 'remove' must be lists of instrument keys")
+        except (ValueError, AttributeError) as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=400)
+        await watchlist.apply(add=add, remove=remove, mode=mode)
+        return web.json_response({"version": watchlist.version, "instruments": len(watchlist.desired)})
+
+    app = web.Application()
+    app.router.add_get("/subscriptions", get_subscriptions)
+    app.router.add_post("/subscriptions", post_subscriptions)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving subscription control at http://{host}:{port}/subscriptions")
+    return runner
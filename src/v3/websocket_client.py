@@ -1,82 +1,66 @@
 # Import necessary modules
 import asyncio
+import functools
 import json
 import ssl
+import aiohttp
 import websockets
-import requests
 import os
 from datetime import datetime
 import socket
+import time
+from typing import Awaitable, Callable, List, Optional
 from google.protobuf.json_format import MessageToDict
 
 from . import MarketDataFeedV3_pb2 as pb
 from .data_models.market_info import MarketInfoEvent
 from .data_models.live_feed import LiveFeed
-from utils import fetch_token
+from .decoder import DecodedFeed, decode_feed_response
+from .decode_pool import DECODE_WORKERS, DecodePool
+from .frame_recorder import RECORD_FRAMES_DIR, REPLAY_FRAMES_DIR, FrameRecorder, replay_frames
+from .backfill import Backfiller, create_backfill_source, find_gaps, get_persisted_bars
+from .credentials import CredentialManager, InvalidTokenError, get_market_data_feed_authorize_v3
+from .subscriptions import SUBSCRIPTION_MODE, SubscriptionManager, Watchlist, get_watchlist, start_control_server
+from pipeline.quote_snapshot import get_quote_snapshot
+from utils.metrics import BYTES_BUCKETS, REGISTRY
 import logging
 
 
-class InvalidTokenError(Exception):
-    """Raised when the API indicates the access token is invalid or expired."""
-    pass
-
 logger = logging.getLogger(__name__)
 
 MAX_WEBSOCKET_CONN_RETRIES = 3
-FETCH_TOKEN_API = os.getenv("API_FETCH_TOKEN", None)
-ACCESS_TOKEN = os.getenv("ACCESS_TOKEN", None)
+# Number of websocket connections the instruments are partitioned across
+WEBSOCKET_SHARDS = int(os.getenv("WEBSOCKET_SHARDS", 1))
 GET_INSTRUMENTS_URL = os.getenv("GET_INSTRUMENTS_URL", None)
+# Seconds the instruments fetched from `GET_INSTRUMENTS_URL` are reused for on reconnects
+INSTRUMENTS_CACHE_TTL = float(os.getenv("INSTRUMENTS_CACHE_TTL", 300))
+# Delay before the first reconnect attempt, doubled for every further attempt
+WEBSOCKET_RECONNECT_DELAY = float(os.getenv("WEBSOCKET_RECONNECT_DELAY", 0.1))
+# Additionally validate every live frame against the pydantic `LiveFeed` model (debug only, slow)
+VALIDATE_LIVE_FEED = os.getenv("VALIDATE_LIVE_FEED", "False").lower() == "true"
+
+FEED_FRAMES = REGISTRY.counter("feed_frames_total", "Live feed frames received.", ("connection",))
+FEED_BYTES = REGISTRY.counter("feed_received_bytes_total", "Bytes of live feed frames received.", ("connection",))
+FEED_CONNECTIONS = REGISTRY.counter("feed_connections_total", "Websocket connections established.", ("connection",))
+FEED_DISCONNECTS = REGISTRY.counter("feed_disconnects_total", "Websocket connections lost or failed to connect.", ("connection",))
+FEED_LAG = REGISTRY.gauge("feed_lag_seconds", "Receive time minus the feed timestamp of the last frame.", ("connection",))
+FEED_RECONNECT_SECONDS = REGISTRY.histogram("feed_reconnect_seconds", "Time from losing a websocket connection to the next one being established.", ("connection",))
+DECODE_SECONDS = REGISTRY.histogram("feed_decode_seconds", "Time to decode a frame on the event loop.")
+FRAME_BYTES = REGISTRY.histogram("feed_frame_bytes", "Size of the received frames.", buckets=BYTES_BUCKETS)
 
 raw = os.getenv("INSTRUMENTS_LIST", "")
 tokens = [i.strip() for i in raw.split(",") if i.strip()]
 INSTRUMENTS_LIST = tokens if tokens else None
 
-def get_market_data_feed_authorize_v3(access_token):
-    """Get authorization for market data feed.
-
-    Raises
-    ------
-    InvalidTokenError
-        If the API responds with status "error" and error_code "UDAPI100050".
-    """
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {access_token}'
-    }
-    url = 'https://api.upstox.com/v3/feed/market-data-feed/authorize'
-    api_response = requests.get(url=url, headers=headers)
-
-    # Parse and handle potential error response structure
-    try:
-        payload = api_response.json()
-    except ValueError:
-        # If not JSON, raise with HTTP status context
-        api_response.raise_for_status()
-        # If no exception raised by raise_for_status, rethrow a generic error
-        raise Exception("Unexpected non-JSON response from authorize endpoint.")
-
-    # Handle error structure: {"status": "error", "errors": [{"error_code": "...", "message": "..."}]}
-    if isinstance(payload, dict) and payload.get("status") == "error":
-        errors = payload.get("errors") or []
-        for err in errors:
-            if isinstance(err, dict) and err.get("error_code") == "UDAPI100050":
-                message = err.get("message") or "Invalid or expired access token."
-                raise InvalidTokenError(message)
-        # For other errors, raise a generic exception including first error message if present
-        if errors:
-            raise Exception(errors[0].get("message") if isinstance(errors[0], dict) else "Authorization failed with error status.")
-        raise Exception("Authorization failed with error status.")
-
-    return payload
-
-
 def decode_protobuf(buffer):
     """Decode protobuf message."""
     feed_response = pb.FeedResponse()
     feed_response.ParseFromString(buffer)
     return feed_response
 
-def get_instruments():
+_instruments_cache = None
+
+async def get_instruments(max_age: float = INSTRUMENTS_CACHE_TTL):
     """
     Retrieves the list of instruments for market data subscription.
 
@@ -88,6 +72,11 @@ def get_instruments():
     list
         A list of instruments for market data subscription.
 
+    Parameters
+    ----------
+    max_age : float, optional
+        Maximum age in seconds of a cached list fetched from the URL. Defaults to `INSTRUMENTS_CACHE_TTL`.
+
     Raises
     ------
     Exception
@@ -96,118 +85,198 @@ def get_instruments():
     Notes
     -----
     - If a URL is provided via the GET_INSTRUMENTS_URL variable, the function sends an HTTP GET request to retrieve the instruments list.
+      The list is reused for `INSTRUMENTS_CACHE_TTL` seconds, so reconnects do not wait for it.
     - If the URL is not provided, it returns the predefined list from the INSTRUMENTS_LIST variable.
     """
-    
+    global _instruments_cache
+
     if INSTRUMENTS_LIST is not None:
         return INSTRUMENTS_LIST
 
     elif GET_INSTRUMENTS_URL is not None:
-        data = requests.get(GET_INSTRUMENTS_URL)
-        instruments_list = data.json()["instruments"]
+        if _instruments_cache is not None and time.monotonic() - _instruments_cache[1] < max_age:
+            return _instruments_cache[0]
 
-        print(instruments_list)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(GET_INSTRUMENTS_URL) as response:
+                data = await response.json(content_type=None)
+        instruments_list = data["instruments"]
+        _instruments_cache = (instruments_list, time.monotonic())
+
+        logger.info(f"Fetched {len(instruments_list)} instruments from {GET_INSTRUMENTS_URL}")
 
         return instruments_list
     
     raise Exception(f"Cannot fetch instruments list. Terminating app...")
 
-async def fetch_market_data(q: asyncio.Queue):
+class FeedStats:
+    """Counters of a websocket connection, updated for every received frame."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.messages = 0
+        self.connections = 0
+        self.last_received_at = None
+        # Receive time minus the exchange side `currentTs` of the last frame, in milliseconds
+        self.lag_ms = None
+        self._frames = FEED_FRAMES.labels(name)
+        self._lag = FEED_LAG.labels(name)
+
+    def record(self, feed: DecodedFeed) -> None:
+        self.messages += 1
+        self._frames.inc()
+        self.last_received_at = feed.received_at
+        if feed.current_ts:
+            self.lag_ms = feed.received_at * 1000 - feed.current_ts
+            self._lag.set(self.lag_ms / 1000)
+
+
+async def run_feed_connection(q: asyncio.Queue,
+                              instruments_getter: Callable[[], Awaitable[List[str]]] = get_instruments,
+                              stats: Optional[FeedStats] = None,
+                              name: str = "feed",
+                              decode_pool: Optional[DecodePool] = None,
+                              recorder: Optional[FrameRecorder] = None,
+                              credentials: Optional[CredentialManager] = None,
+                              backfiller: Optional[Backfiller] = None,
+                              watchlist: Optional[Watchlist] = None):
     """
-    Fetches market data using WebSocket and places it into the provided asyncio Queue.
-
-    This function establishes a WebSocket connection to the Upstox market data feed, subscribes 
-    to specified instruments, and continuously listens for incoming data. The received data is 
-    decoded and placed into the provided queue for further processing.
+    Runs a single websocket connection subscribed to the instruments returned by `instruments_getter`
+    and places the decoded market data into the provided asyncio Queue.
 
     Parameters
     ----------
     q : asyncio.Queue
         The queue where decoded market data will be placed.
+    instruments_getter : coroutine function, optional
+        Returns the instrument keys to subscribe, awaited on every (re)connect. Defaults to `get_instruments`.
+    stats : FeedStats, optional
+        Message, lag and reconnect counters of this connection.
+    name : str, optional
+        Name of the connection used in log messages.
+    decode_pool : DecodePool, optional
+        Hands raw frames to worker processes for decoding instead of decoding them on the event loop.
+    recorder : FrameRecorder, optional
+        Records every raw frame with its receive time before it is decoded.
+    credentials : CredentialManager, optional
+        Provides the access token and authorized websocket URIs. Defaults to a manager owned by this
+        connection, which authorizes on demand.
+    backfiller : Backfiller, optional
+        Receives the I1 bars missed while the connection was down, detected from the snapshot sent
+        after every resubscription, counted from the last bar written per instrument (see `PersistedBars`).
+    watchlist : Watchlist, optional
+        Desired subscription set. Its changes are applied on the live socket (see `SubscriptionManager`),
+        `instruments_getter` then returns the keys of this connection. Without it, the instruments are
+        subscribed once per connect.
 
     Raises
     ------
     Exception
         If neither an access token nor a URL to fetch the token is provided.
-
-    Notes
-    -----
-    - The function includes retry logic for handling WebSocket connection failures.
-    - It operates within an infinite loop and is designed to run as a long-lived task within an 
-      asyncio event loop.
     """
+    own_credentials = credentials is None
+    if own_credentials:
+        credentials = CredentialManager()
 
+    try:
+        await _run_feed_connection(q, instruments_getter, stats, name, decode_pool, recorder, credentials, backfiller, watchlist)
+    finally:
+        if own_credentials:
+            await credentials.close()
+
+
+async def _run_feed_connection(q: asyncio.Queue,
+                               instruments_getter: Callable[[], Awaitable[List[str]]],
+                               stats: Optional[FeedStats],
+                               name: str,
+                               decode_pool: Optional[DecodePool],
+                               recorder: Optional[FrameRecorder],
+                               credentials: CredentialManager,
+                               backfiller: Optional[Backfiller],
+                               watchlist: Optional[Watchlist]):
     # Create default SSL context
     ssl_context = ssl.create_default_context()
     ssl_context.check_hostname = False
     ssl_context.verify_mode = ssl.CERT_NONE
 
     retrying_period_access_token = 1
+    reconnect_seconds = FEED_RECONNECT_SECONDS.labels(name)
+    disconnected_at = None
 
     while True:
         try:
-            # Access token
-            if ACCESS_TOKEN is not None:
-                access_token = ACCESS_TOKEN
-            elif FETCH_TOKEN_API is not None:
-                access_token = await fetch_token(url=FETCH_TOKEN_API)
-            else:
-                raise Exception(f"Neither access token nor url to fetch is provided. Terminating...")
-
-            # Get market data feed authorization
-            response = get_market_data_feed_authorize_v3(access_token=access_token)
-            
-            
             retry_no = 1
-            count = 0
-            # Connect to the WebSocket with SSL context
+            # Connect to the WebSocket with SSL context, every attempt takes a fresh authorized URI
+            # which the credential manager usually has prefetched
             while retry_no <= MAX_WEBSOCKET_CONN_RETRIES:
                 try:
-                    async with websockets.connect(response["data"]["authorized_redirect_uri"], ssl=ssl_context) as websocket:
-                        print('Connection established')
-
-                        await asyncio.sleep(1)  # Wait for 1 second
-
-                        # Data to be sent over the WebSocket
-                        data = {
-                            "guid": "someguid",
-                            "method": "sub",
-                            "data": {
-                                "mode": "full",
-                                "instrumentKeys": get_instruments()
-                            }
-                        }
-
-                        # Convert data to binary and send over WebSocket
-                        binary_data = json.dumps(data).encode('utf-8')
-                        await websocket.send(binary_data)
+                    uri = await credentials.authorized_uri()
+                    # Only secure websockets take an SSL context, the local feed server speaks plain ws://
+                    async with websockets.connect(uri, ssl=ssl_context if uri.startswith("wss://") else None) as websocket:
+                        logger.info(f"Connection established :: {name}")
+                        FEED_CONNECTIONS.labels(name).inc()
+                        if disconnected_at is not None:
+                            reconnect_seconds.observe(time.monotonic() - disconnected_at)
+                            disconnected_at = None
+                        if stats is not None:
+                            stats.connections += 1
+
+                        # Subscribe the instruments, later changes of the watchlist are applied on this socket
+                        subscriptions = SubscriptionManager(websocket, name)
+                        watchlist_version = watchlist.version if watchlist is not None else 0
+                        modes = watchlist.desired if watchlist is not None else {}
+                        await subscriptions.sync({key: modes.get(key, SUBSCRIPTION_MODE) for key in await instruments_getter()})
 
                         # Continuously receive and decode data from WebSocket
                         message = await websocket.recv()  # Recieve market info
                         market_info = MessageToDict(decode_protobuf(message))
                         MarketInfoEvent(**market_info)
-                        print("Market data : \n", market_info)
-                        await websocket.recv()  # Recieve market snapshot
-                        while True:
-                            message = await websocket.recv()
-                            decoded_data = decode_protobuf(message)
-
-                            # Convert the decoded data to a dictionary
-                            data_dict = MessageToDict(decoded_data)
-
-                            # print("data dict : ", data_dict, "\n\n")
-
-                            start_time = datetime.now()
-                            live_data = LiveFeed(**data_dict)
-                            end_time = datetime.now()
-                            print(f"Time taken to parse data using pydantic : {(end_time - start_time).total_seconds()*1000} ms")
-
-                            # Put data in q
-                            await q.put(live_data)
-                            # print(live_data.model_dump_json(), "\n\n")
-
-                            # Print the dictionary representation
-                            logger.debug("Data received from websocket.")
+                        logger.info(f"Market data :: {name} :: {market_info}")
+                        message = await websocket.recv()  # Recieve market snapshot
+                        if backfiller is not None:
+                            # Bars which closed while disconnected are fetched in the background
+                            snapshot = decode_feed_response(message)
+                            backfiller.submit(find_gaps(get_persisted_bars().last_ts, snapshot))
+                        # The connection is usable, later disconnects start over with the shortest delay
+                        retry_no = 1
+                        retrying_period_access_token = 1
+                        received_bytes = FEED_BYTES.labels(name)
+                        # Latest quotes for local readers, updated before the frames wait in `q`
+                        quotes = get_quote_snapshot()
+                        follower = None
+                        if watchlist is not None:
+                            follower = asyncio.create_task(subscriptions.follow(watchlist, instruments_getter, watchlist_version))
+                        try:
+                            while True:
+                                message = await websocket.recv()
+                                received_at = time.time()
+                                received_bytes.inc(len(message))
+                                FRAME_BYTES.observe(len(message))
+                                if recorder is not None:
+                                    recorder.record(message, received_at)
+                                if decode_pool is not None:
+                                    await decode_pool.submit(message, received_at, stats)
+                                    continue
+
+                                decode_started = time.perf_counter()
+                                live_data = decode_feed_response(message, received_at)
+                                DECODE_SECONDS.observe(time.perf_counter() - decode_started)
+                                if stats is not None:
+                                    stats.record(live_data)
+                                if quotes is not None:
+                                    quotes.update(live_data)
+
+                                if VALIDATE_LIVE_FEED:
+                                    # Opt-in debug path, builds the full pydantic tree for every frame
+                                    LiveFeed(**MessageToDict(decode_protobuf(message)))
+
+                                # Put data in q
+                                await q.put(live_data)
+
+                                logger.debug("Data received from websocket.")
+                        finally:
+                            if follower is not None:
+                                follower.cancel()
                 except (
                     websockets.exceptions.ConnectionClosed,
                     websockets.exceptions.InvalidHandshake,
@@ -216,22 +285,30 @@ async def fetch_market_data(q: asyncio.Queue):
                     OSError              # Covers WinError 121 and other low-level I/O issues
                 ) as e:
                     
-                    print(f"WebSocket connection closed unexpectedly or failed to connect: {e} :: Will try to re-establish connection :: retry no : {retry_no}")
-                    await asyncio.sleep(2)  # Wait for a sec
+                    FEED_DISCONNECTS.labels(name).inc()
+                    if disconnected_at is None:
+                        disconnected_at = time.monotonic()
+                    # The next URI is authorized during the delay
+                    credentials.prefetch_uri()
+                    delay = WEBSOCKET_RECONNECT_DELAY * 2 ** (retry_no - 1)
+                    logger.warning(f"WebSocket connection closed unexpectedly or failed to connect: {e} :: Will try to re-establish connection in {delay:.1f}s :: {name} :: retry no : {retry_no}")
+                    await asyncio.sleep(delay)
 
                     retry_no += 1  # Increment by 1
-            print(f"Max retries exceeded for establishing websocket connection :: Will retry with updated token.")
+            logger.warning(f"Max retries exceeded for establishing websocket connection :: Will retry with updated token.")
+            credentials.invalidate_token()
 
         except (
             ConnectionError, 
-            requests.exceptions.RequestException
+            aiohttp.ClientError
         ) as e:
             logger.warning(f"Network/Authorization call failed: {e}. Retrying in 10s...")
             await asyncio.sleep(10)
             continue
 
         except InvalidTokenError as e:
-            print(f"Could not get market data feed authorization :: Error occured : {str(e)} :: Retrying with updating token after {retrying_period_access_token} seconds")
+            logger.warning(f"Could not get market data feed authorization :: Error occured : {str(e)} :: Retrying with updating token after {retrying_period_access_token} seconds")
+            credentials.invalidate_token()
             await asyncio.sleep(retrying_period_access_token)
 
             retrying_period_access_token = min(100, retrying_period_access_token * 2)
@@ -239,6 +316,93 @@ async def fetch_market_data(q: asyncio.Queue):
             logger.error(f"Unknown exception occured. Raising error and terminating... {str(e)}")
             raise e
         
+async def fetch_market_data(q: asyncio.Queue):
+    """
+    Fetches market data using WebSocket and places it into the provided asyncio Queue.
+
+    This function establishes a WebSocket connection to the Upstox market data feed, subscribes 
+    to specified instruments, and continuously listens for incoming data. The received data is 
+    decoded into flat `DecodedFeed` records and placed into the provided queue for further processing.
+
+    Parameters
+    ----------
+    q : asyncio.Queue
+        The queue where decoded market data will be placed.
+
+    Raises
+    ------
+    Exception
+        If neither an access token nor a URL to fetch the token is provided.
+
+    Notes
+    -----
+    - The function includes retry logic for handling WebSocket connection failures.
+    - With `WEBSOCKET_SHARDS` > 1 the instruments are partitioned across that many independent
+      connections, see `ShardedFeedManager`.
+    - With `DECODE_WORKERS` > 0 frames are decoded in that many worker processes, see `DecodePool`.
+    - Set `VALIDATE_LIVE_FEED=true` to additionally validate every frame with the pydantic `LiveFeed` model.
+    - With `RECORD_FRAMES_DIR` every raw frame is recorded, see `FrameRecorder`. With `REPLAY_FRAMES_DIR`
+      recorded frames are replayed at `REPLAY_SPEED` instead of connecting to Upstox, see `replay_frames`.
+    - The access token and authorized websocket URIs are cached and refreshed in the background, so
+      reconnects go straight to the websocket, see `CredentialManager`.
+    - With `BACKFILL_SOURCE`, the I1 bars missed while disconnected are fetched in the background after
+      every reconnect and put on `q` next to the live frames, see `Backfiller`.
+    - The instrument list is polled every `SUBSCRIPTION_REFRESH_INTERVAL` seconds and can be changed through
+      the control endpoint (`SUBSCRIPTION_CONTROL_PORT`); changes are applied with `sub`, `unsub` and
+      `change_mode` requests on the live sockets, see `Watchlist` and `SubscriptionManager`.
+    - It operates within an infinite loop and is designed to run as a long-lived task within an 
+      asyncio event loop.
+    """
+
+    decode_pool = None
+    if DECODE_WORKERS > 0:
+        decode_pool = DecodePool(q=q, workers=DECODE_WORKERS)
+        decode_pool.start()
+
+    recorder = FrameRecorder(RECORD_FRAMES_DIR) if RECORD_FRAMES_DIR else None
+    credentials = None
+    backfiller = None
+    watchlist = None
+    control_runner = None
+
+    try:
+        if not REPLAY_FRAMES_DIR:
+            watchlist = await get_watchlist().start(functools.partial(get_instruments, max_age=0))
+            control_runner = await start_control_server(watchlist)
+            credentials = await CredentialManager().start()
+            source = create_backfill_source(access_token=credentials.access_token)
+            if source is not None:
+                backfiller = Backfiller(source, q.put).start()
+
+        if REPLAY_FRAMES_DIR:
+            await replay_frames(q=q, source=REPLAY_FRAMES_DIR, decode_pool=decode_pool, stats=FeedStats(name="replay"))
+            if decode_pool is not None:
+                await decode_pool.join()
+        elif WEBSOCKET_SHARDS > 1:
+            from .connection_manager import ShardedFeedManager
+
+            await ShardedFeedManager(q=q, shards=WEBSOCKET_SHARDS, instruments_getter=watchlist.instruments,
+                                     decode_pool=decode_pool, recorder=recorder,
+                                     credentials=credentials, backfiller=backfiller, watchlist=watchlist).run()
+        else:
+            await run_feed_connection(q=q, instruments_getter=watchlist.instruments, stats=FeedStats(name="feed"),
+                                      decode_pool=decode_pool, recorder=recorder, credentials=credentials,
+                                      backfiller=backfiller, watchlist=watchlist)
+    finally:
+        if control_runner is not None:
+            await control_runner.cleanup()
+        if watchlist is not None:
+            await watchlist.close()
+        if backfiller is not None:
+            await backfiller.close()
+        if credentials is not None:
+            await credentials.close()
+        if decode_pool is not None:
+            await decode_pool.close()
+        if recorder is not None:
+            recorder.close()
+
+
 if __name__ == "__main__":
     # Execute the function to fetch market data
     asyncio.run(fetch_market_data())
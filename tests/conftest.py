@@ -0,0 +1,5 @@
+import os
+
+# `db` refuses to import without InfluxDB credentials, the tests never connect
+for name in ("INFLUX_DB_URL", "INFLUX_DB_ORG", "INFLUX_BUCKET_NAME", "INFLUX_DB_TOKEN"):
+    os.environ.setdefault(name, "test")
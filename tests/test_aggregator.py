@@ -0,0 +1,68 @@
+from pipeline.aggregator import BarAggregator
+from v3.decoder import CandleRow
+
+ALIGN_MS = 225 * 60_000
+
+
+def test_late_final_update_of_previous_minute_is_refolded():
+    aggregator = BarAggregator(["I5"])
+    start = 1_700_000_000_000 // 60_000 * 60_000
+    minutes = {}
+    bars = {}
+    for m in range(12):
+        ts = start + m * 60_000
+        minutes[ts] = (100.0 + m, 101.0 + m, 99.0 + m, 100.5 + m, 10)
+        for bar in aggregator.update_candle(CandleRow("NSE_EQ|K", "I1", *minutes[ts], ts)):
+            bars[bar.ts] = bar
+        if m:
+            # The final values of the previous minute arrive after the new minute opened
+            previous = ts - 60_000
+            o, h, l, c, v = minutes[previous]
+            minutes[previous] = (o, h + 5, l - 5, c + 1, v + 20)
+            for bar in aggregator.update_candle(CandleRow("NSE_EQ|K", "I1", *minutes[previous], previous)):
+                bars[bar.ts] = bar
+
+    buckets = {}
+    for ts, values in sorted(minutes.items()):
+        buckets.setdefault((ts - ALIGN_MS) // 300_000 * 300_000 + ALIGN_MS, []).append(values)
+    for bucket, values in buckets.items():
+        bar = bars[bucket]
+        assert (bar.open, bar.high, bar.low, bar.close, bar.volume) == (
+            values[0][0], max(v[1] for v in values), min(v[2] for v in values), values[-1][3], sum(v[4] for v in values)
+        )
+
+
+def test_backfilled_gap_is_merged_into_open_and_closed_bars():
+    for offset in range(15):
+        aggregator = BarAggregator(["I5", "I15"])
+        start = ALIGN_MS + offset * 60_000
+        minutes = {start + m * 60_000: (100.0 + m, 102.0 + m, 98.0 + m, 101.0 + m, 10 + m) for m in range(24)}
+        bars = {}
+
+        def apply(new_bars):
+            for bar in new_bars:
+                bars[(bar.interval, bar.ts)] = bar
+
+        disconnect, reconnect = start + 6 * 60_000, start + 13 * 60_000
+        for ts, values in minutes.items():
+            if ts < disconnect:
+                apply(aggregator.update_candle(CandleRow("NSE_EQ|K", "I1", *values, ts)))
+        # Only a provisional value of the last minute was received before the disconnect
+        o, h, l, c, v = minutes[disconnect]
+        apply(aggregator.update_candle(CandleRow("NSE_EQ|K", "I1", o, h - 1, l + 1, c - 0.5, v - 5, disconnect)))
+        apply(aggregator.update_candle(CandleRow("NSE_EQ|K", "I1", *minutes[reconnect], reconnect)))
+        gap = [CandleRow("NSE_EQ|K", "I1", *minutes[ts], ts) for ts in minutes if disconnect <= ts < reconnect]
+        apply(aggregator.backfill("NSE_EQ|K", gap, disconnect, reconnect))
+        for ts, values in minutes.items():
+            if ts > reconnect:
+                apply(aggregator.update_candle(CandleRow("NSE_EQ|K", "I1", *values, ts)))
+
+        for interval, size in (("I5", 300_000), ("I15", 900_000)):
+            buckets = {}
+            for ts, values in sorted(minutes.items()):
+                buckets.setdefault((ts - ALIGN_MS) // size * size + ALIGN_MS, []).append(values)
+            for bucket, values in buckets.items():
+                bar = bars[(interval, bucket)]
+                assert (bar.open, bar.high, bar.low, bar.close, bar.volume) == (
+                    values[0][0], max(v[1] for v in values), min(v[2] for v in values), values[-1][3], sum(v[4] for v in values)
+                ), (offset, interval, bucket)
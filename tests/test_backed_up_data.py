@@ -0,0 +1,59 @@
+import asyncio
+import os
+
+from db.backed_up_data import BacklogReplayer
+from db.spill_store import SpillStore
+
+
+def _replayer(store, push, concurrency=2):
+    replayer = BacklogReplayer(store=store, url="http://influx", org="org", bucket="bucket", token="token",
+                               target_lines=1, concurrency=concurrency)
+    replayer._push_group = push
+    return replayer
+
+
+def test_last_spilled_value_of_a_point_wins(tmp_path):
+    written = {}
+
+    async def push(payload):
+        # The older value is the slowest write, it must still land first
+        await asyncio.sleep(0.05 if "Close=1 " in payload else 0)
+        for line in payload.split("\n"):
+            series, fields, ts = line.split(" ")
+            written[(series, ts)] = fields
+
+    async def main():
+        store = await SpillStore(os.path.join(tmp_path, "spill.sqlite"), max_rows=1000).open()
+        await store.append("I1,feed_name=A Close=1 60000")
+        await store.append("I1,feed_name=B Close=5 60000")
+        await store.append("I1,feed_name=A Close=2 60000")
+        await store.commit()
+        rows, _ = await _replayer(store, push).replay()
+        left = store.row_count
+        await store.close()
+        return rows, left
+
+    assert asyncio.run(main()) == (3, 0)
+    assert written == {("I1,feed_name=A", "60000"): "Close=2", ("I1,feed_name=B", "60000"): "Close=5"}
+
+
+def test_replay_stops_at_the_first_failed_group(tmp_path):
+    pushed = []
+
+    async def push(payload):
+        if payload == "I1,feed_name=A Close=1 60000":
+            raise ConnectionError("InfluxDB is down")
+        pushed.append(payload)
+
+    async def main():
+        store = await SpillStore(os.path.join(tmp_path, "spill.sqlite"), max_rows=1000).open()
+        for query in ("I1,feed_name=B Close=5 60000", "I1,feed_name=A Close=1 60000", "I1,feed_name=A Close=2 60000"):
+            await store.append(query)
+        await store.commit()
+        rows, _ = await _replayer(store, push).replay()
+        left = [query for _, query in await store.fetch_page(0, 10)]
+        await store.close()
+        return rows, left
+
+    assert asyncio.run(main()) == (1, ["I1,feed_name=A Close=1 60000", "I1,feed_name=A Close=2 60000"])
+    assert pushed == ["I1,feed_name=B Close=5 60000"]
@@ -0,0 +1,22 @@
+import time
+
+from v3.backfill import BAR_MS, GAP_BARS, Backfiller, PersistedBars
+from v3.decoder import CandleRow
+
+
+def test_last_bars_survive_a_restart(tmp_path):
+    path = str(tmp_path / "last_bars.json")
+    now = int(time.time() * 1000) // BAR_MS * BAR_MS
+    bars = PersistedBars(path, save_interval=0)
+    bars.update([CandleRow("NSE_EQ|A", "I1", 1, 1, 1, 1, 1, now), CandleRow("NSE_EQ|B", "I1", 1, 1, 1, 1, 1, 0)])
+
+    # The bar of B is too old to start a gap from
+    assert PersistedBars(path).last_ts == {"NSE_EQ|A": now}
+
+
+def test_gap_bars_are_counted_after_the_cut():
+    backfiller = Backfiller(source=None, put=None, max_bars=10)
+    before = GAP_BARS.value
+    backfiller.submit([("NSE_EQ|A", 0, 100 * BAR_MS)])
+
+    assert GAP_BARS.value - before == 9
@@ -0,0 +1,23 @@
+import asyncio
+
+from pipeline.backpressure import OVERFLOWS, BackpressureQueue
+from v3.decoder import CandleRow, DecodedFeed
+
+
+def _feed(close: float, ts: int = 0) -> DecodedFeed:
+    return DecodedFeed("live_feed", ts, 0.0, [CandleRow("NSE_EQ|A", "I1", close, close, close, close, 1, ts)], [])
+
+
+def test_coalesce_merges_into_the_newest_item():
+    async def run():
+        queue = BackpressureQueue(maxsize=2, policy="coalesce", name="test-coalesce")
+        for feed in (_feed(1.0), _feed(2.0), _feed(3.0), _feed(4.0, ts=60000)):
+            await queue.put(feed)
+        return queue.qsize(), [queue.get_nowait() for _ in range(queue.qsize())]
+
+    size, (oldest, newest) = asyncio.run(run())
+
+    assert size == 2
+    assert oldest == _feed(1.0)
+    assert [candle.close for candle in newest.candles] == [3.0, 4.0]
+    assert OVERFLOWS.labels("test-coalesce", "coalesced").value == 2
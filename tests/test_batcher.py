@@ -0,0 +1,73 @@
+import asyncio
+import time
+
+from pipeline.batcher import Batcher, LatencyTracker
+
+
+def test_slow_flush_does_not_overwrite_newer_batch():
+    # Both batches update the same candle, the first one is written slower than the second
+    written = {}
+
+    async def flush(batch):
+        key, value, delay = batch[0]
+        await asyncio.sleep(delay)
+        written[key] = value
+
+    async def run():
+        queue = asyncio.Queue()
+        queue.put_nowait(("NSE_EQ|INE002A01018 I1 1700000000000", "batch 1", 0.2))
+        queue.put_nowait(("NSE_EQ|INE002A01018 I1 1700000000000", "batch 2", 0.0))
+        batcher = Batcher(queue=queue, flush=flush, max_items=1, max_pending_flushes=4)
+        task = asyncio.create_task(batcher.run())
+        await asyncio.sleep(0.5)
+        task.cancel()
+
+    asyncio.run(run())
+    assert written == {"NSE_EQ|INE002A01018 I1 1700000000000": "batch 2"}
+
+
+def test_open_batch_survives_cancellation():
+    seen = []
+
+    async def flush(batch):
+        raise AssertionError("the batch is not closed yet")
+
+    async def run():
+        queue = asyncio.Queue()
+        queue.put_nowait("a")
+        queue.put_nowait("b")
+        batcher = Batcher(queue=queue, flush=flush, max_items=10, max_age_ms=60_000, on_item=seen.append)
+        task = asyncio.create_task(batcher.run())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await batcher.wait_flushes()
+        return batcher.take_open_batch(), batcher.take_open_batch()
+
+    assert asyncio.run(run()) == (["a", "b"], [])
+    assert seen == ["a", "b"]
+
+
+def test_latency_is_only_recorded_for_written_batches():
+    async def flush(batch):
+        return batch[0].written
+
+    class Item:
+        def __init__(self, written):
+            self.written = written
+            self.received_at = time.time()
+
+    async def run():
+        queue = asyncio.Queue()
+        queue.put_nowait(Item(False))
+        queue.put_nowait(Item(True))
+        tracker = LatencyTracker("test", report_interval=float("inf"))
+        batcher = Batcher(queue=queue, flush=flush, max_items=1, latency_tracker=tracker)
+        task = asyncio.create_task(batcher.run())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        await batcher.wait_flushes()
+        return len(tracker.samples)
+
+    assert asyncio.run(run()) == 1
@@ -0,0 +1,14 @@
+from pipeline.candle_filter import CandleChangeFilter
+from v3.decoder import CandleRow
+
+
+def test_discard_returns_held_back_candles():
+    candle_filter = CandleChangeFilter(mode="finalized", provisional_interval_ms=0)
+    ts = 1_700_000_000_000 // 60_000 * 60_000
+    assert candle_filter.filter([CandleRow("NSE_EQ|A", "I1", 1, 2, 0.5, 1.5, 10, ts),
+                                 CandleRow("NSE_EQ|B", "I1", 1, 2, 0.5, 1.5, 10, ts)], now=0) == []
+    last = CandleRow("NSE_EQ|B", "I1", 1, 3, 0.5, 1.8, 12, ts)
+    candle_filter.filter([last], now=1)
+
+    assert candle_filter.discard(["NSE_EQ|B"]) == [last]
+    assert [candle.instrument_key for candle in candle_filter.pending()] == ["NSE_EQ|A"]
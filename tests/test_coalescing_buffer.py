@@ -0,0 +1,21 @@
+import asyncio
+import time
+
+import pytest
+
+from pipeline.coalescing_buffer import CoalescingBuffer
+from v3.decoder import CandleRow, DecodedFeed
+
+
+def test_drain_returns_the_snapshot_before_it_is_due():
+    buffer = CoalescingBuffer(max_age_ms=60_000)
+    candle = CandleRow("NSE_EQ|A", "I1", 1, 2, 0.5, 1.5, 10, 60_000)
+    buffer.put_nowait(DecodedFeed("live_feed", 1, time.time(), [candle], []))
+    buffer.put_nowait("passthrough")
+
+    assert buffer.get_nowait() == "passthrough"
+    with pytest.raises(asyncio.QueueEmpty):
+        buffer.get_nowait()
+    drained = buffer.drain()
+    assert [feed.candles for feed in drained] == [[candle]]
+    assert buffer.drain() == []
@@ -0,0 +1,43 @@
+import asyncio
+
+from v3 import connection_manager
+from v3.connection_manager import ShardedFeedManager, partition_instruments
+
+
+def test_instruments_stay_on_their_shard():
+    instruments = [f"NSE_EQ|{i}" for i in range(100)]
+    partitions = partition_instruments(instruments, 4)
+
+    assert sorted(key for partition in partitions for key in partition) == sorted(instruments)
+    assert partition_instruments(list(reversed(instruments)), 4) == partitions
+    # Adding an instrument moves no other one
+    grown = partition_instruments(instruments + ["NSE_EQ|new"], 4)
+    assert [[key for key in partition if key != "NSE_EQ|new"] for partition in grown] == partitions
+
+
+def test_failed_shard_is_restarted_with_its_partition(monkeypatch):
+    calls = []
+
+    async def run_feed_connection(instruments_getter, name, **kwargs):
+        calls.append((name, await instruments_getter()))
+        if len(calls) < 2:
+            raise RuntimeError("connection loop failed")
+        raise asyncio.CancelledError
+
+    async def instruments():
+        return [f"NSE_EQ|{i}" for i in range(10)]
+
+    monkeypatch.setattr(connection_manager, "run_feed_connection", run_feed_connection)
+    monkeypatch.setattr(connection_manager, "SHARD_RESTART_DELAY", 0)
+    manager = ShardedFeedManager(asyncio.Queue(), shards=2, instruments_getter=instruments)
+
+    async def run():
+        try:
+            await manager.run_shard(1)
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(run())
+
+    partition = partition_instruments([f"NSE_EQ|{i}" for i in range(10)], 2)[1]
+    assert calls == [("shard-1", partition), ("shard-1", partition)]
@@ -0,0 +1,46 @@
+import asyncio
+
+from v3.credentials import CredentialManager
+
+
+def test_reconnect_awaits_the_prefetched_authorization():
+    calls = []
+
+    async def authorize():
+        calls.append(len(calls))
+        await asyncio.sleep(0.05)
+        return f"wss://feed/{len(calls)}"
+
+    async def main():
+        credentials = await CredentialManager(access_token="token", authorize_ttl=60).start()
+        credentials._authorize = authorize
+        # The connection dropped, the reconnect follows before the prefetch finished
+        credentials.prefetch_uri()
+        await asyncio.sleep(0.01)
+        uri = await credentials.authorized_uri()
+        await credentials.close()
+        return uri
+
+    assert asyncio.run(main()) == "wss://feed/1"
+    assert calls == [0]
+
+
+def test_failed_prefetch_is_authorized_again():
+    calls = []
+
+    async def authorize():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            raise ConnectionError("authorize endpoint unreachable")
+        return "wss://feed/2"
+
+    async def main():
+        credentials = await CredentialManager(access_token="token", authorize_ttl=60).start()
+        credentials._authorize = authorize
+        credentials.prefetch_uri()
+        uri = await credentials.authorized_uri()
+        await credentials.close()
+        return uri
+
+    assert asyncio.run(main()) == "wss://feed/2"
+    assert len(calls) == 2
@@ -0,0 +1,25 @@
+import asyncio
+
+from v3 import MarketDataFeedV3_pb2 as pb
+from v3.decode_pool import DecodePool
+
+
+def _frame() -> bytes:
+    response = pb.FeedResponse()
+    response.feeds["NSE_EQ|A"].ltpc.ltp = 101.5
+    return response.SerializeToString()
+
+
+def test_close_delivers_the_frames_in_flight_and_skips_bad_ones():
+    async def run():
+        q = asyncio.Queue()
+        pool = DecodePool(q, workers=1, chunk_size=2, chunk_wait_ms=60_000, top_of_book=False)
+        pool.start()
+        # One full chunk with a bad frame, then a partial chunk which is only dispatched by `close`
+        await pool.submit(_frame(), 1.0)
+        await pool.submit(b"\xff", 2.0)
+        await pool.submit(_frame(), 3.0)
+        await pool.close()
+        return [q.get_nowait().received_at for _ in range(q.qsize())]
+
+    assert asyncio.run(run()) == [1.0, 3.0]
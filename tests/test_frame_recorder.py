@@ -0,0 +1,13 @@
+from v3.frame_recorder import FrameRecorder, iter_frames
+
+
+def test_recorders_never_share_a_segment(tmp_path):
+    first, second = FrameRecorder(str(tmp_path)), FrameRecorder(str(tmp_path))
+    # Both open their first segment within the same second
+    first.record(b"a", 1.0)
+    second.record(b"b", 2.0)
+    first.close()
+    second.close()
+
+    assert len(list(tmp_path.iterdir())) == 2
+    assert sorted(iter_frames(str(tmp_path))) == [(1.0, b"a"), (2.0, b"b")]
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from db.influx_writer import InfluxWriteError, InfluxWriter
+
+
+def test_chunks_keep_the_last_line_of_a_point():
+    writer = InfluxWriter(url="http://influx", org="org", bucket="bucket", token="token", max_lines=1)
+    posted = []
+
+    async def post(chunk):
+        posted.append(chunk)
+
+    writer._post = post
+    asyncio.run(writer.write("I1,feed_name=A Close=1 1\nI1,feed_name=B Close=5 1\nI1,feed_name=A Close=2 1"))
+    assert sorted(posted) == ["I1,feed_name=A Close=2 1", "I1,feed_name=B Close=5 1"]
+
+
+def test_chunks_are_sent_concurrently():
+    writer = InfluxWriter(url="http://influx", org="org", bucket="bucket", token="token", max_lines=1, max_in_flight=4)
+    in_flight = []
+
+    async def post(chunk):
+        in_flight.append(chunk)
+        await asyncio.sleep(0.01)
+
+    async def main():
+        writer._post = post
+        write = asyncio.create_task(writer.write("a 1\nb 1\nc 1"))
+        await asyncio.sleep(0.005)
+        started = len(in_flight)
+        await write
+        return started
+
+    assert asyncio.run(main()) == 3
+
+
+def test_only_failed_chunks_are_returned():
+    writer = InfluxWriter(url="http://influx", org="org", bucket="bucket", token="token", max_lines=1)
+    posted = []
+
+    async def post(chunk):
+        if chunk == "b":
+            raise InfluxWriteError("rejected", failed_payloads=[chunk], status=500)
+        posted.append(chunk)
+
+    writer._post = post
+    with pytest.raises(InfluxWriteError) as error:
+        asyncio.run(writer.write("a\nb\nc"))
+    assert sorted(posted) == ["a", "c"]
+    assert error.value.failed_payloads == ["b"]
@@ -0,0 +1,28 @@
+from utils import instrument_master
+from utils.instrument_master import InstrumentMaster
+
+
+class NotModified:
+    status_code = 304
+
+
+def test_not_modified_refresh_keeps_the_index_and_marks_it_fresh(tmp_path, monkeypatch):
+    master = InstrumentMaster(cache_dir=str(tmp_path), max_age_hours=1)
+    master._write_index([{"instrument_key": "NSE_EQ|A", "trading_symbol": "AAA"}],
+                        {"etag": "v1", "last_modified": None, "fetched_at": 0})
+    master._map_index()
+    requests_seen = []
+
+    def get(url, headers, timeout):
+        requests_seen.append(headers)
+        return NotModified()
+
+    monkeypatch.setattr(instrument_master.requests, "get", get)
+
+    assert master.is_stale
+    assert master.refresh() is False
+    assert requests_seen == [{"If-None-Match": "v1"}]
+    assert not master.is_stale
+    assert master.get("NSE_EQ|A") == "AAA"
+    # The new fetch time is saved with the cache
+    assert not InstrumentMaster(cache_dir=str(tmp_path), max_age_hours=1).load().is_stale
@@ -0,0 +1,32 @@
+from db.line_protocol import LineProtocolEncoder
+from v3 import MarketDataFeedV3_pb2 as pb
+from v3.decoder import decode_feed_response
+
+
+def _frame() -> bytes:
+    response = pb.FeedResponse()
+    market_ff = response.feeds["NSE_EQ|A"].fullFeed.marketFF
+    market_ff.ltpc.ltp, market_ff.ltpc.ltt, market_ff.ltpc.ltq, market_ff.ltpc.cp = 101.5, 1000, 5, 100.0
+    market_ff.atp, market_ff.vtt = 101.0, 500
+    return response.SerializeToString()
+
+
+def test_fields_missing_from_the_frame_are_not_written():
+    tick = decode_feed_response(_frame(), 1.0).ticks[0]
+
+    assert (tick.oi, tick.tbq, tick.delta) == (None, None, None)
+    assert LineProtocolEncoder().encode_ticks([(2000, tick)]) == (
+        "tick,feed_name=NSE_EQ|A,trade_symbol=NSE_EQ|A LTP=101.5,LTT=1000i,LTQ=5i,CP=100.0,ATP=101.0,VTT=500i 2000"
+    )
+
+
+def test_missing_volume_is_not_written():
+    nan = float("nan")
+    lines = LineProtocolEncoder().encode_columns(
+        ["NSE_EQ|A", "NSE_EQ|A"], ["I1", "I1"], [1.0, 1.0], [2.0, 2.0], [0.5, 0.5], [1.5, 1.5], [10.0, nan], [0, 60000],
+    )
+
+    assert lines.splitlines() == [
+        "I1,feed_name=NSE_EQ|A,trade_symbol=NSE_EQ|A Open=1.0,High=2.0,Low=0.5,Close=1.5,Volume=10.0 0",
+        "I1,feed_name=NSE_EQ|A,trade_symbol=NSE_EQ|A Open=1.0,High=2.0,Low=0.5,Close=1.5 60000",
+    ]
@@ -0,0 +1,37 @@
+import pytest
+
+from utils.metrics import MetricsRegistry
+
+
+def test_render_prometheus_text_format():
+    registry = MetricsRegistry()
+    registry.counter("frames_total", "Frames.", ("shard",)).labels("shard-0").inc(3)
+    registry.gauge("depth", "Depth.").set_function(lambda: 2.5)
+    histogram = registry.histogram("seconds", "Seconds.", buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.render().splitlines() == [
+        "# HELP frames_total Frames.",
+        "# TYPE frames_total counter",
+        'frames_total{shard="shard-0"} 3',
+        "# HELP depth Depth.",
+        "# TYPE depth gauge",
+        "depth 2.5",
+        "# HELP seconds Seconds.",
+        "# TYPE seconds histogram",
+        'seconds_bucket{le="0.1"} 1',
+        'seconds_bucket{le="1"} 2',
+        'seconds_bucket{le="+Inf"} 3',
+        "seconds_sum 5.55",
+        "seconds_count 3",
+    ]
+
+
+def test_registered_metrics_are_reused():
+    registry = MetricsRegistry()
+
+    assert registry.counter("frames_total", "Frames.") is registry.counter("frames_total", "Frames.")
+    with pytest.raises(ValueError):
+        registry.gauge("frames_total", "Frames.")
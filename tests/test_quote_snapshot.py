@@ -0,0 +1,46 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from pipeline.quote_snapshot import QuoteSnapshotReader, QuoteSnapshotWriter
+from v3 import MarketDataFeedV3_pb2 as pb
+from v3.decoder import decode_feed_response
+
+
+def _frame() -> bytes:
+    response = pb.FeedResponse()
+    market_ff = response.feeds["NSE_EQ|A"].fullFeed.marketFF
+    market_ff.ltpc.ltp = 101.5
+    for price in (101.0, 100.5):
+        quote = market_ff.marketLevel.bidAskQuote.add()
+        quote.bidQ, quote.bidP, quote.askQ, quote.askP = 10, price, 20, price + 1
+    return response.SerializeToString()
+
+
+def test_top_of_book_is_decoded_without_depth():
+    feed = decode_feed_response(_frame(), 1.0, depth=False, top_of_book=True)
+    assert feed.ticks[0].depth == ((10, 101.0, 20, 102.0),)
+    assert decode_feed_response(_frame(), 1.0, depth=False, top_of_book=False).ticks[0].depth == ()
+
+
+def _open_and_read(name: str):
+    # Runs in another process, like a second ingest process and a bot would
+    try:
+        QuoteSnapshotWriter(name=name, capacity=4, intervals=["I1"]).open()
+        opened = True
+    except FileExistsError:
+        opened = False
+    with QuoteSnapshotReader(name) as reader:
+        quote = reader.get("NSE_EQ|A")
+    return opened, (quote.ltp, quote.bid_p, quote.ask_p)
+
+
+def test_snapshot_of_a_running_process_is_not_replaced():
+    name = f"test_quotes_{os.getpid()}"
+    writer = QuoteSnapshotWriter(name=name, capacity=4, intervals=["I1"]).open()
+    try:
+        writer.update(decode_feed_response(_frame(), 1.0, depth=False, top_of_book=True))
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            assert pool.submit(_open_and_read, name).result() == (False, (101.5, 101.0, 102.0))
+    finally:
+        writer.close()
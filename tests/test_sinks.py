@@ -0,0 +1,55 @@
+import asyncio
+
+from db.sinks import Sink, SinkBatch, SinkRunner
+from v3.decoder import CandleRow
+
+
+class FlakySink(Sink):
+    name = "flaky"
+
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.attempts = 0
+        self.written = []
+        self.spilled = []
+
+    async def write(self, batch: SinkBatch) -> None:
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise ConnectionError("sink unavailable")
+        self.written.append(batch)
+
+    async def spill(self, batch: SinkBatch) -> None:
+        self.spilled.append(batch)
+
+
+def _batch(close: float) -> SinkBatch:
+    return SinkBatch([CandleRow("NSE_EQ|A", "I1", close, close, close, close, 1, 0)], [], 0.0)
+
+
+def _run(sink: Sink, *batches: SinkBatch) -> None:
+    async def run():
+        runner = await SinkRunner(sink, retries=3, retry_delay=0, max_age_ms=60_000).start()
+        for batch in batches:
+            await runner.submit(batch)
+        await runner.close()
+
+    asyncio.run(run())
+
+
+def test_failed_write_is_retried():
+    sink = FlakySink(failures=2)
+    _run(sink, _batch(1.0), _batch(2.0))
+
+    assert sink.attempts == 3
+    assert [candle.close for batch in sink.written for candle in batch.candles] == [1.0, 2.0]
+    assert sink.spilled == []
+
+
+def test_batch_is_spilled_after_the_last_attempt():
+    sink = FlakySink(failures=3)
+    _run(sink, _batch(1.0))
+
+    assert sink.attempts == 3
+    assert sink.written == []
+    assert sink.spilled == [_batch(1.0)]
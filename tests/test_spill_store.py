@@ -0,0 +1,41 @@
+import asyncio
+import os
+
+from db.spill_store import SpillStore
+
+
+def test_close_commits_buffered_rows(tmp_path):
+    db_path = os.path.join(tmp_path, "spill.sqlite")
+
+    async def main():
+        store = await SpillStore(db_path, max_rows=1000, commit_interval_ms=10_000).open()
+        for i in range(10):
+            await store.append(f"row {i}")
+        await store.close()
+        reopened = await SpillStore(db_path, max_rows=1000).open()
+        count = reopened.row_count
+        await reopened.close()
+        return count
+
+    assert asyncio.run(main()) == 10
+
+
+def test_cancelled_commit_keeps_rows(tmp_path):
+    db_path = os.path.join(tmp_path, "spill.sqlite")
+
+    async def main():
+        store = await SpillStore(db_path, max_rows=1000, commit_interval_ms=10_000).open()
+        for i in range(10):
+            await store.append(f"row {i}")
+        commit = asyncio.create_task(store.commit())
+        await asyncio.sleep(0)
+        commit.cancel()
+        await asyncio.gather(commit, return_exceptions=True)
+        pending = store.pending_rows
+        await store.close()
+        reopened = await SpillStore(db_path, max_rows=1000).open()
+        count = reopened.row_count
+        await reopened.close()
+        return pending, count
+
+    assert asyncio.run(main()) == (10, 10)
@@ -0,0 +1,60 @@
+import asyncio
+import json
+
+from v3 import subscriptions
+from v3.subscriptions import SubscriptionManager, Watchlist
+
+
+class FakeWebsocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, message: bytes) -> None:
+        request = json.loads(message)
+        self.sent.append((request["method"], request["data"].get("mode"), request["data"]["instrumentKeys"]))
+
+
+def test_sync_sends_only_the_difference():
+    async def run():
+        websocket = FakeWebsocket()
+        manager = SubscriptionManager(websocket)
+        await manager.sync({"A": "full", "B": "full", "C": "ltpc"})
+        websocket.sent.clear()
+        removed = await manager.sync({"A": "full", "C": "full", "D": "ltpc"})
+        return removed, websocket.sent, manager.active
+
+    removed, sent, active = asyncio.run(run())
+
+    assert removed == ["B"]
+    assert sent == [("unsub", None, ["B"]), ("sub", "ltpc", ["D"]), ("change_mode", "full", ["C"])]
+    assert active == {"A": "full", "C": "full", "D": "ltpc"}
+
+
+def test_sync_splits_messages_into_batches(monkeypatch):
+    monkeypatch.setattr(subscriptions, "SUBSCRIPTION_BATCH_SIZE", 2)
+    websocket = FakeWebsocket()
+    asyncio.run(SubscriptionManager(websocket).sync({key: "full" for key in "ABCDE"}))
+
+    assert [keys for _, _, keys in websocket.sent] == [["A", "B"], ["C", "D"], ["E"]]
+
+
+def test_listeners_get_the_removed_keys():
+    async def run():
+        async def instruments():
+            return ["A", "B", "C"]
+
+        watchlist = Watchlist(mode="full", refresh_interval=0)
+        removed = []
+        watchlist.add_listener(removed.append)
+        await watchlist.start(instruments)
+        version = watchlist.version
+        await watchlist.apply(add=["D"], remove=["B"], mode="ltpc")
+        # Adding an instrument back removes nothing
+        await watchlist.apply(add=["B"])
+        return removed, watchlist.version - version, watchlist.desired
+
+    removed, versions, desired = asyncio.run(run())
+
+    assert removed == [{"B"}]
+    assert versions == 2
+    assert desired == {"A": "full", "C": "full", "D": "ltpc", "B": "full"}
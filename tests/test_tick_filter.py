@@ -0,0 +1,27 @@
+from pipeline.tick_filter import TickThrottle
+from v3.decoder import DecodedFeed, TickRow
+
+
+def _feed(ts, *ticks):
+    return DecodedFeed("live_feed", ts, 0.0, [], list(ticks))
+
+
+def test_trailing_tick_is_written_once_the_interval_expired():
+    throttle = TickThrottle(interval_ms=1000)
+    first, second, last = (TickRow("NSE_EQ|A", ltp, 0, 1, 100) for ltp in (100, 101, 102))
+    other = TickRow("NSE_EQ|B", 50, 0, 1, 50)
+
+    assert throttle.filter([_feed(0, first, other), _feed(200, second), _feed(400, last)]) == [(0, first), (0, other)]
+    assert throttle.pending() == [(400, last)]
+    # A frame of another instrument moves the feed clock past the interval
+    assert throttle.filter([_feed(1000, other)]) == [(400, last)]
+    assert throttle.pending() == []
+
+
+def test_held_tick_is_returned_on_discard():
+    throttle = TickThrottle(interval_ms=1000)
+    first, last = TickRow("NSE_EQ|A", 100, 0, 1, 100), TickRow("NSE_EQ|A", 101, 0, 1, 100)
+    throttle.filter([_feed(0, first), _feed(500, last)])
+
+    assert throttle.discard(["NSE_EQ|A"]) == [(500, last)]
+    assert throttle.pending() == []